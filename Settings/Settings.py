@@ -20,8 +20,47 @@ musicSnippetsDataBaseTagsURL = os.path.join(
     rootURL, musicDBPath, "DatabaseSplittedTags.csv"
 )
 musicMoodsDataBaseURL = os.path.join(rootURL, musicDBPath, "Cyanite.csv")
+musicSnapshotURL = os.path.join(rootURL, musicDBPath, "snapshot")
+musicGraphURL = os.path.join(rootURL, musicDBPath, "graph")
+musicSQLiteURL = os.path.join(rootURL, musicDBPath, "music.sqlite")
+musicSharedURL = os.path.join(rootURL, musicDBPath, "shared")
+musicANNURL = os.path.join(rootURL, musicDBPath, "ann")
+# the 2D UMAP projection of the snippets, a .csv file with the FileNames, x and y of every snippet
+musicProjectionDataBaseURL = os.path.join(rootURL, musicDBPath, "Projection.csv")
+# the grid over that projection, built from it offline
+musicProjectionURL = os.path.join(rootURL, musicDBPath, "projection")
 
 # global variables
+musicDatabaseBackend = (
+    "pandas"  # where the music database is read from, "pandas", "sqlite" or "shared"
+)
+musicGraphNeighbours = 20  # the number of transition targets stored per snippet
+musicQueryCacheSize = 256  # the number of similarity query results kept in memory
+musicQueryCacheDepth = 100  # the number of best matches a cached result keeps, from which those of recently played pieces are skipped
+musicTimingsSize = (
+    1024  # the number of last similarity queries whose stage timings are kept
+)
+musicMoodEntryPoints = 250  # the number of best pieces per mood to start playback from
+musicSearchBudget = 50  # the time in ms a transition search may take before giving up
+musicSearchChunk = 10000  # the number of candidates a transition search scores before it looks at the time again
+musicRecentPieces = (
+    10  # the number of last played pieces that the similarity search avoids
+)
+musicRecencyPenalty = (
+    1000  # the score added to snippets of those pieces, which puts them last
+)
+musicBuildWorkers = (
+    0  # the number of processes building the database artifacts, 0 for one per core
+)
+musicQueryWorkers = (
+    0  # the number of threads querySimilarPieces runs lookups on, 0 for one per core
+)
+musicANNLists = 0  # the number of clusters of the nearest-neighbour index, 0 for the square root of the snippets
+musicANNProbes = 16  # the number of clusters a nearest-neighbour search looks in, more is slower but finds more
+musicProjectionAngle = 30  # the largest angle in degrees between the direction of a directional search and its matches
+
+# the mood columns of the snippet database
+musicMoods = ["Dark", "Chill", "Epic", "Scary", "Ethereal", "Calm", "Sad", "Romantic"]
 shutterSpeed = 0.05  # the time between 2 imageGrabs
 
 # detection coordinates
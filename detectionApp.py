@@ -35,6 +35,7 @@ if __name__ == "__main__":
     context = contextMain()
     """
     currentState = "False"
+    playing = None
 
     while True:
 
@@ -44,6 +45,17 @@ if __name__ == "__main__":
             detector.runDetection(screenshots)
 
             print(detector.gameStateAvg, end="\r")
+
+            """
+            # every tick is handed to the context module, which decides on a new mood when the game
+            # state changes. The other moods that fit the change are passed on with it, to fall back
+            # on when there are no matches for the first.
+            mood = context.main(currentState, detector.gameStateAvg, playing)
+            currentState = detector.gameStateAvg
+            if mood is not None:
+                playing = music.main(mood, context.moodOptions)
+            """
+
             if not isinstance(detector.preview, type(None)):
                 try:
                     cv2.imshow("test", detector.preview)
@@ -20,6 +20,9 @@ class contextMain:
     moods : List
         List containg str of possible moods
 
+    moodOptions : List
+        List containg str of the moods that fit the last change in game state, best first
+
     detections : List
         List containg str of possible gamestate detections
 
@@ -91,6 +94,9 @@ class contextMain:
             "False",
         ]
 
+        # the moods that fit the last change in game state, in order of preference.
+        self.moodOptions: List[str] = []
+
         self.decisionMatrix = None
         self.initDecisionMatrix()
 
@@ -152,10 +158,15 @@ class contextMain:
                 x = self.detections.index(gameStateNew)
                 y = self.detections.index(gameStateOld)
                 # the line below gets the mood corresponding to the new gamestate taking in context.
-                # from the decision matrix a list is retrieved, with the 3 closest moods that match,
-                # for the moment we only use the first one but TODO we can actually build in the logic
-                # to try the second element of the list if the first doesn't find any corresponding
-                # matches, from the similarity lookup.
+                # from the decision matrix a list is retrieved, with the closest moods that match. The
+                # first one is returned, all of them are kept in 'moodOptions' in order of preference.
+                # The main loop passes them on to musicMain.main, whose relaxed search falls back on the
+                # next ones when there are no matches for the first.
+                self.moodOptions = [
+                    option
+                    for option in self.decisionMatrix[x][y][self.activityLevel]
+                    if isinstance(option, str)
+                ]
                 mood = self.decisionMatrix[x][y][self.activityLevel][0]
 
                 self.logger.debug(
@@ -169,11 +180,13 @@ class contextMain:
                 # they both have a use. This is what I am solving below.
                 if gameStateNew == "None":
                     mood = None
+                    self.moodOptions = []
                     self.logger.warning(
                         f"gamestate changed - with ValueError - new gameState is None"
                     )
                 else:
                     mood = gameStateNew
+                    self.moodOptions = [mood]
                     self.logger.warning(
                         f"gamestate changed - with ValueError - new gameState is {mood}"
                     )
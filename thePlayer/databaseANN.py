@@ -0,0 +1,362 @@
+import os
+import json
+import shutil
+import numpy as np
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from Settings.Settings import musicANNURL, musicANNLists
+from thePlayer.databaseSnapshot import databaseSnapshot, snapshotTables
+from thePlayer.databaseScoring import defaultWeights
+
+# version of the layout of the index, bump it whenever the way it is built or stored changes.
+annVersion: int = 1
+
+# the number of k-means iterations, and the number of snippets per list sampled to train on.
+annIterations: int = 20
+annSamplesPerList: int = 64
+
+# the smallest valence or arousal a ratio to it is weighted by, values close to 0 would leave only
+# that dimension to decide which clusters are probed.
+annRatioFloor: float = 0.25
+
+
+class databaseANN:
+    """
+    databaseANN is an approximate nearest-neighbour index over the feature vectors of the snippets, so
+    a similarity search can look through the whole catalog rather than the candidate block of one
+    instrument and dominant note. It is an inverted file index: the snippets are clustered with k-means
+    and stored per cluster, and a query only looks at the clusters whose centroid is closest to it.
+
+    The feature vectors follow the score of databaseScoring, so snippets that are close in the index
+    also score well against each other: half the note histogram as a distribution over the 12 pitch
+    classes, since the notes in common make up one minus half their difference, then the log of the
+    tempo and the noisiness, since a ratio is a difference of logs, and the valence and the arousal
+    themselves, which are compared as a ratio to the value of the reference. The weights of a query
+    and its valence and arousal are applied to the distances to the centroids, so the same index serves
+    any query. The snippets of the clusters that are probed are then scored exactly by databaseScoring,
+    the number of clusters probed trades recall for latency.
+
+    The centroids, the offset of every cluster and the row positions of the snippets sorted by cluster
+    are written as .npy files next to a manifest, and memory mapped when loaded. Snippets without a
+    valence value are never a match and are left out.
+
+    ...
+
+    Attributes
+    ----------
+    centroids : np.ndarray
+        (n_lists x 16) float32 centroids of the clusters.
+
+    offsets : np.ndarray
+        offset table of the clusters, the snippets of the i-th cluster are positions[offsets[i]:offsets[i + 1]].
+
+    positions : np.ndarray
+        int32 row positions of the snippets, sorted by cluster and within a cluster by position.
+
+    Methods
+    -------
+    build() :
+        clusters the feature vectors of the snippets and writes the index to disk.
+
+    load() :
+        memory maps the index, if it is up to date.
+
+    isStale() :
+        checks whether the index is missing or was built from other data.
+
+    stamp() :
+        returns everything the content of the index depends on.
+
+    search() :
+        returns the row positions of the snippets in the clusters closest to a reference.
+
+    featureVectors() :
+        builds the feature vectors of snippets.
+
+    dimensionWeights() :
+        spreads the weights of the scoring over the dimensions of the vectors.
+
+    kmeans() :
+        clusters weighted vectors.
+
+    assign() :
+        assigns vectors to the closest centroid.
+
+    """
+
+    def __init__(self, annURL: str = musicANNURL, lists: int = musicANNLists) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.annURL: str = annURL
+        self.manifestURL: str = os.path.join(annURL, "manifest.json")
+        self.lists: int = lists
+
+        self.centroids: Optional[np.ndarray] = None
+        self.offsets: Optional[np.ndarray] = None
+        self.positions: Optional[np.ndarray] = None
+
+    def build(self, database: object) -> None:
+        """
+        :database: a loaded databaseMain object
+        """
+
+        scoring: object = database.scoring
+        size: int = len(database.index.primaryKeys)
+
+        positions: np.ndarray = np.flatnonzero(~np.isnan(scoring.valence))
+        vectors: np.ndarray = self.featureVectors(scoring, positions)
+
+        # the clusters are trained with the default weights, and the valence and arousal of a typical
+        # snippet as the reference.
+        weights: np.ndarray = self.dimensionWeights(
+            defaultWeights,
+            np.mean(np.abs(vectors[:, 14])),
+            np.mean(np.abs(vectors[:, 15])),
+        )
+
+        lists: int = self.lists or max(1, int(np.sqrt(len(positions))))
+        centroids, assignment = self.kmeans(
+            vectors * weights, min(lists, len(positions))
+        )
+        centroids /= weights
+
+        order: np.ndarray = np.argsort(assignment, kind="stable")
+        offsets: np.ndarray = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=len(centroids)), out=offsets[1:])
+
+        tmpURL: str = self.annURL + ".tmp"
+        if os.path.isdir(tmpURL):
+            shutil.rmtree(tmpURL)
+        os.makedirs(tmpURL)
+
+        for name, array in (
+            ("centroids", centroids.astype(np.float32)),
+            ("offsets", offsets),
+            ("positions", positions[order].astype(np.int32)),
+        ):
+            np.save(os.path.join(tmpURL, name + ".npy"), array)
+
+        with open(os.path.join(tmpURL, "manifest.json"), "w") as f:
+            json.dump(self.stamp(size), f, indent=2)
+
+        if os.path.isdir(self.annURL):
+            shutil.rmtree(self.annURL)
+        os.replace(tmpURL, self.annURL)
+
+        # perform logging operations
+        self.logger.info(
+            f"build called - {len(positions)} snippets in {len(centroids)} lists written"
+        )
+
+    def load(self, size: int) -> bool:
+        """
+        Memory maps the index, unless it is stale.
+
+        :size: number of snippets in the loaded snippet database
+        :return: True if the index has been loaded
+        """
+
+        if self.isStale(size):
+            self.logger.warning(
+                "load called - nearest-neighbour index missing or stale, searching exhaustively"
+            )
+            self.centroids = self.offsets = self.positions = None
+            return False
+
+        for name in ("centroids", "offsets", "positions"):
+            setattr(
+                self,
+                name,
+                np.load(os.path.join(self.annURL, name + ".npy"), mmap_mode="r"),
+            )
+
+        return True
+
+    def isStale(self, size: int) -> bool:
+        """
+        :size: number of snippets in the loaded snippet database
+        :return: True if there is no index, or it was built from other data or settings
+        """
+
+        try:
+            with open(self.manifestURL) as f:
+                manifest: Dict[str, Any] = json.load(f)
+        except (OSError, ValueError):
+            return True
+
+        return manifest != self.stamp(size)
+
+    def stamp(self, size: int) -> Dict[str, Any]:
+        """
+        :size: number of snippets in the snippet database
+        :return: everything the content of the index depends on
+        """
+
+        snapshot: object = databaseSnapshot()
+
+        return {
+            "version": annVersion,
+            "rows": size,
+            "lists": self.lists,
+            "sources": [
+                (
+                    snapshot.sourceStamp(snapshotTables["snippets"][0])
+                    if os.path.isfile(snapshotTables["snippets"][0])
+                    else None
+                )
+            ],
+        }
+
+    def search(
+        self,
+        scoring: object,
+        reference: int,
+        weights: List[float],
+        changes: Tuple[float, float, float] = (0, 0, 0),
+        probes: int = 1,
+    ) -> np.ndarray:
+        """
+        :scoring: the databaseScoring object of the loaded database
+        :reference: row position of the reference snippet
+        :weights: importance of notes, tempo, noisiness, valence and arousal
+        :changes: the tempo, valence and arousal change of the query
+        :probes: the number of clusters to look in, more finds more of the true matches but takes longer
+        :return: sorted row positions of the snippets in the probed clusters
+        """
+
+        query: np.ndarray = self.featureVectors(
+            scoring, np.array([reference]), changes
+        )[0]
+
+        distances: np.ndarray = np.square(
+            (self.centroids - query)
+            * self.dimensionWeights(weights, query[14], query[15])
+        ).sum(axis=1)
+
+        probes = min(max(probes, 1), len(distances))
+        probed: np.ndarray = np.argpartition(distances, probes - 1)[:probes]
+
+        return np.sort(
+            np.concatenate(
+                [
+                    self.positions[self.offsets[cluster] : self.offsets[cluster + 1]]
+                    for cluster in probed.tolist()
+                ]
+            ).astype(np.int64)
+        )
+
+    def featureVectors(
+        self,
+        scoring: object,
+        positions: np.ndarray,
+        changes: Tuple[float, float, float] = (0, 0, 0),
+    ) -> np.ndarray:
+        """
+        :scoring: the databaseScoring object of the loaded database
+        :positions: row positions of the snippets
+        :changes: the tempo, valence and arousal change to apply to the snippets
+        :return: (n_positions x 16) float32 matrix with half the note distribution, the log of the tempo
+            and the noisiness, the valence and the arousal of every snippet
+        """
+
+        notes: np.ndarray = scoring.noteHistograms[positions].astype(np.float32)
+        notes /= np.maximum(notes.sum(axis=1, keepdims=True), 1) * 2
+
+        return np.column_stack(
+            [
+                notes,
+                np.log(np.maximum(scoring.tempo[positions] + changes[0], 1e-6)),
+                np.log(np.maximum(scoring.noisiness[positions], 1e-6)),
+                scoring.valence[positions] + changes[1],
+                scoring.arousal[positions] + changes[2],
+            ]
+        ).astype(np.float32)
+
+    def dimensionWeights(
+        self, weights: List[float], valence: float, arousal: float
+    ) -> np.ndarray:
+        """
+        :weights: importance of notes, tempo, noisiness, valence and arousal
+        :valence: valence of the reference, the valence of a match is compared as a ratio to it
+        :arousal: arousal of the reference, the arousal of a match is compared as a ratio to it
+        :return: the weight of every dimension of the vectors
+        """
+
+        return np.array(
+            [weights[0]] * 12
+            + [
+                weights[1],
+                weights[2],
+                weights[3] / max(abs(valence), annRatioFloor),
+                weights[4] / max(abs(arousal), annRatioFloor),
+            ],
+            dtype=np.float32,
+        )
+
+    def kmeans(self, vectors: np.ndarray, lists: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Lloyd's k-means, trained on a sample of the vectors after which every vector is assigned to the
+        closest centroid. The random state is fixed, so a rebuild from the same data gives the same index.
+
+        :vectors: (n x d) weighted vectors
+        :lists: the number of clusters
+        :return: the (lists x d) centroids and the cluster of every vector
+        """
+
+        rng: object = np.random.default_rng(0)
+        sample: np.ndarray = vectors[
+            rng.choice(
+                len(vectors),
+                min(len(vectors), lists * annSamplesPerList),
+                replace=False,
+            )
+        ]
+        centroids: np.ndarray = sample[rng.choice(len(sample), lists, replace=False)]
+
+        for _ in range(annIterations):
+            assignment: np.ndarray = self.assign(sample, centroids)
+            counts: np.ndarray = np.bincount(assignment, minlength=lists)
+
+            sums: np.ndarray = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+
+            # clusters that lost all their vectors start over from a random one.
+            empty: np.ndarray = counts == 0
+            centroids = np.where(
+                empty[:, np.newaxis],
+                sample[rng.choice(len(sample), lists)],
+                sums / np.maximum(counts, 1)[:, np.newaxis],
+            )
+
+        return centroids, self.assign(vectors, centroids)
+
+    def assign(self, vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """
+        :vectors: (n x d) weighted vectors
+        :centroids: (lists x d) centroids
+        :return: the index of the closest centroid for every vector
+        """
+
+        assignment: np.ndarray = np.empty(len(vectors), dtype=np.int64)
+        norms: np.ndarray = np.square(centroids).sum(axis=1)
+
+        # the distance matrix is built in chunks, for 1M snippets it wouldn't fit in memory at once.
+        for start in range(0, len(vectors), 8192):
+            chunk: np.ndarray = vectors[start : start + 8192]
+            assignment[start : start + 8192] = np.argmin(
+                norms - 2 * chunk @ centroids.T, axis=1
+            )
+
+        return assignment
+
+
+if __name__ == "__main__":
+
+    # build the nearest-neighbour index from the current database, run from the root of the repo with:
+    # python -m thePlayer.databaseANN
+    from thePlayer.databaseMain import databaseMain
+
+    logging.basicConfig(level=logging.INFO)
+    databaseANN().build(databaseMain(backend="pandas", rebuild=False))
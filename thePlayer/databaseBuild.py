@@ -0,0 +1,281 @@
+import os
+import sys
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from Settings.Settings import musicBuildWorkers, musicDatabaseBackend
+from thePlayer.databaseSnapshot import databaseSnapshot, snapshotTables
+from thePlayer.databaseGraph import databaseGraph
+from thePlayer.databaseSQLite import databaseSQLite
+from thePlayer.databaseShared import databaseShared
+from thePlayer.databaseANN import databaseANN
+from thePlayer.databaseProjection import databaseProjection
+
+# number of reference snippets scored by a single task of the graph build. Large candidate blocks are
+# split over several tasks so the work spreads evenly over the processes.
+graphTaskSize: int = 2048
+
+# the database loaded by a worker process, on the first task that needs it.
+workerDatabase: Optional[object] = None
+
+
+def loadWorkerDatabase() -> object:
+    """
+    :return: the database of the worker process, loaded from the snapshot without building anything
+    """
+
+    global workerDatabase
+
+    if workerDatabase is None:
+        from thePlayer.databaseMain import databaseMain
+
+        workerDatabase = databaseMain(backend="pandas", rebuild=False)
+
+    return workerDatabase
+
+
+def readTable(table: str) -> TypeVar("pd.DataFrame"):
+    """
+    :table: name of the table, one of the keys of snapshotTables
+    :return: the table as read from its .csv file
+    """
+    return databaseSnapshot().readSource(table)
+
+
+def scoreGraphTask(
+    tasks: List[Tuple[Tuple[Any, Any], np.ndarray]],
+) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    :tasks: pairs of a candidate block and the row positions of the references in it to score
+    :return: the references, their targets and their scores for every pair
+    """
+
+    database: object = loadWorkerDatabase()
+    graph: databaseGraph = databaseGraph()
+    results: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+
+    for block, references in tasks:
+        targets, scores = graph.scoreBlock(
+            database,
+            database.index.candidatePositions(*block),
+            references,
+            np.full((len(references), graph.k), -1, dtype=np.int32),
+            np.full((len(references), graph.k), np.nan, dtype=np.float32),
+        )
+        results.append((references, targets, scores))
+
+    return results
+
+
+def buildSQLite() -> None:
+    """
+    Builds the SQLite file from the database of the worker process.
+    """
+    databaseSQLite().build(loadWorkerDatabase())
+
+
+def publishShared() -> None:
+    """
+    Publishes the shared segment from the database of the worker process.
+    """
+    databaseShared().publish(loadWorkerDatabase())
+
+
+def buildANN() -> None:
+    """
+    Builds the nearest-neighbour index from the database of the worker process.
+    """
+    databaseANN().build(loadWorkerDatabase())
+
+
+def buildProjection() -> None:
+    """
+    Builds the grid over the UMAP projection from the database of the worker process.
+    """
+    databaseProjection().build(loadWorkerDatabase())
+
+
+class databaseBuild:
+    """
+    databaseBuild brings all the artifacts derived from the .csv files in theDB/ up to date in one go:
+    the snapshot, the transition graph, the nearest-neighbour index, the grid over the UMAP projection and, for the backends that use them, the SQLite file and the
+    shared segment with the note histograms, key lookups and candidate blocks. Each artifact is stamped
+    with the content hashes of the .csv files it was built from, and only the artifacts whose stamp
+    doesn't match are built again.
+
+    The work is spread over a pool of processes. The tables are parsed in parallel, after which the
+    SQLite file, the shared segment, the nearest-neighbour index, the projection grid and the candidate blocks of the
+    transition graph are built side by side. Every worker loads the database from the fresh snapshot once and reuses it for its tasks.
+
+    ...
+
+    Attributes
+    ----------
+    workers : int
+        number of processes in the pool.
+
+    Methods
+    -------
+    build() :
+        builds the artifacts that are stale.
+
+    staleArtifacts() :
+        lists the artifacts that are missing or were built from other data.
+
+    buildGraph() :
+        builds the transition graph with the pool.
+
+    """
+
+    def __init__(self, workers: int = musicBuildWorkers) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.workers: int = workers or os.cpu_count() or 1
+
+    def build(
+        self, backend: Optional[str] = musicDatabaseBackend, force: bool = False
+    ) -> List[str]:
+        """
+        :backend: the backend the database is used with, the SQLite file and the shared segment are only
+            built for their own backend. None builds the artifacts of all the backends.
+        :force: True to build all the artifacts, also the ones that are up to date
+        :return: names of the artifacts that were built
+        """
+
+        stale: List[str] = self.staleArtifacts(backend, force)
+
+        if not stale:
+            return stale
+
+        # perform logging operations
+        self.logger.warning(f"build called - building artifacts: {stale}")
+
+        # the workers are started fresh rather than forked, they must not inherit the state of a
+        # process that is halfway through loading its own database.
+        with ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            if "snapshot" in stale:
+                databaseSnapshot().build(
+                    dict(zip(snapshotTables, pool.map(readTable, snapshotTables)))
+                )
+
+            futures: List[Future] = []
+            if "sqlite" in stale:
+                futures.append(pool.submit(buildSQLite))
+            if "shared" in stale:
+                futures.append(pool.submit(publishShared))
+            if "ann" in stale:
+                futures.append(pool.submit(buildANN))
+            if "projection" in stale:
+                futures.append(pool.submit(buildProjection))
+
+            if "graph" in stale:
+                self.buildGraph(pool)
+
+            for future in futures:
+                future.result()
+
+        # perform logging operations
+        self.logger.info(f"build called - artifacts built: {stale}")
+
+        return stale
+
+    def staleArtifacts(self, backend: Optional[str], force: bool = False) -> List[str]:
+        """
+        :backend: the backend the database is used with, None for all of them
+        :force: True to list all the artifacts for the backend
+        :return: names of the artifacts that have to be built, in the order they are built in
+        """
+
+        snapshot: databaseSnapshot = databaseSnapshot()
+        stale: List[str] = []
+
+        if force or snapshot.isStale():
+            stale.append("snapshot")
+
+        if backend in ("sqlite", None) and (force or databaseSQLite().isStale()):
+            stale.append("sqlite")
+
+        if backend in ("shared", None) and (force or databaseShared().isStale()):
+            stale.append("shared")
+
+        # the size of the graph and the index is that of the snippet table, which a stale snapshot
+        # can't tell.
+        rows: Optional[int] = (
+            None
+            if "snapshot" in stale
+            else snapshot.readManifest()["tables"]["snippets"]["rows"]
+        )
+
+        if force or rows is None or databaseANN().isStale(rows):
+            stale.append("ann")
+
+        # the grid is only built when there is a projection to build it from.
+        projection: databaseProjection = databaseProjection()
+        if os.path.isfile(projection.sourceURL) and (
+            force or rows is None or projection.isStale(rows)
+        ):
+            stale.append("projection")
+
+        if force or rows is None or databaseGraph().isStale(rows):
+            stale.append("graph")
+
+        return stale
+
+    def buildGraph(self, pool: ProcessPoolExecutor) -> None:
+        """
+        Builds the transition graph like databaseGraph.build() does, with the candidate blocks spread
+        over the processes of the pool.
+
+        :pool: the process pool to score the blocks with
+        """
+
+        from thePlayer.databaseMain import databaseMain
+
+        database: object = databaseMain(backend="pandas", rebuild=False)
+        graph: databaseGraph = databaseGraph()
+        size: int = len(database.index.primaryKeys)
+
+        # the most expensive blocks are handed out first, the cheap ones fill the gaps at the end.
+        tasks: List[Tuple[Tuple[Any, Any], np.ndarray]] = [
+            (block, references[start : start + graphTaskSize])
+            for block, references in database.index.groupByBlock(
+                np.arange(size)
+            ).items()
+            for start in range(0, len(references), graphTaskSize)
+        ]
+        tasks.sort(
+            key=lambda task: -len(task[1])
+            * len(database.index.candidatePositions(*task[0]))
+        )
+
+        batches: List[List[Tuple[Tuple[Any, Any], np.ndarray]]] = [
+            tasks[worker :: self.workers * 4] for worker in range(self.workers * 4)
+        ]
+
+        targets: np.ndarray = np.full((size, graph.k), -1, dtype=np.int32)
+        scores: np.ndarray = np.full((size, graph.k), np.nan, dtype=np.float32)
+
+        for results in pool.map(scoreGraphTask, [batch for batch in batches if batch]):
+            for references, blockTargets, blockScores in results:
+                targets[references] = blockTargets
+                scores[references] = blockScores
+
+        graph.save(targets, scores)
+
+        # perform logging operations
+        self.logger.info(f"buildGraph called - graph of {size} snippets written")
+
+
+if __name__ == "__main__":
+
+    # build all the artifacts of all the backends that are stale, run from the root of the repo with:
+    # python -m thePlayer.databaseBuild [--force]
+    logging.basicConfig(level=logging.INFO)
+    databaseBuild().build(None, force="--force" in sys.argv[1:])
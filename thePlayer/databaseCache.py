@@ -0,0 +1,126 @@
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+
+class databaseCache:
+    """
+    databaseCache is a bounded cache for the results of similarity queries, evicting the least recently
+    used entry once it is full. Gameplay keeps returning to the same states, and with that to the same
+    queries, which are then answered without scoring anything.
+
+    Results are stored as read-only numpy arrays, a caller can't change what is in the cache by
+    changing what it got back.
+
+    ...
+
+    Attributes
+    ----------
+    maxSize : int
+        the maximum number of entries, 0 disables the cache.
+
+    hits : int
+        number of lookups that were answered from the cache.
+
+    misses : int
+        number of lookups that weren't.
+
+    Methods
+    -------
+    get() :
+        returns the entry for a key and marks it as most recently used.
+
+    put() :
+        stores an entry, evicting the least recently used one if the cache is full.
+
+    clear() :
+        removes all entries, used when the database is reloaded.
+
+    info() :
+        returns the counters and size of the cache.
+
+    """
+
+    def __init__(self, maxSize: int) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.maxSize: int = maxSize
+        self.hits: int = 0
+        self.misses: int = 0
+
+        self.entries: OrderedDict = OrderedDict()
+        self.lock: Lock = Lock()
+
+    def get(self, key: Tuple[Any, ...]) -> Optional[Tuple[np.ndarray, ...]]:
+        """
+        :key: tuple with the arguments of the query
+        :return: the stored arrays, or None if the key isn't cached
+        """
+
+        with self.lock:
+            entry: Optional[Tuple[np.ndarray, ...]] = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+
+        return entry
+
+    def put(self, key: Tuple[Any, ...], *arrays: np.ndarray) -> Tuple[np.ndarray, ...]:
+        """
+        Stores read-only copies of the arrays under the key.
+
+        :key: tuple with the arguments of the query
+        :arrays: the result of the query
+        :return: the read-only arrays as they are stored
+        """
+
+        entry: List[np.ndarray] = []
+        for array in arrays:
+            array = np.array(array)
+            array.flags.writeable = False
+            entry.append(array)
+        entry: Tuple[np.ndarray, ...] = tuple(entry)
+
+        if self.maxSize <= 0:
+            return entry
+
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+        return entry
+
+    def clear(self) -> None:
+        """
+        Removes all entries and resets the counters.
+        """
+
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+        # perform logging operations
+        self.logger.info("cache cleared")
+
+    def info(self) -> Dict[str, int]:
+        """
+        :return: dict with the hits, misses, current size and maximum size of the cache
+        """
+
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.entries),
+                "maxSize": self.maxSize,
+            }
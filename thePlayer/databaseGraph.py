@@ -0,0 +1,307 @@
+import os
+import json
+import shutil
+import numpy as np
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from Settings.Settings import musicGraphURL, musicGraphNeighbours
+from thePlayer.databaseSnapshot import databaseSnapshot, snapshotTables
+from thePlayer.databaseScoring import defaultWeights
+
+
+class databaseGraph:
+    """
+    databaseGraph is the k-nearest transition graph of the snippet database. Without changes to tempo,
+    valence or arousal the similarity search only depends on the reference snippet, so the best
+    transition targets of every snippet can be computed offline. At runtime a default query is then
+    answered by reading one row of the graph.
+
+    The graph is stored as 2 compact arrays, with one row per snippet in the order of the (sorted)
+    snippet database: the row positions of the targets as int32, padded with -1, and their scores as
+    float32. A manifest records the .csv files, weights and number of neighbours it was built with.
+
+    ...
+
+    Attributes
+    ----------
+    targets : np.ndarray
+        (n_snippets x k) row positions of the best transition targets of every snippet, best first.
+
+    scores : np.ndarray
+        (n_snippets x k) similarity scores of those targets.
+
+    Methods
+    -------
+    build() :
+        scores every snippet against its candidates and writes the graph to disk.
+
+    update() :
+        adds snippets appended to the database to the graph.
+
+    scoreBlock() :
+        scores references against candidates and merges them into their targets.
+
+    save() :
+        writes the graph to disk.
+
+    load() :
+        memory maps the graph, if it is up to date.
+
+    isStale() :
+        checks whether the graph is missing or was built from other data.
+
+    neighbours() :
+        returns the targets and scores for a snippet.
+
+    """
+
+    def __init__(
+        self, graphURL: str = musicGraphURL, k: int = musicGraphNeighbours
+    ) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.graphURL: str = graphURL
+        self.manifestURL: str = os.path.join(graphURL, "manifest.json")
+        self.k: int = k
+
+        self.targets: Optional[np.ndarray] = None
+        self.scores: Optional[np.ndarray] = None
+
+    def build(self, database: object) -> None:
+        """
+        Runs the similarity search of databaseMain for every snippet at once. The snippets are grouped
+        by their candidate block, and every group is scored in chunks with scoreBatch.
+
+        :database: a loaded databaseMain object
+        """
+
+        index: object = database.index
+        size: int = len(index.primaryKeys)
+
+        targets: np.ndarray = np.full((size, self.k), -1, dtype=np.int32)
+        scores: np.ndarray = np.full((size, self.k), np.nan, dtype=np.float32)
+
+        for block, references in index.groupByBlock(np.arange(size)).items():
+            targets[references], scores[references] = self.scoreBlock(
+                database,
+                index.candidatePositions(*block),
+                references,
+                targets[references],
+                scores[references],
+            )
+
+        self.save(targets, scores)
+
+        # perform logging operations
+        self.logger.info(f"build called - graph of {size} snippets written")
+
+    def update(
+        self, database: object, start: int, added: Dict[Tuple[Any, Any], np.ndarray]
+    ) -> None:
+        """
+        Brings the graph up to date after snippets have been appended to the database. The new snippets
+        get a row of their own, scored against their whole candidate block. The current snippets of the
+        blocks that gained candidates are only scored against the new candidates, which are merged into
+        the targets they already have: a candidate that wasn't in the best k before can't be now.
+
+        :database: a loaded databaseMain object, with the new snippets added
+        :start: row position of the first new snippet
+        :added: dict from (Instrument, DominantNoteMean) to the new candidate positions in that block
+        """
+
+        index: object = database.index
+        size: int = len(index.primaryKeys)
+
+        targets: np.ndarray = np.full((size, self.k), -1, dtype=np.int32)
+        scores: np.ndarray = np.full((size, self.k), np.nan, dtype=np.float32)
+        targets[:start] = self.targets
+        scores[:start] = self.scores
+
+        for block, references in index.groupByBlock(np.arange(start, size)).items():
+            targets[references], scores[references] = self.scoreBlock(
+                database,
+                index.candidatePositions(*block),
+                references,
+                targets[references],
+                scores[references],
+            )
+
+        current: Dict[Tuple[Any, Any], np.ndarray] = index.groupByBlock(
+            np.arange(start)
+        )
+        for block, positions in added.items():
+            if block in current:
+                references: np.ndarray = current[block]
+                targets[references], scores[references] = self.scoreBlock(
+                    database,
+                    positions,
+                    references,
+                    targets[references],
+                    scores[references],
+                )
+
+        self.save(targets, scores)
+        self.load(size)
+
+        # perform logging operations
+        self.logger.info(
+            f"update called - {size - start} snippets added, {len(added)} blocks updated"
+        )
+
+    def scoreBlock(
+        self,
+        database: object,
+        positions: np.ndarray,
+        references: np.ndarray,
+        targets: np.ndarray,
+        scores: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Scores the references against candidates in chunks with scoreBatch, and merges the candidates
+        into the targets the references already have.
+
+        :database: a loaded databaseMain object
+        :positions: sorted row positions of the candidates, all higher than the current targets
+        :references: row positions of the reference snippets
+        :targets: (n_references x k) current targets of the references, -1 where there is none
+        :scores: (n_references x k) current scores of the references
+        :return: the targets and scores of the references with the candidates merged in
+        """
+
+        index: object = database.index
+        scoring: object = database.scoring
+
+        for chunk in range(0, len(references), 256):
+            chunkReferences: np.ndarray = references[chunk : chunk + 256]
+            chunkScores: np.ndarray = scoring.scoreBatch(
+                positions,
+                chunkReferences,
+                np.zeros((len(chunkReferences), 3), dtype=np.float32),
+                defaultWeights,
+            )
+
+            for row, reference in enumerate(chunkReferences, chunk):
+                # don't store transitions to the same piece
+                keep: np.ndarray = np.flatnonzero(
+                    index.primaryKeys[positions] != index.primaryKeys[reference]
+                )
+
+                # the current targets come first, they have the lower positions so ties still go to
+                # the lowest position.
+                found: np.ndarray = targets[row] >= 0
+                rowPositions: np.ndarray = np.concatenate(
+                    [targets[row][found], positions[keep]]
+                )
+                rowScores: np.ndarray = np.concatenate(
+                    [scores[row][found], chunkScores[row - chunk, keep]]
+                )
+                best: np.ndarray = scoring.selectTop(rowScores, self.k)
+
+                targets[row, : len(best)] = rowPositions[best]
+                scores[row, : len(best)] = rowScores[best]
+
+        return targets, scores
+
+    def save(self, targets: np.ndarray, scores: np.ndarray) -> None:
+        """
+        Writes the graph to disk. It is first written to a temporary directory and only swapped in once
+        complete.
+
+        :targets: (n_snippets x k) row positions of the targets
+        :scores: (n_snippets x k) scores of the targets
+        """
+
+        tmpURL: str = self.graphURL + ".tmp"
+        if os.path.isdir(tmpURL):
+            shutil.rmtree(tmpURL)
+        os.makedirs(tmpURL)
+
+        np.save(os.path.join(tmpURL, "targets.npy"), targets)
+        np.save(os.path.join(tmpURL, "scores.npy"), scores)
+        with open(os.path.join(tmpURL, "manifest.json"), "w") as f:
+            json.dump(self.stamp(len(targets)), f, indent=2)
+
+        if os.path.isdir(self.graphURL):
+            shutil.rmtree(self.graphURL)
+        os.replace(tmpURL, self.graphURL)
+
+    def load(self, size: int) -> bool:
+        """
+        Memory maps the graph, unless it is stale.
+
+        :size: number of snippets in the loaded snippet database
+        :return: True if the graph has been loaded
+        """
+
+        if self.isStale(size):
+            self.logger.warning(
+                "load called - transition graph missing or stale, using live scoring"
+            )
+            self.targets, self.scores = None, None
+            return False
+
+        self.targets = np.load(
+            os.path.join(self.graphURL, "targets.npy"), mmap_mode="r"
+        )
+        self.scores = np.load(os.path.join(self.graphURL, "scores.npy"), mmap_mode="r")
+
+        return True
+
+    def isStale(self, size: int) -> bool:
+        """
+        :size: number of snippets in the loaded snippet database
+        :return: True if there is no graph, or it was built from other data or settings
+        """
+
+        try:
+            with open(self.manifestURL) as f:
+                manifest: Dict[str, Any] = json.load(f)
+        except (OSError, ValueError):
+            return True
+
+        return manifest != self.stamp(size)
+
+    def stamp(self, size: int) -> Dict[str, Any]:
+        """
+        :size: number of snippets in the snippet database
+        :return: everything the content of the graph depends on
+        """
+
+        snapshot: object = databaseSnapshot()
+
+        return {
+            "rows": size,
+            "k": self.k,
+            "weights": list(defaultWeights),
+            "sources": [
+                (
+                    snapshot.sourceStamp(snapshotTables[table][0])
+                    if os.path.isfile(snapshotTables[table][0])
+                    else None
+                )
+                for table in ("snippets", "full")
+            ],
+        }
+
+    def neighbours(self, reference: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :reference: row position of the reference snippet
+        :return: the row positions and scores of its transition targets, best first
+        """
+
+        targets: np.ndarray = self.targets[reference]
+        found: np.ndarray = targets >= 0
+
+        return targets[found].astype(np.int64), self.scores[reference][found]
+
+
+if __name__ == "__main__":
+
+    # build the transition graph from the current database, run from the root of the repo with:
+    # python -m thePlayer.databaseGraph
+    from thePlayer.databaseMain import databaseMain
+
+    logging.basicConfig(level=logging.INFO)
+    databaseGraph().build(databaseMain(backend="pandas", rebuild=False))
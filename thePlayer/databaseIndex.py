@@ -0,0 +1,627 @@
+import re
+from bisect import bisect_left
+import numpy as np
+import pandas as pd
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from Settings.Settings import musicMoods
+from thePlayer.databaseSchema import databaseSchema
+
+# matches the numbers in the string representation of the notes column, as well as the ';' we
+# use to separate the rows when parsing the whole column at once.
+notesPattern: object = re.compile(r"-?\d+(?:\.\d*)?|;")
+
+
+class databaseIndex:
+    """
+    databaseIndex holds the structures that are derived from the music databases once, when they
+    are loaded, so the query methods in databaseMain don't have to recompute them for every lookup.
+
+    ...
+
+    Attributes
+    ----------
+    noteHistograms : np.ndarray
+        (n_snippets x 12) matrix counting how often each of the 12 pitch classes occurs in a snippet,
+        rows are in the same order as the snippet database.
+
+    secondaryKeys : np.ndarray
+        the SecondaryKeys of the snippets sorted, as int32 numbers when databaseSchema could encode
+        them. When the snippet database is sorted by them already this is its column itself.
+
+    secondaryKeyOrder : np.ndarray
+        the row position of every key in secondaryKeys, None when those are in row order.
+
+    fileNameHeap : np.ndarray
+        the FileNames of all the snippets as one utf-8 heap, in row order.
+
+    fileNameOffsets : np.ndarray
+        offset table of the heap, the FileNames of row i are fileNameHeap[fileNameOffsets[i]:fileNameOffsets[i + 1]].
+
+    fileNameOrder : np.ndarray
+        the row positions sorted by FileNames, to look a filename up with a binary search.
+
+    primaryKeyPositions : Dict
+        maps the PrimaryKey of every piece to its row position in the full database.
+
+    pieceOffsets : np.ndarray
+        offset table of the snippet database, which is sorted by piece and bar. The snippets of the
+        i-th piece are the rows pieceOffsets[i] up to pieceOffsets[i + 1].
+
+    pieceNumbers : Dict
+        maps the PrimaryKeys of every piece to its number in the offset table.
+
+    primaryKeys : np.ndarray
+        the PrimaryKeys column of the snippet database as an array.
+
+    thirdKeys : np.ndarray
+        the ThirdKey column of the snippet database as an array.
+
+    pieceRows : np.ndarray
+        the row of the piece in the full database for every snippet, -1 if the piece is unknown.
+
+    instruments : np.ndarray
+        the Instrument column of the full database as an array.
+
+    dominantNotes : np.ndarray
+        the DominantNoteMean column of the snippet database as an array.
+
+    moodRankings : Dict
+        maps every mood to the row positions of the snippets that can start playback in that mood,
+        from the highest mood score to the lowest.
+
+    candidateBlocks : Dict
+        maps every (Instrument, DominantNoteMean) pair to the row positions of the snippets that are
+        candidates for a similarity search, snippets without a valence value are left out.
+
+    Methods
+    -------
+    positionBySecondaryKey() :
+        binary search of the row position of a snippet by its secondary key.
+
+    positionByFileName() :
+        binary search of the row position of a snippet by its filename.
+
+    hasKey() :
+        checks whether a secondary key or filename is in the snippet database.
+
+    positionByPrimaryKey() :
+        O(1) lookup of the row position of a piece in the full database.
+
+    snippetRange() :
+        returns the range of rows that holds all the snippets of a piece.
+
+    snippetFileNames() :
+        returns the filenames of a range of rows.
+
+    fileNamesAt() :
+        returns the filenames of rows.
+
+    candidatePositions() :
+        O(1) lookup of the candidate rows for an instrument and a dominant note.
+
+    blockPositions() :
+        gathers the candidate rows of several instruments and dominant notes.
+
+    appendRows() :
+        adds snippets and pieces that come after all the current ones.
+
+    moodRanking() :
+        O(1) lookup of the ranked entry points for a mood.
+
+    buildMoodRanking() :
+        ranks the entry points for a mood.
+
+    groupByBlock() :
+        groups snippets by the instrument of their piece and their dominant note.
+
+    buildCandidateBlocks() :
+        partitions the candidate snippets by instrument and dominant note.
+
+    buildPieceRows() :
+        looks up the row of the piece in the full database for every snippet.
+
+    buildPieceOffsets() :
+        builds the offset table of the pieces in the snippet database.
+
+    buildPositions() :
+        builds a dict from key to row position for a column.
+
+    buildKeyLookup() :
+        sorts the secondary keys for the binary search.
+
+    buildFileNames() :
+        builds the heap, offsets and sort order of the filenames.
+
+    buildNoteHistograms() :
+        parses the full notes column into the histogram matrix in a single pass.
+
+    noteHistogram() :
+        parses the notes of a single snippet into a histogram.
+
+    """
+
+    def __init__(
+        self,
+        df_snippets: TypeVar("pd.DataFrame"),
+        df_full: TypeVar("pd.DataFrame"),
+        moods: object,
+    ) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.noteHistograms: np.ndarray = self.buildNoteHistograms(df_snippets["Notes"])
+
+        # the keys of every snippet are held once, the secondary keys as numbers and the filenames as
+        # one heap, rather than as a python string per row in a dict.
+        self.schema: object = databaseSchema()
+        self.secondaryKeys, self.secondaryKeyOrder = self.buildKeyLookup(
+            df_snippets["SecondaryKeys"].to_numpy()
+        )
+        self.fileNameHeap, self.fileNameOffsets, self.fileNameOrder = (
+            self.buildFileNames(df_snippets["FileNames"])
+        )
+        self.primaryKeyPositions: Dict[int, int] = self.buildPositions(
+            df_full["PrimaryKey"]
+        )
+
+        self.pieceOffsets, self.pieceNumbers = self.buildPieceOffsets(
+            df_snippets["PrimaryKeys"]
+        )
+
+        self.primaryKeys: np.ndarray = df_snippets["PrimaryKeys"].to_numpy()
+        self.thirdKeys: np.ndarray = df_snippets["ThirdKey"].to_numpy()
+        self.pieceRows: np.ndarray = self.buildPieceRows(df_snippets["PrimaryKeys"])
+        self.instruments: np.ndarray = df_full["Instrument"].to_numpy(dtype=object)
+        self.dominantNotes: np.ndarray = df_snippets["DominantNoteMean"].to_numpy()
+        self.candidateBlocks: Dict[Tuple[Any, Any], np.ndarray] = (
+            self.buildCandidateBlocks(df_snippets)
+        )
+
+        self.moodRankings: Dict[str, np.ndarray] = {
+            mood: self.buildMoodRanking(self.thirdKeys, *moods.moodScores(mood))
+            for mood in musicMoods
+            if mood in moods.entries
+        }
+
+        # perform logging operations
+        self.logger.info(f"database index built - snippets: {len(df_snippets)}")
+
+    def positionBySecondaryKey(self, secondaryKey: str) -> int:
+        """
+        :secondaryKey: string representing the SecondaryKeys entry in the snippet database
+        :return: row position of the snippet in the snippet database, raises a KeyError if unknown
+        """
+
+        key: Any = secondaryKey
+        if self.secondaryKeys.dtype != object:
+            key = self.schema.encodeSecondaryKey(secondaryKey)
+            if key is None:
+                raise KeyError(secondaryKey)
+
+        # of equal keys the first row comes first, the sort is stable.
+        found: int = int(np.searchsorted(self.secondaryKeys, key))
+
+        if found == len(self.secondaryKeys) or self.secondaryKeys[found] != key:
+            raise KeyError(secondaryKey)
+
+        return int(
+            found if self.secondaryKeyOrder is None else self.secondaryKeyOrder[found]
+        )
+
+    def positionByFileName(self, fileName: str) -> int:
+        """
+        :fileName: string representing the FileNames entry in the snippet database
+        :return: row position of the snippet in the snippet database, raises a KeyError if unknown
+        """
+
+        encoded: bytes = str(fileName).encode("utf-8")
+        found: int = bisect_left(self.fileNameOrder, encoded, key=self.fileNameBytes)
+
+        if found == len(self.fileNameOrder) or (
+            self.fileNameBytes(self.fileNameOrder[found]) != encoded
+        ):
+            raise KeyError(fileName)
+
+        return int(self.fileNameOrder[found])
+
+    def hasKey(self, column: str, key: Any) -> bool:
+        """
+        :column: 'SecondaryKeys' or 'FileNames'
+        :key: the key to look for
+        :return: True if a snippet has the key
+        """
+
+        try:
+            if column == "SecondaryKeys":
+                self.positionBySecondaryKey(key)
+            else:
+                self.positionByFileName(key)
+        except KeyError:
+            return False
+
+        return True
+
+    def positionByPrimaryKey(self, primaryKey: int) -> int:
+        """
+        :primaryKey: number representing the piece, as found in the PrimaryKey column of the full database
+        :return: row position of the piece in the full database, raises a KeyError if unknown
+        """
+        return self.primaryKeyPositions[primaryKey]
+
+    def snippetRange(self, primaryKey: int) -> Tuple[int, int]:
+        """
+        :primaryKey: number representing the piece, as found in the PrimaryKeys column of the snippet database
+        :return: start and end row of the snippets of the piece, raises a KeyError if unknown
+        """
+        number: int = self.pieceNumbers[primaryKey]
+
+        return int(self.pieceOffsets[number]), int(self.pieceOffsets[number + 1])
+
+    def snippetFileNames(self, start: int, end: int) -> np.ndarray:
+        """
+        :start: first row position
+        :end: row position after the last one
+        :return: object array with the FileNames of the rows in between
+        """
+        return self.fileNamesAt(np.arange(start, max(start, end)))
+
+    def fileNamesAt(self, positions: np.ndarray) -> np.ndarray:
+        """
+        :positions: row positions in the snippet database
+        :return: object array with the FileNames of the rows, decoded from the heap
+        """
+
+        fileNames: np.ndarray = np.empty(len(positions), dtype=object)
+        fileNames[:] = [
+            self.fileNameBytes(position).decode("utf-8")
+            for position in np.asarray(positions).tolist()
+        ]
+
+        return fileNames
+
+    def fileNameBytes(self, position: int) -> bytes:
+        """
+        :position: row position in the snippet database
+        :return: the utf-8 encoded FileNames of the row
+        """
+        return self.fileNameHeap[
+            self.fileNameOffsets[position] : self.fileNameOffsets[position + 1]
+        ].tobytes()
+
+    def candidatePositions(self, instrument: str, dominantNote: Any) -> np.ndarray:
+        """
+        :instrument: string representing the instrumentation, as found in the full database
+        :dominantNote: the DominantNoteMean value, as found in the snippet database
+        :return: sorted array with the row positions of the candidates, empty if there are none
+        """
+        return self.candidateBlocks.get(
+            (instrument, dominantNote), np.empty(0, dtype=np.int64)
+        )
+
+    def blockPositions(
+        self,
+        instruments: Optional[Set[str]] = None,
+        dominantNotes: Optional[Set[float]] = None,
+    ) -> np.ndarray:
+        """
+        Merges the candidate blocks of every (Instrument, DominantNoteMean) pair that matches, used when
+        the exact pair is too strict.
+
+        :instruments: the instruments to gather, None for all of them
+        :dominantNotes: the dominant notes to gather as numbers, None for all of them
+        :return: sorted array with the row positions of the candidates, empty if there are none
+        """
+
+        blocks: List[np.ndarray] = [
+            positions
+            for (instrument, dominantNote), positions in self.candidateBlocks.items()
+            if (instruments is None or instrument in instruments)
+            and (dominantNotes is None or float(dominantNote) in dominantNotes)
+        ]
+
+        if not blocks:
+            return np.empty(0, dtype=np.int64)
+
+        return np.sort(np.concatenate(blocks))
+
+    def appendRows(
+        self,
+        df_snippets: TypeVar("pd.DataFrame"),
+        df_full: TypeVar("pd.DataFrame"),
+        moods: object,
+    ) -> Dict[Tuple[Any, Any], np.ndarray]:
+        """
+        Adds new snippets and pieces to the index. The new snippets belong to new pieces with primary
+        keys above all the current ones, so they are appended after the current rows and none of the
+        existing row positions change. Only the candidate blocks the new snippets fall into and the
+        rankings of the moods they have a score for are touched.
+
+        :df_snippets: the new snippets, sorted by piece and bar
+        :df_full: the new pieces
+        :moods: the sparse mood scores, with the scores of the new snippets already added
+        :return: dict from (Instrument, DominantNoteMean) to the new candidate positions in that block
+        """
+
+        start: int = len(self.primaryKeys)
+        positions: np.ndarray = np.arange(start, start + len(df_snippets))
+
+        self.noteHistograms = np.concatenate(
+            [self.noteHistograms, self.buildNoteHistograms(df_snippets["Notes"])]
+        )
+
+        # keys that are already known keep pointing at their first row.
+        for key, position in self.buildPositions(df_full["PrimaryKey"]).items():
+            self.primaryKeyPositions.setdefault(key, position + len(self.instruments))
+
+        # the lookups are sorted again as a whole, the new keys can fall anywhere in between.
+        self.secondaryKeys, self.secondaryKeyOrder = self.buildKeyLookup(
+            np.concatenate(
+                [
+                    self.secondaryKeys[
+                        (
+                            np.argsort(self.secondaryKeyOrder, kind="stable")
+                            if self.secondaryKeyOrder is not None
+                            else slice(None)
+                        )
+                    ],
+                    df_snippets["SecondaryKeys"].to_numpy(),
+                ]
+            )
+        )
+
+        heap, offsets, _ = self.buildFileNames(df_snippets["FileNames"])
+        self.fileNameHeap = np.concatenate([self.fileNameHeap, heap])
+        self.fileNameOffsets = np.concatenate(
+            [self.fileNameOffsets[:-1], offsets + self.fileNameOffsets[-1]]
+        )
+        self.fileNameOrder = np.array(
+            sorted(range(len(self.fileNameOffsets) - 1), key=self.fileNameBytes),
+            dtype=np.int32,
+        )
+
+        pieceOffsets, pieceNumbers = self.buildPieceOffsets(df_snippets["PrimaryKeys"])
+        self.pieceNumbers.update(
+            {
+                key: number + len(self.pieceOffsets) - 1
+                for key, number in pieceNumbers.items()
+            }
+        )
+        self.pieceOffsets = np.concatenate(
+            [self.pieceOffsets[:-1], pieceOffsets + start]
+        )
+
+        self.primaryKeys = np.concatenate(
+            [self.primaryKeys, df_snippets["PrimaryKeys"].to_numpy()]
+        )
+        self.thirdKeys = np.concatenate(
+            [self.thirdKeys, df_snippets["ThirdKey"].to_numpy()]
+        )
+        self.instruments = np.concatenate(
+            [self.instruments, df_full["Instrument"].to_numpy(dtype=object)]
+        )
+        self.pieceRows = np.concatenate(
+            [self.pieceRows, self.buildPieceRows(df_snippets["PrimaryKeys"])]
+        )
+        self.dominantNotes = np.concatenate(
+            [self.dominantNotes, df_snippets["DominantNoteMean"].to_numpy()]
+        )
+
+        # the new positions are higher than all the current ones, so the blocks stay sorted.
+        added: Dict[Tuple[Any, Any], np.ndarray] = self.groupByBlock(
+            positions[df_snippets["Valence"].notna().to_numpy()]
+        )
+        for block, blockPositions in added.items():
+            self.candidateBlocks[block] = np.concatenate(
+                [
+                    self.candidateBlocks.get(block, np.empty(0, dtype=np.int64)),
+                    blockPositions,
+                ]
+            )
+
+        # only the ranked moods the new snippets have a score for are ranked again.
+        for mood in list(self.moodRankings):
+            rows, scores = moods.moodScores(mood)
+            if len(rows) and rows[-1] >= start:
+                self.moodRankings[mood] = self.buildMoodRanking(
+                    self.thirdKeys, rows, scores
+                )
+
+        # perform logging operations
+        self.logger.info(
+            f"appendRows called - snippets: {len(df_snippets)}, pieces: {len(df_full)}, blocks: {len(added)}"
+        )
+
+        return added
+
+    def moodRanking(self, mood: str) -> np.ndarray:
+        """
+        :mood: string representing the mood
+        :return: row positions of the entry points for the mood, best first. Raises a KeyError if the
+            mood has not been ranked.
+        """
+        return self.moodRankings[mood]
+
+    def buildMoodRanking(
+        self, thirdKeys: np.ndarray, rows: np.ndarray, scores: np.ndarray
+    ) -> np.ndarray:
+        """
+        Playback is started from one of the first bars of a piece (ThirdKey < 25) that has a score for
+        the mood. These are sorted once, from the highest score to the lowest. Only the snippets that
+        have a score are looked at.
+
+        :thirdKeys: the ThirdKey column of the snippet database
+        :rows: row positions of the snippets with a score for the mood, ascending, as kept by databaseMoods
+        :scores: the scores of those snippets
+        :return: row positions of the entry points for the mood, best first
+        """
+
+        start: np.ndarray = thirdKeys[rows] < 25
+        entryPoints: np.ndarray = rows[start].astype(np.int64)
+
+        return entryPoints[np.argsort(-scores[start], kind="stable")]
+
+    def groupByBlock(self, positions: np.ndarray) -> Dict[Tuple[Any, Any], np.ndarray]:
+        """
+        Groups snippets by the (Instrument, DominantNoteMean) pair of their piece. Snippets whose
+        piece is unknown, or that lack one of the 2 values, are left out.
+
+        :positions: row positions of the snippets to group
+        :return: dict from (Instrument, DominantNoteMean) to the row positions in that group
+        """
+
+        positions = positions[self.pieceRows[positions] >= 0]
+
+        groups: Dict[Tuple[Any, Any], np.ndarray] = (
+            pd.DataFrame(
+                {
+                    "Instrument": self.instruments[self.pieceRows[positions]],
+                    "DominantNoteMean": self.dominantNotes[positions],
+                }
+            )
+            .groupby(["Instrument", "DominantNoteMean"])
+            .indices
+        )
+
+        return {key: positions[rows] for key, rows in groups.items()}
+
+    def buildCandidateBlocks(
+        self, df_snippets: TypeVar("pd.DataFrame")
+    ) -> Dict[Tuple[Any, Any], np.ndarray]:
+        """
+        Snippets without a valence value are never a match and are left out before grouping.
+
+        :df_snippets: the snippet database
+        :return: dict from (Instrument, DominantNoteMean) to the row positions of the candidates
+        """
+
+        return self.groupByBlock(
+            np.flatnonzero(df_snippets["Valence"].notna().to_numpy())
+        )
+
+    def buildPieceRows(self, primaryKeys: TypeVar("pd.Series")) -> np.ndarray:
+        """
+        The instrumentation is only stored in the full database, so for every snippet we look up the
+        row of its piece there.
+
+        :primaryKeys: the PrimaryKeys column of the snippet database
+        :return: array with the row in the full database for every snippet, -1 if the piece is unknown
+        """
+
+        return np.array(
+            [self.primaryKeyPositions.get(key, -1) for key in primaryKeys.tolist()],
+            dtype=np.int64,
+        )
+
+    def buildPieceOffsets(
+        self, primaryKeys: TypeVar("pd.Series")
+    ) -> Tuple[np.ndarray, Dict[Any, int]]:
+        """
+        The snippet database is sorted by piece, so a piece starts at every row where the primary key
+        differs from the one before it.
+
+        :primaryKeys: the PrimaryKeys column of the sorted snippet database
+        :return: the offset table and a dict from primary key to piece number
+        """
+
+        keys: np.ndarray = primaryKeys.to_numpy()
+        starts: np.ndarray = np.flatnonzero(
+            np.r_[True, keys[1:] != keys[:-1]][: len(keys)]
+        )
+
+        pieceOffsets: np.ndarray = np.append(starts, len(keys)).astype(np.int64)
+        pieceNumbers: Dict[Any, int] = {
+            key: number for number, key in enumerate(keys[starts].tolist())
+        }
+
+        return pieceOffsets, pieceNumbers
+
+    def buildPositions(self, keys: TypeVar("pd.Series")) -> Dict[Any, int]:
+        """
+        Builds a dict from every key in a column to its row position. When a key occurs more than
+        once the first row wins, the same row the boolean masks used to return with '.values[0]'.
+
+        :keys: column of the database to index
+        :return: dict from key to row position
+        """
+
+        keys: List[Any] = keys.tolist()
+
+        return dict(zip(reversed(keys), range(len(keys) - 1, -1, -1)))
+
+    def buildKeyLookup(
+        self, keys: np.ndarray
+    ) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """
+        :keys: the SecondaryKeys of the snippets in row order, encoded or as text
+        :return: the keys sorted and the row position of every sorted key. The snippets are sorted by
+            piece and bar and so are the encoded keys, then the keys are returned as they are and the
+            positions as None.
+        """
+
+        if keys.dtype != object and np.all(keys[1:] >= keys[:-1]):
+            return keys, None
+
+        order: np.ndarray = np.argsort(keys, kind="stable")
+
+        return keys[order], order.astype(np.int32)
+
+    def buildFileNames(
+        self, fileNames: TypeVar("pd.Series")
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :fileNames: the FileNames column of the snippet database
+        :return: the names as one utf-8 heap, the offsets of every row in it and the row positions
+            sorted by name
+        """
+
+        encoded: List[bytes] = [
+            str(fileName).encode("utf-8") for fileName in fileNames.tolist()
+        ]
+
+        offsets: np.ndarray = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(fileName) for fileName in encoded], out=offsets[1:])
+
+        # sorted is stable, of equal names the first row comes first.
+        order: np.ndarray = np.array(
+            sorted(range(len(encoded)), key=encoded.__getitem__), dtype=np.int32
+        )
+
+        return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets, order
+
+    def buildNoteHistograms(self, notes: TypeVar("pd.Series")) -> np.ndarray:
+        """
+        Notes are stored in the .csv as the string representation of a list of pitch classes. Rather
+        than running ast.literal_eval on every row, all rows are joined and tokenized by one regular
+        expression, and the tokens are counted per row with a single bincount.
+
+        :notes: the Notes column of the snippet database
+        :return: (n_snippets x 12) int32 matrix of pitch class counts
+        """
+
+        tokens: List[str] = notesPattern.findall(";".join(notes.fillna("").astype(str)))
+        tokens: np.ndarray = np.array(tokens, dtype=object)
+
+        # every separator moves us on to the next row.
+        separators: np.ndarray = tokens == ";"
+        rows: np.ndarray = np.cumsum(separators)[~separators]
+        pitches: np.ndarray = tokens[~separators].astype(float).astype(np.int64) % 12
+
+        histograms: np.ndarray = np.bincount(
+            rows * 12 + pitches, minlength=len(notes) * 12
+        )
+
+        return histograms.reshape(len(notes), 12).astype(np.int32)
+
+    def noteHistogram(self, notes: str) -> np.ndarray:
+        """
+        Parses the notes of a single snippet.
+
+        :notes: string representation of the notes, as found in the Notes column
+        :return: array of 12 pitch class counts
+        """
+
+        pitches: List[int] = [int(float(x)) % 12 for x in notesPattern.findall(notes)]
+
+        return np.bincount(pitches, minlength=12).astype(np.int32)
@@ -0,0 +1,247 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from thePlayer.databaseMain import databaseMain, queryColumns
+from thePlayer.databaseSchema import databaseSchema
+from thePlayer.databaseSnapshot import snapshotTables
+from thePlayer.databaseProjection import databaseProjection
+
+
+class databaseIngest:
+    """
+    databaseIngest adds newly analyzed pieces to a loaded music database without rebuilding it. The new
+    snippets and pieces are appended to the .csv files, and the snapshot, the tables in memory, the
+    sparse mood scores, the database index, the scoring features and the transition graph are updated
+    for the new rows only. The nearest-neighbour index is left to be rebuilt.
+
+    New pieces must have primary keys above all the current ones. The snippet database is sorted by
+    piece, so the new snippets then come after all the current rows and no row position changes, which
+    is what lets every structure be extended rather than rebuilt.
+
+    ...
+
+    Attributes
+    ----------
+    database : databaseMain
+        the loaded database the pieces are added to, it has to use the pandas backend.
+
+    Methods
+    -------
+    ingest() :
+        adds new snippets and pieces to the database.
+
+    prepare() :
+        checks the new rows and brings them in the layout of the .csv files.
+
+    appendSources() :
+        appends the new rows to the .csv files.
+
+    appendTables() :
+        appends the new rows to the tables that are held in memory.
+
+    """
+
+    def __init__(self, database: object) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.database: object = database
+
+    def ingest(
+        self, df_snippets: TypeVar("pd.DataFrame"), df_full: TypeVar("pd.DataFrame")
+    ) -> int:
+        """
+        :df_snippets: the snippets of the new pieces, with the columns of the snippet .csv file
+        :df_full: the new pieces, with the columns of the full .csv file
+        :return: the number of snippets that were added
+        """
+
+        database: object = self.database
+
+        # the SQLite file and the shared segment are built from the pandas backend, they pick up the
+        # new pieces when they are rebuilt.
+        if database.store is not None:
+            raise ValueError(
+                f"ingest called - pieces can only be added with the pandas backend, not {database.backend}"
+            )
+
+        df_snippets, df_full = self.prepare(df_snippets, df_full)
+        start: int = len(database.index.primaryKeys)
+
+        # the .csv files stay the source of the database, the new rows are written there first.
+        self.appendSources(df_snippets, df_full)
+
+        # a stale snapshot isn't used, it is left for a full rebuild.
+        if database.useSnapshot:
+            database.snapshot.appendRows("snippets", df_snippets)
+            database.snapshot.appendRows("full", df_full)
+
+        snippets: TypeVar("pd.DataFrame") = databaseSchema().apply(
+            "snippets", df_snippets
+        )
+        full: TypeVar("pd.DataFrame") = databaseSchema().apply("full", df_full)
+
+        self.appendTables({"snippets": snippets, "full": full})
+        database.moods.appendRows(snippets)
+        added: Dict[Tuple[Any, Any], np.ndarray] = database.index.appendRows(
+            snippets, full, database.moods
+        )
+        database.scoring.appendRows(snippets, database.index.noteHistograms)
+        database.recency.resize()
+
+        if database.graph.targets is not None:
+            database.graph.update(database, start, added)
+        else:
+            self.logger.warning(
+                "ingest called - no up to date transition graph to update, rebuild it with 'python -m thePlayer.databaseGraph'"
+            )
+
+        # the nearest-neighbour index doesn't know about the new pieces either, searches look through
+        # the whole catalog until it is rebuilt.
+        database.ann.load(len(database.index.primaryKeys))
+
+        # the projection may have coordinates for the new snippets as well, the grid is built again and
+        # loaded by the next directional search.
+        if os.path.isfile(database.projection.sourceURL):
+            databaseProjection().build(database)
+        database.projection.unload()
+
+        # cached results don't know about the new pieces.
+        database.cache.clear()
+
+        # perform logging operations
+        self.logger.info(
+            f"ingest called - pieces: {len(df_full)}, snippets: {len(df_snippets)}"
+        )
+
+        return len(df_snippets)
+
+    def prepare(
+        self, df_snippets: TypeVar("pd.DataFrame"), df_full: TypeVar("pd.DataFrame")
+    ) -> Tuple[TypeVar("pd.DataFrame"), TypeVar("pd.DataFrame")]:
+        """
+        Checks that the new rows can be appended and puts them in the layout of the .csv files: the
+        columns in the same order, missing columns empty, the snippets sorted by piece and bar and with
+        index labels after the current ones.
+
+        :df_snippets: the snippets of the new pieces
+        :df_full: the new pieces
+        :return: the snippets and the pieces, ready to be appended
+        """
+
+        database: object = self.database
+        index: object = database.index
+        frames: Dict[str, TypeVar("pd.DataFrame")] = {}
+
+        for table, frame in (("snippets", df_snippets), ("full", df_full)):
+            columns: List[str] = database.snapshot.tableColumns(
+                table, fromSnapshot=False
+            )
+
+            unknown: List[str] = [
+                column for column in frame.columns if column not in columns
+            ]
+            missing: List[str] = [
+                column for column in queryColumns[table] if column not in frame.columns
+            ]
+            if unknown or missing:
+                raise ValueError(
+                    f"prepare called - {table} has unknown columns {unknown} or lacks columns {missing}"
+                )
+
+            frames[table] = frame.reindex(columns=columns)
+
+        snippetKeys: Set[Any] = set(frames["snippets"]["PrimaryKeys"].tolist())
+        pieceKeys: List[Any] = frames["full"]["PrimaryKey"].tolist()
+
+        if snippetKeys and min(snippetKeys) <= index.primaryKeys.max(initial=-1):
+            raise ValueError(
+                "prepare called - new pieces need primary keys above the current ones"
+            )
+        if any(key in index.primaryKeyPositions for key in pieceKeys) or len(
+            set(pieceKeys)
+        ) < len(pieceKeys):
+            raise ValueError("prepare called - pieces are already in the database")
+
+        for column in ("SecondaryKeys", "FileNames"):
+            keys: TypeVar("pd.Series") = frames["snippets"][column]
+            if keys.duplicated().any() or any(
+                index.hasKey(column, key) for key in keys.tolist()
+            ):
+                raise ValueError(
+                    f"prepare called - snippets with {column} already in the database"
+                )
+
+        # the secondary keys of the database are stored as numbers, new ones that can't be encoded
+        # wouldn't fit in between.
+        if index.secondaryKeys.dtype != object and (
+            databaseSchema().encodeSecondaryKeys(frames["snippets"]["SecondaryKeys"])
+            is None
+        ):
+            raise ValueError(
+                "prepare called - SecondaryKeys have to be '<PrimaryKeys>_<bar>', with the bar as 4 digits"
+            )
+
+        snippets: TypeVar("pd.DataFrame") = database.sortSnippets(frames["snippets"])
+        snippets.index = pd.RangeIndex(
+            database.df_snippets.index.max() + 1,
+            database.df_snippets.index.max() + 1 + len(snippets),
+            name=database.df_snippets.index.name,
+        )
+
+        full: TypeVar("pd.DataFrame") = frames["full"]
+        full.index = pd.RangeIndex(
+            len(index.instruments), len(index.instruments) + len(full)
+        )
+
+        return snippets, full
+
+    def appendSources(
+        self, df_snippets: TypeVar("pd.DataFrame"), df_full: TypeVar("pd.DataFrame")
+    ) -> None:
+        """
+        :df_snippets: the new snippets, as returned by prepare()
+        :df_full: the new pieces, as returned by prepare()
+        """
+
+        for table, frame in (("snippets", df_snippets), ("full", df_full)):
+            sourceURL, kwargs = snapshotTables[table]
+
+            frame.to_csv(sourceURL, mode="a", header=False, index="index_col" in kwargs)
+
+    def appendTables(self, frames: Dict[str, TypeVar("pd.DataFrame")]) -> None:
+        """
+        Appends the new rows to the tables that have been read, with the columns that have been read of
+        them. Tables that haven't been read yet are read with the new rows later on.
+
+        :frames: dict from the name of the table to its new rows, cast to the schema
+        """
+
+        for name, frame in frames.items():
+            table: Optional[TypeVar("pd.DataFrame")] = self.database.tables.get(name)
+
+            if table is None:
+                continue
+
+            # categoricals with different categories are concatenated as objects, the schema casts
+            # them back.
+            self.database.tables[name] = databaseSchema().apply(
+                name, pd.concat([table, frame[table.columns]])
+            )
+
+
+if __name__ == "__main__":
+
+    # add new pieces to the database, run from the root of the repo with:
+    # python -m thePlayer.databaseIngest <snippets .csv> <pieces .csv>
+    # both files have the layout of the .csv files in theDB/.
+    logging.basicConfig(level=logging.INFO)
+
+    databaseIngest(databaseMain(backend="pandas")).ingest(
+        pd.read_csv(sys.argv[1], **snapshotTables["snippets"][1]),
+        pd.read_csv(sys.argv[2], **snapshotTables["full"][1]),
+    )
@@ -1,6 +1,9 @@
+import os
+import sys
+import time
+from threading import RLock
+from concurrent.futures import Executor, ThreadPoolExecutor
 import pandas as pd
-import ast
-from collections import Counter
 import numpy as np
 from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
 import logging
@@ -12,7 +15,70 @@ from Settings.Settings import (
     musicMoodsDataBaseURL,
     musicSnippetsDataBaseTagsURL,
     shutterSpeed,
+    musicQueryCacheSize,
+    musicQueryCacheDepth,
+    musicMoodEntryPoints,
+    musicMoods,
+    musicSearchBudget,
+    musicSearchChunk,
+    musicDatabaseBackend,
+    musicANNProbes,
+    musicProjectionAngle,
+    musicQueryWorkers,
 )
+from thePlayer.databaseSnapshot import databaseSnapshot
+from thePlayer.databaseIndex import databaseIndex
+from thePlayer.databaseScoring import databaseScoring, defaultWeights
+from thePlayer.databaseGraph import databaseGraph
+from thePlayer.databaseCache import databaseCache
+from thePlayer.databaseMoods import databaseMoods
+from thePlayer.databaseRecency import databaseRecency
+from thePlayer.databaseSQLite import databaseSQLite
+from thePlayer.databaseSQLiteIndex import databaseSQLiteIndex
+from thePlayer.databaseShared import databaseShared
+from thePlayer.databaseSharedIndex import databaseSharedIndex
+from thePlayer.databaseBuild import databaseBuild
+from thePlayer.databaseANN import databaseANN
+from thePlayer.databaseProjection import databaseProjection
+from thePlayer.databaseTimings import databaseTimings
+from thePlayer.databaseSchema import secondaryKeyBase
+
+# the levels findRelaxedPiece goes through, from the strict filters of findSimilarPiece to any snippet
+# that has a score for the mood.
+relaxationLevels: List[str] = ["strict", "relatedKeys", "anyInstrument", "moodOnly"]
+
+# the keys that are related to the dominant note of a snippet, in semitones: the note itself, its fourth
+# and its fifth.
+relatedIntervals: List[int] = [0, 5, 7]
+
+# the columns the query paths of this class read from every table. Only these are loaded when a table
+# is first accessed, None loads the whole table. Other columns are loaded on request with table().
+# The mood columns are kept out of the snippet table, they are stored sparsely by databaseMoods.
+queryColumns: Dict[str, Optional[List[str]]] = {
+    "snippets": [
+        "FileNames",
+        "PrimaryKeys",
+        "SecondaryKeys",
+        "ThirdKey",
+        "TotalSnippets",
+        "Duration",
+        "NoisinessMedian",
+        "TempoMean",
+        "DensityNotes",
+        "Notes",
+        "UniqueNotes",
+        "DominantNoteMean",
+        "Valence",
+        "Arousal",
+    ],
+    "full": ["PrimaryKey", "Instrument"],
+    "moods": None,
+}
+
+
+# the columns of the snippet table that the database index holds once it has been built. They are
+# dropped from the table and put back into the rows snippetRows() returns.
+indexedColumns: List[str] = ["FileNames"]
 
 
 class databaseMain:
@@ -32,11 +98,104 @@ class databaseMain:
 
     Methods
     -------
+    loadDatabases() :
+        Loads the databases from the binary snapshot, or from the .csv files if the snapshot is out of date.
+
+    table() :
+        Returns a table of the database, loading it or some of its columns on first access.
+
+    readTable() :
+        Reads columns of a table from the snapshot or the .csv file.
+
+    sourceColumns() :
+        Returns the names of all the columns a table has on disk.
+
+    loadMoods() :
+        Reads mood columns of the snippet database into the sparse mood store.
+
+    moodScores() :
+        Returns the snippets that have a score for a mood, and those scores.
+
+    snippetRows() :
+        Returns rows of the snippet database by position, from either backend.
+
+    sortSnippets() :
+        Sorts the snippets by piece and bar number.
+
     findPieceByMood() :
         Takes in a mood and return a matching piece that can be played from the start.
 
+    samplePieceByMood() :
+        Picks one of the pieces matching a mood at random.
+
     findSimilarPiece() :
-        Takes in a piece of music and looks up close musical matches.
+        Takes in a piece of music and looks up close musical matches, keeping the reference for matchCounters().
+
+    querySimilarPiece() :
+        Thread-safe version of findSimilarPiece that keeps no state of the query on the object.
+
+    querySimilarPieces() :
+        Runs several thread-safe lookups at the same time on a pool of threads.
+
+    findNearestPiece() :
+        Searches the whole catalog for the closest matches, with weights of its own.
+
+    findDirectionalPiece() :
+        Moves from a snippet in a direction of the UMAP projection.
+
+    findRelaxedPiece() :
+        Looks up close musical matches, relaxing the filters until there are some or time runs out.
+
+    findSimilarPieceByMoods() :
+        Looks up close musical matches for a list of moods, scoring the candidates only once.
+
+    findSimilarPieces() :
+        Looks up close musical matches for a batch of pieces, moods and changes at once.
+
+    cachedMatches() :
+        Finds the best matches for a reference snippet, from the query cache if they are in it.
+
+    recentMatches() :
+        Applies the penalties of the recently played pieces to cached matches.
+
+    penalizeMatches() :
+        Re-ranks cached matches with penalties, if that gives the same matches as scoring again.
+
+    matchKey() :
+        Returns the key the matches of a query are cached under.
+
+    matchReference() :
+        Finds the best matches for a reference snippet as they are cached.
+
+    rankReference() :
+        Scores candidates against a reference snippet and keeps the best, with a bound on the others.
+
+    scoreReference() :
+        Scores candidates against a reference snippet and keeps the best.
+
+    scoreReferenceUntil() :
+        Scores a large set of candidates in chunks for as long as a deadline allows.
+
+    nearestCandidates() :
+        Selects the snippets findNearestPiece scores.
+
+    candidates() :
+        Selects the snippets that can follow a reference snippet.
+
+    memoryReport() :
+        Breaks down the memory held by the databases per column.
+
+    markPlayed() :
+        Registers that a piece has been played, so it isn't repeated right away.
+
+    cacheInfo() :
+        Returns the hit and miss counters of the query cache.
+
+    timingReport() :
+        Returns the percentiles of the time and the rows of every stage of the similarity queries.
+
+    slowestQueries() :
+        Returns the slowest of the last similarity queries, per stage.
 
     gatherMoods() :
         Gathers moods from similar pieces.
@@ -51,40 +210,415 @@ class databaseMain:
         Gather relevant data for a given piece
 
     matchCounters() :
-        RegEx voodoo, yes it was aweful to write
+        Counts the notes a snippet has in common with the reference piece.
+
+    commonNotes() :
+        Thread-safe version of matchCounters that takes the reference piece as an argument.
 
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self, backend: str = musicDatabaseBackend, rebuild: bool = False
+    ) -> None:
         # initialize logger
         self.logger: object = logging.getLogger(__name__)
         self.logger.info("database main initialized")
 
+        # "pandas" holds the tables in memory, "sqlite" reads rows from theDB/music.sqlite on demand and
+        # "shared" memory maps the segment in theDB/shared that other processes map as well.
+        self.backend: str = backend
+
+        # artifacts that weren't built from the current .csv files are only built again before loading
+        # when asked for, building them takes all the cores for a while. Otherwise they are built with
+        # 'python -m thePlayer.databaseBuild'.
+        self.rebuild: bool = rebuild
+
         self.referencePiece: Dict[str, Union[str, int]] = {}
 
-        self.df_snippets: TypeVar("pd.DataFrame") = pd.read_csv(
-            musicSnippetsDataBaseTagsURL, index_col=0
+        # guards the tables and moods that are loaded on first access, so lookups can run from several
+        # threads at the same time.
+        self.lock: RLock = RLock()
+
+        # results of similarity queries, emptied whenever the databases are (re)loaded.
+        self.cache: object = databaseCache(musicQueryCacheSize)
+
+        # wall time and row counts of every stage of the last similarity queries.
+        self.timings: object = databaseTimings()
+
+        self.loadDatabases()
+
+    def loadDatabases(self) -> None:
+        """
+        Loads the snippet, full and mood databases. When the binary snapshot in theDB/ is up to date it
+        is read from there, which is almost instant. Otherwise we fall back on parsing the .csv files,
+        the snapshot can be rebuilt with 'python -m thePlayer.databaseSnapshot'.
+
+        All the artifacts the backend uses are first checked against the content hashes of the .csv
+        files. With rebuild turned on the stale ones are built again with databaseBuild, otherwise they
+        are only reported. An artifact built from other data is never used, the fallbacks below are.
+
+        With the sqlite backend only the numeric features are read into memory, from the SQLite file
+        that is built with 'python -m thePlayer.databaseSQLite'. If that file is out of date the
+        pandas backend is used instead.
+
+        With the shared backend the arrays and indexes are memory mapped read-only from the segment
+        published with 'python -m thePlayer.databaseShared', so processes that run side by side share
+        them. If the segment is out of date this process publishes it first.
+        """
+
+        if self.rebuild:
+            databaseBuild().build(self.backend)
+        else:
+            stale: List[str] = databaseBuild().staleArtifacts(self.backend)
+
+            # perform logging operations
+            if stale:
+                self.logger.warning(
+                    f"loadDatabases called - stale artifacts {stale}, build them with 'python -m thePlayer.databaseBuild'"
+                )
+
+        self.store: Optional[object] = None
+
+        if self.backend == "sqlite":
+            store: object = databaseSQLite()
+
+            if store.isStale():
+                self.logger.warning(
+                    "loadDatabases called - SQLite database missing or stale, using pandas"
+                )
+            else:
+                store.connect()
+                self.store = store
+
+        if self.backend == "shared":
+            store: object = databaseShared()
+
+            if store.isStale():
+                self.logger.warning(
+                    "loadDatabases called - shared segment missing or stale, publishing it"
+                )
+                store.publish(databaseMain(backend="pandas", rebuild=False))
+
+            store.attach()
+            self.store = store
+
+        self.snapshot: object = databaseSnapshot()
+        self.useSnapshot: bool = not self.snapshot.isStale()
+
+        if not self.useSnapshot:
+            self.logger.warning(
+                "loadDatabases called - snapshot missing or stale, reading .csv files"
+            )
+
+        # tables are only read when they are first accessed, see table().
+        self.tables: Dict[str, TypeVar("pd.DataFrame")] = {}
+        self.tableSources: Dict[str, List[str]] = {}
+
+        if self.store is not None:
+            features, noteHistograms = self.store.features()
+
+            self.moods: object = databaseMoods(len(noteHistograms))
+            self.loadMoods(musicMoods)
+
+            if self.backend == "shared":
+                self.index: object = databaseSharedIndex(self.store)
+            else:
+                self.index: object = databaseSQLiteIndex(
+                    self.store, features, noteHistograms, self.moods
+                )
+            self.scoring: object = databaseScoring(features, noteHistograms)
+        else:
+            # the mood scores are mostly missing, only the snippets that have one are kept.
+            self.moods: object = databaseMoods(len(self.df_snippets))
+            self.loadMoods(musicMoods)
+
+            # structures derived from the databases, built once here rather than on every query.
+            self.index: object = databaseIndex(
+                self.df_snippets, self.df_full, self.moods
+            )
+            self.scoring: object = databaseScoring(
+                self.df_snippets, self.index.noteHistograms
+            )
+
+            # the filenames are held by the index from here on, where they were and the dtype text was
+            # read as are remembered to put them back the same way.
+            snippets: TypeVar("pd.DataFrame") = self.tables["snippets"]
+            self.indexedAt: Dict[str, int] = {
+                column: snippets.columns.get_loc(column) for column in indexedColumns
+            }
+            self.textDtype: object = snippets["FileNames"].dtype
+            self.tables["snippets"] = snippets.drop(columns=indexedColumns)
+
+        # the pieces played recently are penalized by the scoring pass, this is state of the process
+        # itself and never part of the shared segment.
+        self.recency: object = databaseRecency(self.index)
+
+        # the precomputed transition graph answers queries without changes, if it is up to date.
+        self.graph: object = databaseGraph()
+        self.graph.load(len(self.index.primaryKeys))
+
+        # the nearest-neighbour index searches the whole catalog, if it is up to date.
+        self.ann: object = databaseANN()
+        self.ann.load(len(self.index.primaryKeys))
+
+        # the UMAP projection lets the search move in a direction, if there are coordinates for it. The
+        # grid is loaded by the first directional search.
+        self.projection: object = databaseProjection()
+
+        # cached results refer to rows of the databases we just replaced.
+        self.cache.clear()
+
+        # perform logging operations
+        self.logger.info(
+            f"loadDatabases called - backend: {self.backend if self.store else 'pandas'}, snippets: {len(self.index.primaryKeys)}, pieces: {len(self.index.instruments)}"
+        )
+
+    @property
+    def df_snippets(self) -> TypeVar("pd.DataFrame"):
+        return self.table("snippets")
+
+    @property
+    def df_full(self) -> TypeVar("pd.DataFrame"):
+        return self.table("full")
+
+    @property
+    def df_moods(self) -> TypeVar("pd.DataFrame"):
+        return self.table("moods")
+
+    def table(
+        self, name: str, columns: Optional[List[str]] = None
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        Returns a table of the database. The first time it is accessed only the columns in queryColumns
+        are read, columns asked for later on are read then and added to the table.
+
+        :name: name of the table, one of 'snippets', 'full' or 'moods'
+        :columns: columns that have to be in the table on top of queryColumns, None for just those.
+            Columns the table doesn't have are left out.
+        :return: the table as a dataframe
+        """
+
+        with self.lock:
+            wanted: Optional[List[str]] = queryColumns[name]
+            if columns is not None:
+                wanted = None if wanted is None else wanted + list(columns)
+
+            frame: Optional[TypeVar("pd.DataFrame")] = self.tables.get(name)
+
+            if frame is None:
+                frame = self.readTable(name, wanted)
+
+                if name == "snippets":
+                    frame = self.sortSnippets(frame)
+
+                self.tables[name] = frame
+                return frame
+
+            if columns is None:
+                return frame
+
+            # columns the table doesn't have are skipped rather than read again on every call, as are
+            # the columns the index holds.
+            missing: List[str] = [
+                column
+                for column in (self.sourceColumns(name) if wanted is None else columns)
+                if column not in frame.columns
+                and column in self.sourceColumns(name)
+                and not (name == "snippets" and column in indexedColumns)
+            ]
+
+            if missing:
+                # the index of every table is unique, so the new columns line up with the rows by label
+                # even after the snippets have been sorted.
+                frame = frame.join(self.readTable(name, missing))
+                self.tables[name] = frame
+
+            return frame
+
+    def readTable(
+        self, name: str, columns: Optional[List[str]]
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        :name: name of the table, one of 'snippets', 'full' or 'moods'
+        :columns: columns to read, None reads all of them
+        :return: the columns as a dataframe, from the snapshot if it is up to date
+        """
+
+        # perform logging operations
+        self.logger.info(f"readTable called - table: {name}, columns: {columns}")
+
+        if self.useSnapshot:
+            return self.snapshot.loadTable(name, columns)
+
+        return self.snapshot.readSource(name, columns)
+
+    def sourceColumns(self, name: str) -> List[str]:
+        """
+        :name: name of the table, one of 'snippets', 'full' or 'moods'
+        :return: the names of all the columns the table has in the snapshot or .csv file
+        """
+
+        if name not in self.tableSources:
+            self.tableSources[name] = self.snapshot.tableColumns(name, self.useSnapshot)
+
+        return self.tableSources[name]
+
+    def loadMoods(self, moods: List[str]) -> None:
+        """
+        Reads the mood columns that haven't been loaded yet in one go and stores them sparsely. The
+        dense columns are dropped again right after, they never become part of the snippet table.
+
+        :moods: strings representing the moods, columns of the snippet database that don't exist are skipped
+        """
+
+        with self.lock:
+            # the SQLite file and the shared segment hold the mood scores sparsely already.
+            if self.store is not None:
+                for mood in moods:
+                    if (
+                        mood not in self.moods.entries
+                        and mood in self.store.meta["moods"]
+                    ):
+                        self.moods.addScores(mood, *self.store.moodScores(mood))
+                return
+
+            missing: List[str] = [
+                mood
+                for mood in moods
+                if mood not in self.moods.entries
+                and mood in self.sourceColumns("snippets")
+            ]
+
+            if not missing:
+                return
+
+            # the columns are read in the order of the .csv file, the labels put them in the sorted order.
+            columns: TypeVar("pd.DataFrame") = self.readTable(
+                "snippets", missing
+            ).reindex(self.df_snippets.index)
+
+            for mood in missing:
+                self.moods.addMood(mood, columns[mood])
+
+    def moodScores(self, mood: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :mood: string representing the mood, a column of the snippet database
+        :return: the row positions of the snippets with a score for the mood and their scores. Raises a
+            KeyError if the snippet database has no such column.
+        """
+
+        # moods that are not in the settings are loaded the first time they are asked for.
+        self.loadMoods([mood])
+
+        return self.moods.moodScores(mood)
+
+    def snippetRows(self, positions: np.ndarray) -> TypeVar("pd.DataFrame"):
+        """
+        :positions: row positions in the snippet database
+        :return: the rows of the snippets as a dataframe, in the order of the positions, with the keys
+            and filenames as text
+        """
+
+        if self.store is not None:
+            return self.store.snippetRows(positions)
+
+        rows: TypeVar("pd.DataFrame") = self.df_snippets.iloc[positions]
+
+        # the encoded secondary keys and the filenames are only decoded for the rows asked for.
+        if pd.api.types.is_integer_dtype(rows["SecondaryKeys"].dtype):
+            rows = rows.assign(
+                SecondaryKeys=pd.array(
+                    self.index.schema.decodeSecondaryKeys(
+                        rows["SecondaryKeys"].to_numpy()
+                    ),
+                    dtype=self.textDtype,
+                )
+            )
+        rows.insert(
+            self.indexedAt["FileNames"],
+            "FileNames",
+            pd.array(self.index.fileNamesAt(positions), dtype=self.textDtype),
         )
-        self.df_full: TypeVar("pd.DataFrame") = pd.read_csv(musicFullDataBaseURL)
-        self.df_moods: TypeVar("pd.DataFrame") = pd.read_csv(musicMoodsDataBaseURL)
+
+        return rows
+
+    def sortSnippets(
+        self, df_snippets: TypeVar("pd.DataFrame")
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        Sorts the snippets by piece and then by bar number, which makes all the bars of a piece a
+        contiguous range of rows. The bar number is the last 4 digits of the secondary key, or the
+        remainder of the encoded key.
+
+        :df_snippets: the snippet database as it was read
+        :return: the snippet database sorted by piece and bar number
+        """
+
+        keys: TypeVar("pd.Series") = df_snippets["SecondaryKeys"]
+        bars: np.ndarray = (
+            keys.to_numpy() % secondaryKeyBase
+            if pd.api.types.is_integer_dtype(keys.dtype)
+            else keys.str[-4:].astype(int).to_numpy()
+        )
+        order: np.ndarray = np.lexsort((bars, df_snippets["PrimaryKeys"].to_numpy()))
+
+        # the .csv files are usually in this order already, then there is nothing to copy.
+        if np.array_equal(order, np.arange(len(order))):
+            return df_snippets
+
+        self.logger.info("sortSnippets called - snippets reordered by piece and bar")
+
+        return df_snippets.iloc[order]
 
     def findPieceByMood(self, mood: str) -> TypeVar("pd.DataFrame"):
         """
         This function will only be used when starting playback from a point where no music has been played yet.
-        It will take in a mood and return a matching piece that can be played from the start.
+        It will take in a mood and return a matching piece that can be played from the start. The snippets
+        have been ranked per mood at load time, so this is a slice of that ranking.
 
         :mood: string representing the mood of the piece
-        :return: a dataframe containg data about pieces that match the given mood.
+        :return: a dataframe containg data about pieces that match the given mood, best first.
         """
 
-        matches: TypeVar("pd.DataFrame") = self.df_snippets
-        matches = matches.loc[matches.ThirdKey < 25]
-        matches = matches[matches[mood].notna()]
+        matches: TypeVar("pd.DataFrame") = self.snippetRows(self.entryPoints(mood))
 
         self.logger.info(f"findPieceByMood called - mood: {mood}")
         self.logger.debug(f"findPieceByMood called - returns: {matches}")
 
-        return matches.sort_values(mood, ascending=False)[:250]
+        return matches
+
+    def samplePieceByMood(self, mood: str) -> TypeVar("pd.DataFrame"):
+        """
+        Picks one of the entry points of findPieceByMood at random, without building the dataframe of
+        all of them.
+
+        :mood: string representing the mood of the piece
+        :return: a single row dataframe containing the picked snippet, raises a KeyError if there is none
+        """
+
+        entryPoints: np.ndarray = self.entryPoints(mood)
+
+        if len(entryPoints) == 0:
+            raise KeyError(mood)
+
+        # perform logging operations
+        self.logger.info(f"samplePieceByMood called - mood: {mood}")
+
+        return self.snippetRows([np.random.choice(entryPoints)])
+
+    def entryPoints(self, mood: str) -> np.ndarray:
+        """
+        :mood: string representing the mood of the piece
+        :return: row positions of the best snippets to start playback from in the mood, best first
+        """
+
+        # moods that are not in the settings are ranked the first time they are asked for.
+        if mood not in self.index.moodRankings:
+            self.index.moodRankings[mood] = self.index.buildMoodRanking(
+                self.index.thirdKeys, *self.moodScores(mood)
+            )
+
+        return self.index.moodRanking(mood)[:musicMoodEntryPoints]
 
     def findSimilarPiece(
         self,
@@ -94,10 +628,10 @@ class databaseMain:
         valenceChange: int = 0,
         arousalChange: int = 0,
     ) -> TypeVar("pd.DataFrame"):
-
         """
         method that combines data gathering with analysis and returns a name of a snippet that represents
-        the closest match.
+        the closest match. The reference is kept in self.referencePiece for matchCounters(), so this
+        method is not thread-safe, querySimilarPiece() is.
 
         :referencePiece: string that represents the filename as it occurs in the full piece database
         :mood: string representing the mood we are currently looking for
@@ -108,192 +642,1216 @@ class databaseMain:
         """
 
         # these weights allocate importance to the fidderent commonalities between the 2 snippets.
-        self.weights: List[float] = [1.2, 1, 0.2, 1, 1]
+        self.weights: List[float] = defaultWeights
+
+        # first step here is to gather all the relevant data via the 'gatherData' method, unless it
+        # has been gathered for this reference already.
+        if self.referencePiece.get("filename") != referencePiece:
+            self.gatherData(referencePiece)
+        self.notesRef: np.ndarray = self.index.noteHistograms[
+            self.index.positionByFileName(referencePiece)
+        ]
 
-        # first step here is to gather all the relevant data via the 'gatherData' method.
-        # Then it runs through each relevant parameter and finds close matches by several
-        # sorting processes.
+        return self.querySimilarPiece(
+            referencePiece, mood, tempoChange, valenceChange, arousalChange
+        )
 
-        self.gatherData(referencePiece)
+    def querySimilarPiece(
+        self,
+        referencePiece: str,
+        mood: str,
+        tempoChange: int = 0,
+        valenceChange: int = 0,
+        arousalChange: int = 0,
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        Looks up the same matches as findSimilarPiece, without keeping anything of the query on the
+        object. Everything the query needs is a local of its own, and what it shares with other queries
+        is either read-only, locked or swapped rather than changed in place, so this method is
+        thread-safe and lookups can run from several threads at the same time.
 
-        # first step is to select all the pieces with a similar instrumentation, You store the
-        # primary keys to look up the value in the other databases as it is the only common
-        # element.
-        matches = self.df_full.loc[
-            self.df_full["Instrument"] == self.referencePiece["Instrument"]
-        ]
-        matchesOrchestration = matches["PrimaryKey"].tolist()
+        :referencePiece: string that represents the filename as it occurs in the full piece database
+        :mood: string representing the mood we are currently looking for
+        :tempoChange: float representing the amount you want the tempo to change up or down
+        :valenceChange: float representing the amount the next match should change for valence
+        :arousalChange: float representing the amount the next match should change for arousal
+        :return: a dataframe containing possible matches to the reference piece
+        """
 
-        # next line gets all the matching keys from the snippets results.
-        matches = self.df_snippets.loc[
-            self.df_snippets["PrimaryKeys"].isin(matchesOrchestration)
-        ]
+        # the time every stage takes is recorded, see timingReport().
+        timer: Optional[Dict[Optional[str], Any]] = self.timings.start()
 
-        # don't return matches for the same piece
-        matches = matches.loc[
-            matches["PrimaryKeys"] != self.referencePiece["PrimaryKey"]
-        ]
+        finalPositions, finalScores = self.cachedMatches(
+            referencePiece, tempoChange, valenceChange, arousalChange, timer
+        )
 
-        # use only matches that have valence and arousal values
-        matches = matches[matches["Valence"].notna()]
+        finalMatches: TypeVar("pd.DataFrame") = self.buildMatches(
+            finalPositions, finalScores, mood
+        )
+        self.timings.mark(timer, "moods", len(finalMatches))
+        self.timings.add(timer, referencePiece)
 
-        # then we select all the snippets with the same dominant note (= musical key).
-        matches = matches.loc[
-            matches["DominantNoteMean"] == self.referencePiece["DominantNoteMean"]
-        ]
+        # perform logging operations
+        self.logger.info(
+            f"querySimilarPiece called - referencePiece: {referencePiece} and mood: {mood}"
+        )
+        self.logger.debug(
+            f"querySimilarPiece called - tempoChange: {tempoChange}, valenceChange: {valenceChange}, arousalChange: {arousalChange}"
+        )
+        if len(finalMatches) == 0:
+            self.logger.warning(f"no matches found")
+
+        return finalMatches
+
+    def querySimilarPieces(
+        self,
+        queries: List[Tuple[str, str, List[float]]],
+        executor: Optional[Executor] = None,
+    ) -> List[TypeVar("pd.DataFrame")]:
+        """
+        Runs querySimilarPiece for every query on a pool of threads, so the lookups of for example
+        several players or mix points don't wait on each other. The scoring releases the GIL while it
+        works through the candidates, and with the sqlite backend so do the reads from the file.
+
+        :queries: list of (referencePiece, mood, [tempoChange, valenceChange, arousalChange]) tuples, with
+            the same meaning as the arguments of querySimilarPiece
+        :executor: the pool to run the lookups on, None to start one with musicQueryWorkers threads for
+            this call alone
+        :return: one dataframe of possible matches per query, in the order of the queries
+        """
+
+        def lookup(query: Tuple[str, str, List[float]]) -> TypeVar("pd.DataFrame"):
+            referencePiece, mood, change = query
+            return self.querySimilarPiece(referencePiece, mood, *change)
+
+        if executor is not None:
+            results: List[TypeVar("pd.DataFrame")] = list(executor.map(lookup, queries))
+        else:
+            with ThreadPoolExecutor(musicQueryWorkers or os.cpu_count() or 1) as pool:
+                results = list(pool.map(lookup, queries))
+
+        # perform logging operations
+        self.logger.info(f"querySimilarPieces called - queries: {len(queries)}")
+
+        return results
+
+    def findNearestPiece(
+        self,
+        referencePiece: str,
+        mood: str,
+        weights: List[float] = defaultWeights,
+        tempoChange: int = 0,
+        valenceChange: int = 0,
+        arousalChange: int = 0,
+        probes: int = musicANNProbes,
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        Like findSimilarPiece, but the matches are searched in the whole catalog instead of only the
+        snippets with the same instrumentation and dominant note, and with weights of the query's own.
+        The nearest-neighbour index narrows the catalog down to the clusters closest to the reference,
+        which are then scored exactly. Without an up to date index the whole catalog is scored.
 
-        # then we match the occurance of notes between the reference piece and the previous matches
-        # giving us a number. The higher the number, the more matches. But it doesn't take into account
-        # that some pieces simply have more notes than others so a normalization is made:
-        self.notesRef: TypeVar("Counter") = Counter(
-            ast.literal_eval(self.referencePiece["Notes"])
+        :referencePiece: string that represents the filename as it occurs in the full piece database
+        :mood: string representing the mood we are currently looking for
+        :weights: importance of notes, tempo, noisiness, valence and arousal
+        :tempoChange: float representing the amount you want the tempo to change up or down
+        :valenceChange: float representing the amount the next match should change for valence
+        :arousalChange: float representing the amount the next match should change for arousal
+        :probes: the number of clusters of the index to look in, more finds more of the true matches
+            but takes longer
+        :return: a dataframe containing possible matches to the reference piece
+        """
+
+        # the time every stage takes is recorded, see timingReport().
+        timer: Optional[Dict[Optional[str], Any]] = self.timings.start()
+
+        recency: Tuple[int, Optional[np.ndarray]] = self.recency.state()
+        changes: Tuple[float, float, float] = (
+            tempoChange,
+            valenceChange,
+            arousalChange,
         )
 
-        matches["commonCount"] = matches["Notes"].apply(
-            lambda row: self.matchCounters(row)
+        # the matches are cached without the penalties of the recently played pieces, see cachedMatches().
+        key: Tuple[Any, ...] = (
+            "nearest",
+            referencePiece,
+            tuple(weights),
+            *changes,
+            probes,
         )
+        cached: Optional[Tuple[np.ndarray, ...]] = self.cache.get(key)
+        self.timings.mark(timer, "cache", 0 if cached is None else len(cached[0]))
+
+        if cached is None:
+            reference: int = self.index.positionByFileName(referencePiece)
+            self.timings.mark(timer, "reference", 1)
 
-        matches["commonCountRatio"] = 1 - (
-            matches["commonCount"] / matches["DensityNotes"]
+            candidates: np.ndarray = self.nearestCandidates(
+                reference, weights, changes, probes
+            )
+            self.timings.mark(timer, "candidates", len(candidates))
+
+            cached = self.cache.put(
+                key,
+                *self.rankReference(
+                    reference, candidates, *changes, weights, timer=timer
+                ),
+            )
+
+        matches: Optional[Tuple[np.ndarray, np.ndarray]] = self.penalizeMatches(
+            *cached, recency[1]
         )
 
-        # calculate the difference for the following analytics : TempoMean , NoisinessMedian
-        matches["commonTempo"] = (
-            1
-            - (matches["TempoMean"] / (self.referencePiece["TempoMean"] + tempoChange))
-        ).abs()
+        if matches is None:
+            # the recently played pieces push back too many of the cached matches, they are scored live.
+            reference = self.index.positionByFileName(referencePiece)
+            candidates = self.nearestCandidates(reference, weights, changes, probes)
+            self.timings.mark(timer, "candidates", len(candidates))
 
-        matches["commonNoisiness"] = (
-            1 - (matches["NoisinessMedian"] / self.referencePiece["NoisinessMedian"])
-        ).abs()
+            matches = self.scoreReference(
+                reference, candidates, *changes, weights, timer, recency
+            )
 
-        # calculate similarities between the valence and arousal values
-        matches["commonValence"] = (
-            1 - (matches["Valence"] / (self.referencePiece["Valence"] + valenceChange))
-        ).abs()
+        finalMatches: TypeVar("pd.DataFrame") = self.buildMatches(*matches, mood)
+        self.timings.mark(timer, "moods", len(finalMatches))
+        self.timings.add(timer, referencePiece, "findNearestPiece")
 
-        matches["commonArousal"] = (
-            1 - (matches["Arousal"] / (self.referencePiece["Arousal"] + arousalChange))
-        ).abs()
+        # perform logging operations
+        self.logger.info(
+            f"findNearestPiece called - referencePiece: {referencePiece}, mood: {mood}, weights: {weights}, probes: {probes}"
+        )
 
-        # now calculate the sum of all the common data. The lower this number, the closer the match
-        matches["commonRatio"] = (
-            matches["commonCountRatio"] * self.weights[0]
-            + matches["commonTempo"] * self.weights[1]
-            + matches["commonNoisiness"] * self.weights[2]
-            + matches["commonValence"] * self.weights[3]
-            + matches["commonArousal"] * self.weights[4]
-        ).abs()
+        return finalMatches
 
-        # the result is a list of the best matches to the reference piece.
-        finalMatches: TypeVar("pd.DataFrame") = matches.nsmallest(20, "commonRatio")
-        finalMatches = finalMatches.iloc[1:, :]
+    def findDirectionalPiece(
+        self,
+        referencePiece: str,
+        mood: str,
+        direction: Tuple[float, float],
+        angle: float = musicProjectionAngle,
+        count: int = 19,
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        Finds the snippets closest to the reference in the UMAP projection, within a cone around a
+        direction. Musical attributes change along directions in the projection, see README-DATA, so
+        this steers the music towards for example a faster tempo or another chord voicing.
 
-        # here I will now write some code that gathers the moods of the music in order to give the user/program
-        # a choice about what the next piece will be.
+        :referencePiece: string that represents the filename as it occurs in the full piece database
+        :mood: string representing the mood we are currently looking for
+        :direction: the x and y of the direction to move in, in the projection
+        :angle: the largest angle in degrees between the direction and a match, seen from the reference
+        :count: the number of matches to return
+        :return: a dataframe containing possible matches to the reference piece, with their distance
+            in the projection as commonRatio
+        """
 
-        # Make a new dataframe column that can store the value for the requested mood.
-        finalMatches["Moods"] = ""
+        # the time every stage takes is recorded, see timingReport().
+        timer: Optional[Dict[Optional[str], Any]] = self.timings.start()
 
-        # make a new list that can store the mood representation values themselves.
-        moodValues: List[str, str] = []
+        recency: Tuple[int, Optional[np.ndarray]] = self.recency.state()
 
-        # iterate over rows in the finalmatches and lookup the values in the database.
-        for _, row in finalMatches.iterrows():
-            key = row["SecondaryKeys"]
-            moodVal = self.gatherMoods(key, mood)
-            moodValues.append(moodVal)
+        # the matches are cached without the penalties of the recently played pieces, see cachedMatches().
+        key: Tuple[Any, ...] = (
+            "directional",
+            referencePiece,
+            tuple(direction),
+            angle,
+            count,
+        )
+        cached: Optional[Tuple[np.ndarray, ...]] = self.cache.get(key)
+        self.timings.mark(timer, "cache", 0 if cached is None else len(cached[0]))
 
-        # write the moods to the newly created column.
-        finalMatches["Moods"] = moodValues
+        if not self.projection.load(self.index):
+            matches: Optional[Tuple[np.ndarray, np.ndarray]] = (
+                np.array([], dtype=np.int64),
+                np.array([], dtype=np.float32),
+            )
+        else:
+            reference: int = self.index.positionByFileName(referencePiece)
+            self.timings.mark(timer, "reference", 1)
+
+            if cached is None:
+                depth: int = max(count, musicQueryCacheDepth)
+                positions, distances = self.projection.cone(
+                    reference, direction, angle, depth
+                )
+                self.timings.mark(timer, "select", len(positions))
+
+                # the cone holds fewer snippets than asked for only when it has no more.
+                cached = self.cache.put(
+                    key,
+                    positions,
+                    distances,
+                    np.float32(distances[-1] if len(positions) == depth else np.inf),
+                )
+
+            matches = self.penalizeMatches(*cached, recency[1], count, 0)
+
+            if matches is None:
+                # the recently played pieces push back too many of the cached matches, the cone is
+                # searched again with their penalties.
+                matches = self.projection.cone(
+                    reference, direction, angle, count, recency[1]
+                )
+                self.timings.mark(timer, "select", len(matches[0]))
+
+        finalMatches: TypeVar("pd.DataFrame") = self.buildMatches(*matches, mood)
+        self.timings.mark(timer, "moods", len(finalMatches))
+        self.timings.add(timer, referencePiece, "findDirectionalPiece")
 
         # perform logging operations
         self.logger.info(
-            f"findSimilarPiece called - referencePiece: {referencePiece} and mood: {mood}"
-        )
-        self.logger.debug(
-            f"findSimilarPiece called - tempoChange: {tempoChange}, valenceChange: {valenceChange}, arousalChange: {arousalChange}"
+            f"findDirectionalPiece called - referencePiece: {referencePiece}, mood: {mood}, direction: {direction}, angle: {angle}"
         )
         if len(finalMatches) == 0:
             self.logger.warning(f"no matches found")
 
-        # return the potential matches, sorted from high mood awareness to low.
-        return finalMatches.sort_values("Moods", ascending=False)
+        return finalMatches
+
+    def findRelaxedPiece(
+        self,
+        referencePiece: str,
+        mood: str,
+        budget: float = musicSearchBudget,
+        tempoChange: int = 0,
+        valenceChange: int = 0,
+        arousalChange: int = 0,
+        fallbackMoods: Optional[List[str]] = None,
+    ) -> Tuple[TypeVar("pd.DataFrame"), str]:
+        """
+        Version of findSimilarPiece that relaxes its filters step by step when they leave nothing: first
+        to the keys related to the dominant note, then to any instrument and at last to any snippet that
+        has a score for the mood, or for one of the fallback moods in turn. A level is only started while
+        the budget lasts, and the candidates of the relaxed levels are scored in chunks of musicSearchChunk
+        that are only started while it lasts too. The time a transition search takes is so bounded by the
+        budget plus a single chunk.
+
+        :referencePiece: string that represents the filename as it occurs in the snippet database
+        :mood: string representing the mood we are currently looking for
+        :budget: the time in milliseconds after which no more levels are tried
+        :tempoChange: float representing the amount you want the tempo to change up or down
+        :valenceChange: float representing the amount the next match should change for valence
+        :arousalChange: float representing the amount the next match should change for arousal
+        :fallbackMoods: the moods to try at the last level when there are no matches for the mood, in
+            order of preference
+        :return: a dataframe containing possible matches to the reference piece, and the level of
+            relaxationLevels it was found at. When the budget runs out during a level, the matches are
+            the best of the candidates scored so far, and the dataframe is empty if there are none.
+        """
+
+        deadline: float = time.perf_counter() + budget / 1000
+        recency: Tuple[int, Optional[np.ndarray]] = self.recency.state()
+
+        # the time every stage takes is recorded, see timingReport(). The stages of all the levels that
+        # were tried add up, and the query is recorded with the level it stopped at.
+        timer: Optional[Dict[Optional[str], Any]] = self.timings.start()
+
+        # only the last level selects its candidates by mood, so that is the level the fallback moods
+        # are tried at, each of them in turn.
+        moods: List[str] = [mood] + [
+            option for option in fallbackMoods or [] if option != mood
+        ]
+        steps: List[Tuple[str, str]] = [
+            (level, mood) for level in relaxationLevels[:-1]
+        ] + [(relaxationLevels[-1], option) for option in moods]
+
+        for number, (level, stepMood) in enumerate(steps):
+            if level == "strict":
+                positions, scores = self.cachedMatches(
+                    referencePiece,
+                    tempoChange,
+                    valenceChange,
+                    arousalChange,
+                    timer,
+                    recency,
+                )
+            else:
+                # the strict level doesn't need the reference when it is answered from the cache.
+                if number == relaxationLevels.index("strict") + 1:
+                    reference: int = self.index.positionByFileName(referencePiece)
+                    instrument, dominantNote = self.candidateBlock(reference)
+                    relatedNotes: Set[float] = {
+                        (float(dominantNote) + interval) % 12
+                        for interval in relatedIntervals
+                    }
+                    self.timings.mark(timer, "reference", 1)
+
+                if level == "relatedKeys":
+                    relaxed: np.ndarray = self.index.blockPositions(
+                        {instrument}, relatedNotes
+                    )
+                elif level == "anyInstrument":
+                    relaxed = self.index.blockPositions(None, relatedNotes)
+                else:
+                    relaxed = self.moodScores(stepMood)[0].astype(np.int64)
+
+                # don't return matches for the same piece
+                relaxed = relaxed[
+                    self.index.primaryKeys[relaxed] != self.index.primaryKeys[reference]
+                ]
+                self.timings.mark(timer, "candidates", len(relaxed))
+
+                positions, scores = self.scoreReferenceUntil(
+                    reference,
+                    relaxed,
+                    deadline,
+                    tempoChange,
+                    valenceChange,
+                    arousalChange,
+                    timer,
+                    recency,
+                )
+
+            if len(positions) or time.perf_counter() > deadline:
+                break
+
+        matches: TypeVar("pd.DataFrame") = self.buildMatches(
+            positions, scores, stepMood
+        )
+        self.timings.mark(timer, "moods", len(matches))
+        self.timings.add(timer, referencePiece, f"findRelaxedPiece:{level}")
+
+        # perform logging operations
+        self.logger.info(
+            f"findRelaxedPiece called - referencePiece: {referencePiece}, mood: {stepMood}, level: {level}"
+        )
+        if len(matches) == 0:
+            self.logger.warning(f"no matches found")
+
+        return matches, level
+
+    def findSimilarPieceByMoods(
+        self,
+        referencePiece: str,
+        moods: List[str],
+        tempoChange: int = 0,
+        valenceChange: int = 0,
+        arousalChange: int = 0,
+        firstOnly: bool = False,
+    ) -> Dict[str, TypeVar("pd.DataFrame")]:
+        """
+        Looks up close musical matches for several moods at once, in order of preference. The candidates
+        are scored against the reference a single time, after which the best matches are selected per
+        mood among the candidates that have a score for that mood.
+
+        :referencePiece: string that represents the filename as it occurs in the snippet database
+        :moods: strings representing the moods to look for, the preferred mood first
+        :tempoChange: float representing the amount you want the tempo to change up or down
+        :valenceChange: float representing the amount the next match should change for valence
+        :arousalChange: float representing the amount the next match should change for arousal
+        :firstOnly: True to stop at the first mood that has matches
+        :return: dict from mood to a dataframe of its matches, like findSimilarPiece returns them. With
+            firstOnly it only holds the first mood that has matches, or nothing if none of them does.
+        """
+
+        # the time every stage takes is recorded, see timingReport().
+        timer: Optional[Dict[Optional[str], Any]] = self.timings.start()
+
+        reference: int = self.index.positionByFileName(referencePiece)
+        self.timings.mark(timer, "reference", 1)
+
+        positions: np.ndarray = self.candidates(reference)
+        self.timings.mark(timer, "candidates", len(positions))
 
-    def gatherMoods(self, matchByKey: int, mood: str) -> TypeVar("pd.Series"):
+        scores: np.ndarray = self.scoring.scoreCandidates(
+            positions,
+            reference,
+            tempoChange,
+            valenceChange,
+            arousalChange,
+            defaultWeights,
+            self.recency.penalties(),
+        )
+        self.timings.mark(timer, "scoring", len(scores))
+
+        results: Dict[str, TypeVar("pd.DataFrame")] = {}
+
+        # like findSimilarPiece, the very best candidate is left out whatever the mood, so a mood every
+        # candidate has a score for gets the same 19 matches findSimilarPiece returns.
+        eligible: np.ndarray = np.ones(len(positions), dtype=bool)
+        eligible[self.scoring.selectTop(scores, 1)] = False
+
+        for mood in moods:
+            self.loadMoods([mood])
+
+            # only the candidates with a score for the mood can be a match for it.
+            keep: np.ndarray = np.flatnonzero(
+                eligible & ~np.isnan(self.moods.scoresAt(positions, mood))
+            )
+            best: np.ndarray = keep[self.scoring.selectTop(scores[keep], 19)]
+            self.timings.mark(timer, "select", len(best))
+
+            if firstOnly and len(best) == 0:
+                continue
+
+            results[mood] = self.buildMatches(positions[best], scores[best], mood)
+            self.timings.mark(timer, "moods", len(results[mood]))
+
+            if firstOnly:
+                break
+
+        self.timings.add(timer, referencePiece, "findSimilarPieceByMoods")
+
+        # perform logging operations
+        self.logger.info(
+            f"findSimilarPieceByMoods called - referencePiece: {referencePiece}, moods: {moods}, found: {list(results)}"
+        )
+
+        return results
+
+    def findSimilarPieces(
+        self, queries: List[Tuple[str, str, List[float]]]
+    ) -> List[TypeVar("pd.DataFrame")]:
+        """
+        Batched version of findSimilarPiece, used to evaluate several possible mix points and changes at
+        once. Queries whose references share the same candidate block are scored together as one
+        (queries x candidates) matrix, so N mix points cost one pass over the candidates instead of N.
+
+        :queries: list of (referencePiece, mood, [tempoChange, valenceChange, arousalChange]) tuples, with
+            the same meaning as the arguments of findSimilarPiece
+        :return: one dataframe of possible matches per query, in the order of the queries
+        """
+
+        # the time every stage takes is recorded, see timingReport(). The batch is recorded as a single
+        # query, under the reference of its first query and with the stages of all the queries added up.
+        timer: Optional[Dict[Optional[str], Any]] = self.timings.start()
+
+        references: np.ndarray = np.array(
+            [self.index.positionByFileName(query[0]) for query in queries],
+            dtype=np.int64,
+        )
+        changes: np.ndarray = np.array(
+            [query[2] for query in queries], dtype=np.float32
+        ).reshape(len(queries), 3)
+
+        # group the queries by the candidate block their reference falls in.
+        groups: Dict[Tuple[Any, Any], List[int]] = {}
+        for number, reference in enumerate(references.tolist()):
+            groups.setdefault(self.candidateBlock(reference), []).append(number)
+
+        self.timings.mark(timer, "reference", len(queries))
+
+        found: List[Optional[Tuple[np.ndarray, np.ndarray]]] = [None] * len(queries)
+        recency: Tuple[int, Optional[np.ndarray]] = self.recency.state()
+
+        # queries that are cached, or have no changes and can be read from the transition graph, are
+        # answered one by one.
+        for number, (referencePiece, mood, change) in enumerate(queries):
+            key: Tuple[Any, ...] = self.matchKey(referencePiece, *change)
+            cached: Optional[Tuple[np.ndarray, ...]] = self.cache.get(key)
+
+            if cached is None and self.usesGraph(*change):
+                cached = self.cache.put(
+                    key, *self.matchReference(references[number], *change)
+                )
+
+            if cached is not None:
+                found[number] = self.recentMatches(
+                    key, referencePiece, cached, change, recency, timer
+                )
+
+        self.timings.mark(timer, "cache", sum(matches is not None for matches in found))
+
+        for block, numbers in groups.items():
+            numbers = [number for number in numbers if found[number] is None]
+            if not numbers:
+                continue
+
+            positions: np.ndarray = self.index.candidatePositions(*block)
+            self.timings.mark(timer, "candidates", len(positions))
+
+            scores: np.ndarray = self.scoring.scoreBatch(
+                positions,
+                references[numbers],
+                changes[numbers],
+                defaultWeights,
+            )
+            self.timings.mark(timer, "scoring", scores.size)
+
+            for row, number in enumerate(numbers):
+                # don't return matches for the same piece
+                keep: np.ndarray = np.flatnonzero(
+                    self.index.primaryKeys[positions]
+                    != self.index.primaryKeys[references[number]]
+                )
+                best: np.ndarray = keep[
+                    self.scoring.selectTop(scores[row, keep], musicQueryCacheDepth)
+                ]
+
+                # the snippets that are left out score at least as high as the last one that is kept.
+                referencePiece, mood, change = queries[number]
+                key = self.matchKey(referencePiece, *change)
+                cached = self.cache.put(
+                    key,
+                    positions[best],
+                    scores[row, best],
+                    np.float32(
+                        scores[row, best[-1]] if len(best) < len(keep) else np.inf
+                    ),
+                )
+                found[number] = self.recentMatches(
+                    key, referencePiece, cached, change, recency
+                )
+
+            self.timings.mark(timer, "select", len(numbers))
+
+        results: List[TypeVar("pd.DataFrame")] = [
+            self.buildMatches(*matches, mood)
+            for matches, (referencePiece, mood, change) in zip(found, queries)
+        ]
+        self.timings.mark(timer, "moods", sum(len(matches) for matches in results))
+        if queries:
+            self.timings.add(timer, queries[0][0], "findSimilarPieces")
+
+        # perform logging operations
+        self.logger.info(
+            f"findSimilarPieces called - queries: {len(queries)}, blocks: {len(groups)}"
+        )
+
+        return results
+
+    def cachedMatches(
+        self,
+        referencePiece: str,
+        tempoChange: float = 0,
+        valenceChange: float = 0,
+        arousalChange: float = 0,
+        timer: Optional[Dict[Optional[str], Any]] = None,
+        recency: Optional[Tuple[int, Optional[np.ndarray]]] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Version of matchReference that answers from the query cache when it can, used by every query
+        that matches a reference with the default filters and weights.
+
+        :referencePiece: string that represents the filename as it occurs in the full piece database
+        :tempoChange: float representing the amount you want the tempo to change up or down
+        :valenceChange: float representing the amount the next match should change for valence
+        :arousalChange: float representing the amount the next match should change for arousal
+        :timer: optional timer of the query to mark the stages on, see databaseTimings
+        :recency: the generation and penalties to score with as returned by databaseRecency.state(),
+            None for the current ones
+        :return: the row positions and scores of the matches, best first
+        """
+
+        # the generation and the penalties are read together, a piece marked as played while the query
+        # runs only counts for the next one.
+        recency = recency or self.recency.state()
+
+        # gameplay keeps returning to the same states, so the same query is often answered from the cache.
+        # The matches are cached without the penalties of the pieces played so far, those are applied
+        # after the lookup, so playing a piece leaves the cache as it is.
+        key: Tuple[Any, ...] = self.matchKey(
+            referencePiece, tempoChange, valenceChange, arousalChange
+        )
+        cached: Optional[Tuple[np.ndarray, ...]] = self.cache.get(key)
+        self.timings.mark(timer, "cache", 0 if cached is None else len(cached[0]))
+
+        if cached is None:
+            # select the candidates and score how close each of them is to the reference.
+            reference: int = self.index.positionByFileName(referencePiece)
+            self.timings.mark(timer, "reference", 1)
+
+            cached = self.cache.put(
+                key,
+                *self.matchReference(
+                    reference, tempoChange, valenceChange, arousalChange, timer
+                ),
+            )
+
+        return self.recentMatches(
+            key,
+            referencePiece,
+            cached,
+            (tempoChange, valenceChange, arousalChange),
+            recency,
+            timer,
+        )
+
+    def recentMatches(
+        self,
+        key: Tuple[Any, ...],
+        referencePiece: str,
+        cached: Tuple[np.ndarray, ...],
+        changes: Tuple[float, float, float],
+        recency: Tuple[int, Optional[np.ndarray]],
+        timer: Optional[Dict[Optional[str], Any]] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Applies the penalties of the recently played pieces to cached matches. When these push back so
+        many of the cached matches that other snippets could take their place, the candidates are scored
+        again: without the penalties and as deep as the cache keeps them if the matches came from the
+        transition graph, and with the penalties if even that isn't enough.
+
+        :key: the key the matches are cached under, see matchKey()
+        :referencePiece: string that represents the filename as it occurs in the full piece database
+        :cached: the row positions, scores and bound of the matches as returned by matchReference()
+        :changes: the tempo, valence and arousal change of the query
+        :recency: the generation and penalties to score with as returned by databaseRecency.state()
+        :timer: optional timer of the query to mark the stages on, see databaseTimings
+        :return: the row positions and scores of the matches, best first
+        """
+
+        matches: Optional[Tuple[np.ndarray, np.ndarray]] = self.penalizeMatches(
+            *cached, recency[1]
+        )
+        if matches is not None:
+            return matches
+
+        reference: int = self.index.positionByFileName(referencePiece)
+        candidates: np.ndarray = self.candidates(reference)
+        self.timings.mark(timer, "candidates", len(candidates))
+
+        if len(cached[0]) < musicQueryCacheDepth:
+            cached = self.cache.put(
+                key, *self.rankReference(reference, candidates, *changes, timer=timer)
+            )
+            matches = self.penalizeMatches(*cached, recency[1])
+            if matches is not None:
+                return matches
+
+        return self.scoreReference(
+            reference, candidates, *changes, timer=timer, recency=recency
+        )
+
+    def penalizeMatches(
+        self,
+        positions: np.ndarray,
+        scores: np.ndarray,
+        bound: np.ndarray,
+        penalties: Optional[np.ndarray],
+        count: int = 20,
+        skip: int = 1,
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        :positions: row positions of the cached matches, best first
+        :scores: the score of every cached match, without penalties
+        :bound: the lowest score a snippet that isn't among the cached matches can have
+        :penalties: the penalty array as returned by databaseRecency.penalties(), None if no piece is
+            penalized
+        :count: the number of matches to select
+        :skip: the number of best matches to leave out of those
+        :return: the row positions and penalized scores of the best matches, best first, or None if
+            snippets that aren't cached could be among them
+        """
+
+        best: Union[slice, np.ndarray] = slice(0, count)
+
+        if penalties is not None and penalties[positions].any():
+            scores = scores + penalties[positions]
+            best = self.scoring.selectTop(scores, count)
+
+            # the selection is the one scoring all the candidates would give as long as none of the
+            # selected matches scores above the snippets that weren't cached.
+            if len(best) and scores[best[-1]] > bound:
+                return None
+
+        return positions[best][skip:], scores[best][skip:]
+
+    def matchKey(
+        self,
+        referencePiece: str,
+        tempoChange: float,
+        valenceChange: float,
+        arousalChange: float,
+    ) -> Tuple[Any, ...]:
+        """
+        :referencePiece: string that represents the filename as it occurs in the full piece database
+        :tempoChange: the tempo change of the query
+        :valenceChange: the valence change of the query
+        :arousalChange: the arousal change of the query
+        :return: the key the matches of the query are cached under. The mood only decides the order the
+            matches are returned in, so queries for other moods share the entry.
+        """
+
+        return (
+            referencePiece,
+            float(tempoChange),
+            float(valenceChange),
+            float(arousalChange),
+        )
+
+    def matchReference(
+        self,
+        reference: int,
+        tempoChange: float = 0,
+        valenceChange: float = 0,
+        arousalChange: float = 0,
+        timer: Optional[Dict[Optional[str], Any]] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds the best matches for a reference snippet as they are cached, from the transition graph if
+        possible and by scoring the candidates otherwise. The penalties of the recently played pieces are
+        left out and the very best match is kept, penalizeMatches() takes care of both.
+
+        :reference: row position of the reference snippet
+        :tempoChange: float representing the amount you want the tempo to change up or down
+        :valenceChange: float representing the amount the next match should change for valence
+        :arousalChange: float representing the amount the next match should change for arousal
+        :timer: optional timer of the query to mark the stages on, see databaseTimings
+        :return: the row positions and scores of the matches, best first, and the bound as returned by
+            rankReference()
+        """
+
+        if self.usesGraph(tempoChange, valenceChange, arousalChange):
+            # without any changes the best transitions have been computed offline.
+            positions, scores = self.graph.neighbours(reference)
+            self.timings.mark(timer, "graph", len(positions))
+
+            # a snippet has fewer targets than the graph keeps only when it has no more candidates.
+            return (
+                positions,
+                scores,
+                np.float32(
+                    scores[-1]
+                    if len(positions) == self.graph.targets.shape[1]
+                    else np.inf
+                ),
+            )
+
+        candidates: np.ndarray = self.candidates(reference)
+        self.timings.mark(timer, "candidates", len(candidates))
+
+        return self.rankReference(
+            reference,
+            candidates,
+            tempoChange,
+            valenceChange,
+            arousalChange,
+            timer=timer,
+        )
+
+    def rankReference(
+        self,
+        reference: int,
+        positions: np.ndarray,
+        tempoChange: float = 0,
+        valenceChange: float = 0,
+        arousalChange: float = 0,
+        weights: List[float] = defaultWeights,
+        timer: Optional[Dict[Optional[str], Any]] = None,
+        penalties: Optional[np.ndarray] = None,
+        depth: int = musicQueryCacheDepth,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :reference: row position of the reference snippet
+        :positions: row positions of the candidates
+        :tempoChange: float representing the amount you want the tempo to change up or down
+        :valenceChange: float representing the amount the next match should change for valence
+        :arousalChange: float representing the amount the next match should change for arousal
+        :weights: importance of notes, tempo, noisiness, valence and arousal
+        :timer: optional timer of the query to mark the stages on, see databaseTimings
+        :penalties: optional float32 array with an amount to add to the score of every snippet
+        :depth: the number of candidates to keep
+        :return: the row positions and scores of the best candidates, best first, and the bound: the
+            lowest score any of the candidates that weren't kept has, infinite if all were kept
+        """
+
+        # then we score the candidates on the notes they have in common with the reference, normalized
+        # by the amount of notes they have, and on the ratio of their tempo, noisiness, valence and
+        # arousal to those of the reference. The lower the score, the closer the match.
+        scores: np.ndarray = self.scoring.scoreCandidates(
+            positions,
+            reference,
+            tempoChange,
+            valenceChange,
+            arousalChange,
+            weights,
+            penalties,
+        )
+        self.timings.mark(timer, "scoring", len(scores))
+
+        best: np.ndarray = self.scoring.selectTop(scores, depth)
+        self.timings.mark(timer, "select", len(best))
+
+        return (
+            positions[best],
+            scores[best],
+            np.float32(scores[best[-1]] if len(best) < len(scores) else np.inf),
+        )
+
+    def scoreReference(
+        self,
+        reference: int,
+        positions: np.ndarray,
+        tempoChange: float = 0,
+        valenceChange: float = 0,
+        arousalChange: float = 0,
+        weights: List[float] = defaultWeights,
+        timer: Optional[Dict[Optional[str], Any]] = None,
+        recency: Optional[Tuple[int, Optional[np.ndarray]]] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :reference: row position of the reference snippet
+        :positions: row positions of the candidates
+        :tempoChange: float representing the amount you want the tempo to change up or down
+        :valenceChange: float representing the amount the next match should change for valence
+        :arousalChange: float representing the amount the next match should change for arousal
+        :weights: importance of notes, tempo, noisiness, valence and arousal
+        :timer: optional timer of the query to mark the stages on, see databaseTimings
+        :recency: the generation and penalties to score with as returned by databaseRecency.state(),
+            None for the current ones
+        :return: the row positions and scores of the best candidates, best first
+        """
+
+        recency = recency or self.recency.state()
+
+        positions, scores, bound = self.rankReference(
+            reference,
+            positions,
+            tempoChange,
+            valenceChange,
+            arousalChange,
+            weights,
+            timer,
+            recency[1],
+            20,
+        )
+
+        # the result is a list of the best matches to the reference piece, of which the very best
+        # is left out.
+        return positions[1:], scores[1:]
+
+    def scoreReferenceUntil(
+        self,
+        reference: int,
+        positions: np.ndarray,
+        deadline: float,
+        tempoChange: float = 0,
+        valenceChange: float = 0,
+        arousalChange: float = 0,
+        timer: Optional[Dict[Optional[str], Any]] = None,
+        recency: Optional[Tuple[int, Optional[np.ndarray]]] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Version of scoreReference for large sets of candidates, which scores them in chunks of
+        musicSearchChunk and doesn't start another chunk once the deadline has passed.
+
+        :reference: row position of the reference snippet
+        :positions: row positions of the candidates, in ascending order
+        :deadline: the time.perf_counter() value after which no more chunks are scored
+        :tempoChange: float representing the amount you want the tempo to change up or down
+        :valenceChange: float representing the amount the next match should change for valence
+        :arousalChange: float representing the amount the next match should change for arousal
+        :timer: optional timer of the query to mark the stages on, see databaseTimings
+        :recency: the generation and penalties to score with as returned by databaseRecency.state(),
+            None for the current ones
+        :return: the row positions and scores of the best candidates that were scored, best first
+        """
+
+        recency = recency or self.recency.state()
+
+        if len(positions) <= musicSearchChunk:
+            return self.scoreReference(
+                reference,
+                positions,
+                tempoChange,
+                valenceChange,
+                arousalChange,
+                timer=timer,
+                recency=recency,
+            )
+
+        chunks: List[Tuple[np.ndarray, np.ndarray]] = []
+        for start in range(0, len(positions), musicSearchChunk):
+            if chunks and time.perf_counter() > deadline:
+                break
+
+            chunkPositions, chunkScores, bound = self.rankReference(
+                reference,
+                positions[start : start + musicSearchChunk],
+                tempoChange,
+                valenceChange,
+                arousalChange,
+                defaultWeights,
+                timer,
+                recency[1],
+                20,
+            )
+            chunks.append((chunkPositions, chunkScores))
+
+        # the best of every chunk are ranked once more, in the order of their positions so that ties are
+        # settled the way a single pass over all the candidates settles them.
+        merged: np.ndarray = np.concatenate([chunk[0] for chunk in chunks])
+        order: np.ndarray = np.argsort(merged, kind="stable")
+        merged = merged[order]
+        scores: np.ndarray = np.concatenate([chunk[1] for chunk in chunks])[order]
+
+        best: np.ndarray = self.scoring.selectTop(scores, 20)
+
+        # like scoreReference, the very best match is left out.
+        return merged[best][1:], scores[best][1:]
+
+    def nearestCandidates(
+        self,
+        reference: int,
+        weights: List[float],
+        changes: Tuple[float, float, float],
+        probes: int,
+    ) -> np.ndarray:
+        """
+        :reference: row position of the reference snippet
+        :weights: importance of notes, tempo, noisiness, valence and arousal
+        :changes: the tempo, valence and arousal change of the query
+        :probes: the number of clusters of the nearest-neighbour index to look in
+        :return: row positions of the snippets findNearestPiece scores, from the nearest-neighbour index
+            if it is up to date and the whole catalog otherwise
+        """
+
+        if self.ann.centroids is not None:
+            positions: np.ndarray = self.ann.search(
+                self.scoring, reference, weights, changes, probes
+            )
+        else:
+            positions = np.flatnonzero(~np.isnan(self.scoring.valence))
+
+        # don't return matches for the same piece
+        return positions[
+            self.index.primaryKeys[positions] != self.index.primaryKeys[reference]
+        ]
+
+    def candidates(self, reference: int) -> np.ndarray:
+        """
+        :reference: row position of the reference snippet
+        :return: row positions of the snippets that can follow the reference, before scoring
+        """
+
+        # the hard filters only depend on the instrumentation of the piece and on the dominant note
+        # (= musical key), so the candidates for every combination have been partitioned at load
+        # time, with the snippets that lack valence and arousal values already left out.
+        positions: np.ndarray = self.index.candidatePositions(
+            *self.candidateBlock(reference)
+        )
+
+        # don't return matches for the same piece
+        return positions[
+            self.index.primaryKeys[positions] != self.index.primaryKeys[reference]
+        ]
+
+    def memoryReport(self) -> TypeVar("pd.DataFrame"):
+        """
+        Breaks down the memory held by the loaded databases, per column of every table and per array of
+        the structures derived from them, so the footprint can be tracked across data releases. Memory
+        mapped arrays are counted at their full size, even though only the pages in use are resident.
+
+        :return: a dataframe with the table, column, dtype and size in bytes of everything held, largest first
+        """
+
+        rows: List[Dict[str, Any]] = []
+
+        # only the tables and columns that have been loaded so far are in memory.
+        for table, frame in self.tables.items():
+            for column, size in frame.memory_usage(index=True, deep=True).items():
+                dtype = frame.index.dtype if column == "Index" else frame[column].dtype
+                rows.append(
+                    {
+                        "table": table,
+                        "column": column,
+                        "dtype": str(dtype),
+                        "bytes": int(size),
+                    }
+                )
+
+        for mood, (moodRows, moodScores) in self.moods.entries.items():
+            rows.append(
+                {
+                    "table": "moods",
+                    "column": mood,
+                    "dtype": "sparse",
+                    "bytes": moodRows.nbytes + moodScores.nbytes,
+                }
+            )
+
+        # arrays shared between structures are only counted once.
+        counted: Set[int] = set()
+
+        for table, structure in (
+            ("index", self.index),
+            ("scoring", self.scoring),
+            ("graph", self.graph),
+            ("ann", self.ann),
+            ("projection", self.projection),
+        ):
+            for attribute, value in vars(structure).items():
+                if id(value) in counted:
+                    continue
+                counted.add(id(value))
+
+                if isinstance(value, np.ndarray):
+                    dtype, size = str(value.dtype), value.nbytes
+                elif isinstance(value, dict):
+                    dtype, size = "dict", sys.getsizeof(value)
+                else:
+                    continue
+
+                rows.append(
+                    {"table": table, "column": attribute, "dtype": dtype, "bytes": size}
+                )
+
+        report: TypeVar("pd.DataFrame") = pd.DataFrame(rows).sort_values(
+            "bytes", ascending=False, ignore_index=True
+        )
+
+        # perform logging operations
+        self.logger.info(f"memoryReport called - total bytes: {report['bytes'].sum()}")
+
+        return report
+
+    def markPlayed(self, primaryKey: int) -> None:
+        """
+        Registers that a piece has been played, the similarity search avoids it for the next
+        musicRecentPieces pieces.
+
+        :primaryKey: number representing the piece, as found in the PrimaryKeys column of the snippet database
+        """
+        self.recency.markPlayed(primaryKey)
+
+    def cacheInfo(self) -> Dict[str, int]:
+        """
+        :return: dict with the hits, misses, current size and maximum size of the query cache
+        """
+        return self.cache.info()
+
+    def timingReport(self, query: Optional[str] = None) -> TypeVar("pd.DataFrame"):
+        """
+        :query: the method to limit the report to, "findRelaxedPiece" covers all its levels while
+            "findRelaxedPiece:strict" covers one. None for all the queries.
+        :return: a dataframe with the number of queries, and the 50th, 95th and 99th percentile of the
+            time in milliseconds and of the rows that came out, of every stage of the last similarity
+            queries
+        """
+        return self.timings.report(query)
+
+    def slowestQueries(
+        self, n: int = 10, query: Optional[str] = None
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        :n: the number of queries to return
+        :query: the method to limit the queries to as in timingReport(), None for all the queries
+        :return: a dataframe with the method, the reference and the time in milliseconds of every stage
+            of the n slowest of the last similarity queries
+        """
+        return self.timings.slowest(n, query)
+
+    def usesGraph(
+        self, tempoChange: float = 0, valenceChange: float = 0, arousalChange: float = 0
+    ) -> bool:
+        """
+        :tempoChange: the tempo change of the query
+        :valenceChange: the valence change of the query
+        :arousalChange: the arousal change of the query
+        :return: True if the query can be answered from the transition graph
+        """
+
+        return self.graph.targets is not None and not (
+            tempoChange or valenceChange or arousalChange
+        )
+
+    def candidateBlock(self, reference: int) -> Tuple[Any, Any]:
+        """
+        :reference: row position of a snippet in the snippet database
+        :return: the (Instrument, DominantNoteMean) pair that selects the candidates for the snippet
+        """
+
+        row: int = self.index.pieceRows[reference]
+
+        # raise a KeyError if the piece isn't in the full database.
+        if row < 0:
+            raise KeyError(self.index.primaryKeys[reference])
+
+        return self.index.instruments[row], self.index.dominantNotes[reference]
+
+    def buildMatches(
+        self, positions: np.ndarray, scores: np.ndarray, mood: str
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        Turns the best matches of a similarity search into the dataframe that is returned to the caller.
+        Here we gather the moods of the music in order to give the user/program a choice about what
+        the next piece will be.
+
+        :positions: row positions of the matches, best first
+        :scores: the score of every match
+        :mood: string representing the mood we are currently looking for
+        :return: the rows of the matches with their score and mood, sorted from high mood awareness to low.
+        """
+
+        self.loadMoods([mood])
+
+        matches: TypeVar("pd.DataFrame") = self.snippetRows(positions).assign(
+            commonRatio=np.array(scores),
+            Moods=(self.moods.scoresAt(positions, mood) if len(positions) else []),
+        )
+
+        return matches.sort_values("Moods", ascending=False)
+
+    def gatherMoods(self, matchByKey: str, mood: str) -> TypeVar("pd.Series"):
         """
         This function takes the n most similar matches as calculated in the function findSimilarPiece and gathers the mood values for it.
 
-        :matchByKey: int representing the SecondaryKeys entry in the database
+        :matchByKey: string representing the SecondaryKeys entry in the database
         :mood: string representing which mood values to look for
         :return: a value representing the mood given for the piece specified by secondary key
         """
-        row: TypeVar("pd.Series") = self.df_snippets.loc[
-            self.df_snippets["SecondaryKeys"] == matchByKey
-        ]
+        position: int = self.index.positionBySecondaryKey(matchByKey)
 
         # perform logging operations
         self.logger.info(
             f"gatherMoods called - matchByKey: {matchByKey} and mood: {mood}"
         )
 
-        return row[mood].values[0]
+        self.loadMoods([mood])
 
-    def gatherValenceAndArousal(self, matchByKey: int) -> List[float]:
+        return self.moods.score(position, mood)
+
+    def gatherValenceAndArousal(self, matchByKey: str) -> List[float]:
         """
         This function takes the n most similar matches as calculated in the function findSimilarPiece and gathers the mood values for it.
 
-        :matchByKey: int representing the SecondaryKeys entry in the database
+        :matchByKey: string representing the SecondaryKeys entry in the database
         :return: a list containing 2 float values representing Valence and Arousal scores
         """
-        row: TypeVar("pd.Series") = self.df_snippets.loc[
-            self.df_snippets["SecondaryKeys"] == matchByKey
-        ]
+        position: int = self.index.positionBySecondaryKey(matchByKey)
 
         # perform logging operations
         self.logger.info(f"gatherValenceAndArousal called - matchByKey: {matchByKey}")
 
-        return [row["Valence"].values[0], row["Arousal"].values[0]]
+        return [self.scoring.valence[position], self.scoring.arousal[position]]
 
-    def gatherSnippets(self, match: str) -> List[str]:
+    def gatherSnippets(
+        self, match: Union[TypeVar("pd.DataFrame"), TypeVar("pd.Series")]
+    ) -> np.ndarray:
         """
-        For a given snippet, get all the filenames that come after it in the correct order.
+        For a given snippet, get all the filenames that come after it in the correct order. The snippets are
+        sorted by piece and bar number, so this is a slice of the FileNames column that doesn't copy anything.
 
-        :match: string representing the filename as found in the snippet database TODO
-        :returns: list that contains strings representing filenames of snippets as found in the snippet database
+        :match: single row dataframe or series, representing the snippet as found in the snippet database
+        :returns: array that contains strings representing filenames of snippets as found in the snippet database
         """
 
-        matchedSnippets: List[str] = []
-
-        # from this list we want to gather all the filenames of the snippets that follow our match and gather them in a list.
-        try:
-            matchedSecondaryKey: str = match["SecondaryKeys"].item()
-        except AttributeError:
-            matchedSecondaryKey: str = match["SecondaryKeys"]
+        # the match can come in as a single row dataframe or as a row of one.
+        if isinstance(match, pd.DataFrame):
+            match: TypeVar("pd.Series") = match.iloc[0]
 
+        matchedSecondaryKey: str = match["SecondaryKeys"]
         lookupKey: int = int(matchedSecondaryKey[-4:])
+        total: int = int(match["TotalSnippets"])
 
-        total: int = match["TotalSnippets"].item()
+        # get all the snippets following the match we found, up to the end of the piece.
+        position: int = self.index.positionBySecondaryKey(matchedSecondaryKey)
+        _, pieceEnd = self.index.snippetRange(match["PrimaryKeys"])
 
-        # get all the snippets following the match we found
-        for number in range(lookupKey, total):
-            matchSecondaryKey = (
-                f"{int(match['PrimaryKeys'].item())}_{str(number).zfill(4)}"
-            )
-            snippetToWrite = self.df_snippets.loc[
-                self.df_snippets["SecondaryKeys"] == matchSecondaryKey
-            ]
-            matchedSnippets.append(snippetToWrite["FileNames"].item())
+        matchedSnippets: np.ndarray = self.index.snippetFileNames(
+            position, min(pieceEnd, position + total - lookupKey)
+        )
 
         # perform logging operations
         self.logger.info(f"gatherSnippets called - match: {match}")
-        if matchedSnippets == 0:
+        if len(matchedSnippets) == 0:
             self.logger.warning(f"gatherSnippets called - no snippets found")
 
         return matchedSnippets
 
     def gatherData(self, referencePiece: str) -> None:
-
         """
         Gathers all relevant columns from the different databases and aggregates them in
         a dictionary 'self.referencePiece'
@@ -301,29 +1859,25 @@ class databaseMain:
         :referencePiece: string reference to the filename as it is found in the snippet database
         """
 
-        referenceLocationSnippet: TypeVar("pd.DataFrame") = self.df_snippets.loc[
-            self.df_snippets["FileNames"] == referencePiece
-        ]
+        referenceLocationSnippet: TypeVar("pd.Series") = self.snippetRows(
+            [self.index.positionByFileName(referencePiece)]
+        ).iloc[0]
         self.referencePiece: Dict[str, Union[str, int]] = {
             "filename": referencePiece,
-            "PrimaryKey": referenceLocationSnippet["PrimaryKeys"].values[0],
-            "Duration": referenceLocationSnippet["Duration"].values[0],
-            "NoisinessMedian": referenceLocationSnippet["NoisinessMedian"].values[0],
-            "TempoMean": referenceLocationSnippet["TempoMean"].values[0],
-            "DensityNotes": referenceLocationSnippet["DensityNotes"].values[0],
-            "Notes": referenceLocationSnippet["Notes"].values[0],
-            "UniqueNotes": referenceLocationSnippet["UniqueNotes"].values[0],
-            "DominantNoteMean": referenceLocationSnippet["DominantNoteMean"].values[0],
-            "Valence": referenceLocationSnippet["Valence"].values[0],
-            "Arousal": referenceLocationSnippet["Arousal"].values[0],
+            "PrimaryKey": referenceLocationSnippet["PrimaryKeys"],
+            "Duration": referenceLocationSnippet["Duration"],
+            "NoisinessMedian": referenceLocationSnippet["NoisinessMedian"],
+            "TempoMean": referenceLocationSnippet["TempoMean"],
+            "DensityNotes": referenceLocationSnippet["DensityNotes"],
+            "Notes": referenceLocationSnippet["Notes"],
+            "UniqueNotes": referenceLocationSnippet["UniqueNotes"],
+            "DominantNoteMean": referenceLocationSnippet["DominantNoteMean"],
+            "Valence": referenceLocationSnippet["Valence"],
+            "Arousal": referenceLocationSnippet["Arousal"],
         }
 
-        referenceLocationFull: TypeVar("pd.DataFrame") = self.df_full.loc[
-            self.df_full["PrimaryKey"] == self.referencePiece["PrimaryKey"]
-        ]
-
-        self.referencePiece["Instrument"] = referenceLocationFull["Instrument"].values[
-            0
+        self.referencePiece["Instrument"] = self.index.instruments[
+            self.index.positionByPrimaryKey(self.referencePiece["PrimaryKey"])
         ]
 
         # perform logging operations
@@ -332,18 +1886,33 @@ class databaseMain:
 
     def matchCounters(self, toMatch: str) -> int:
         """
-        This method is used in formatting string entries from the .csv files using pure voodoo.
-        Afterwards it actually calculates the amount of matching notes (and thus harmonic context)
+        This method parses a string entry of the notes column from the .csv files into a histogram of
+        pitch classes. Afterwards it actually calculates the amount of matching notes (and thus harmonic
+        context) with the reference piece of the last findSimilarPiece call.
 
-        :toMatch: string representation of the notes column in the datbase snippets database TODO
-        :return: sum of the commonly present notes TODO
+        :toMatch: string representation of the notes column in the datbase snippets database
+        :return: sum of the commonly present notes
         """
-        toCount: List[int] = ast.literal_eval(toMatch)
-        toCount = [int(x) for x in toCount]
-        toCount = Counter(toCount)
+        toCount: np.ndarray = self.index.noteHistogram(toMatch)
 
         # perform logging operations
         self.logger.info(f"matchCounters called - toMatch: {toMatch}")
         self.logger.debug(f"matchCounters called - toCount: {toCount}")
 
-        return sum((self.notesRef & toCount).values())
+        return int(np.minimum(self.notesRef, toCount).sum())
+
+    def commonNotes(self, referencePiece: str, toMatch: str) -> int:
+        """
+        Thread-safe version of matchCounters, the reference is passed in rather than taken from the
+        last findSimilarPiece call.
+
+        :referencePiece: string that represents the filename as it occurs in the snippet database
+        :toMatch: string representation of the notes column in the datbase snippets database
+        :return: sum of the notes present in both
+        """
+
+        notesRef: np.ndarray = self.index.noteHistograms[
+            self.index.positionByFileName(referencePiece)
+        ]
+
+        return int(np.minimum(notesRef, self.index.noteHistogram(toMatch)).sum())
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+
+class databaseMoods:
+    """
+    databaseMoods holds the mood scores of the snippet database sparsely. Most snippets only have a
+    score for one or two of the moods, so rather than a column per mood that is mostly NaN, every mood
+    is stored as the row positions of the snippets that have a score for it together with those scores.
+
+    ...
+
+    Attributes
+    ----------
+    size : int
+        number of snippets in the snippet database.
+
+    entries : Dict
+        maps every mood to a pair of arrays, the sorted int32 row positions of the snippets that have
+        a score for the mood and their float32 scores.
+
+    Methods
+    -------
+    addMood() :
+        stores the populated entries of a dense mood column.
+
+    addScores() :
+        stores the populated entries of a mood as they are.
+
+    appendRows() :
+        adds the scores of snippets appended to the snippet database.
+
+    moodScores() :
+        returns the row positions and scores for a mood.
+
+    score() :
+        looks up the score of a single snippet for a mood.
+
+    scoresAt() :
+        looks up the scores of several snippets for a mood.
+
+    """
+
+    def __init__(self, size: int) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.size: int = size
+        self.entries: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+    def addMood(self, mood: str, column: TypeVar("pd.Series")) -> None:
+        """
+        :mood: string representing the mood
+        :column: the dense mood column, in the row order of the snippet database
+        """
+
+        values: np.ndarray = column.to_numpy(dtype=np.float32)
+        rows: np.ndarray = np.flatnonzero(~np.isnan(values)).astype(np.int32)
+
+        self.addScores(mood, rows, values[rows])
+
+    def addScores(self, mood: str, rows: np.ndarray, scores: np.ndarray) -> None:
+        """
+        :mood: string representing the mood
+        :rows: int32 row positions of the snippets that have a score for the mood, ascending
+        :scores: float32 scores of those snippets
+        """
+
+        self.entries[mood] = (rows, scores)
+
+        # perform logging operations
+        self.logger.debug(f"addScores called - mood: {mood}, entries: {len(rows)}")
+
+    def appendRows(self, df_snippets: TypeVar("pd.DataFrame")) -> None:
+        """
+        Adds the scores of new snippets for the moods that are stored, the snippets are appended after
+        all the current rows so the row positions stay sorted.
+
+        :df_snippets: the new snippets, with the mood columns
+        """
+
+        for mood, (rows, scores) in self.entries.items():
+            if mood not in df_snippets.columns:
+                continue
+
+            values: np.ndarray = df_snippets[mood].to_numpy(dtype=np.float32)
+            found: np.ndarray = np.flatnonzero(~np.isnan(values))
+
+            self.entries[mood] = (
+                np.concatenate([rows, (found + self.size).astype(np.int32)]),
+                np.concatenate([scores, values[found]]),
+            )
+
+        self.size += len(df_snippets)
+
+    def moodScores(self, mood: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :mood: string representing the mood
+        :return: the row positions of the snippets with a score for the mood, ascending, and their
+            scores. Raises a KeyError if the mood isn't stored.
+        """
+        return self.entries[mood]
+
+    def score(self, position: int, mood: str) -> np.float32:
+        """
+        :position: row position of the snippet in the snippet database
+        :mood: string representing the mood
+        :return: the score of the snippet for the mood, NaN if it has none
+        """
+
+        rows, scores = self.entries[mood]
+        found: int = int(np.searchsorted(rows, position))
+
+        if found < len(rows) and rows[found] == position:
+            return scores[found]
+
+        return np.float32(np.nan)
+
+    def scoresAt(self, positions: np.ndarray, mood: str) -> np.ndarray:
+        """
+        :positions: row positions of snippets in the snippet database
+        :mood: string representing the mood
+        :return: float32 array with the score of every snippet for the mood, NaN where it has none
+        """
+
+        rows, scores = self.entries[mood]
+        result: np.ndarray = np.full(len(positions), np.nan, dtype=np.float32)
+
+        if len(rows) == 0:
+            return result
+
+        found: np.ndarray = np.minimum(np.searchsorted(rows, positions), len(rows) - 1)
+        present: np.ndarray = rows[found] == positions
+        result[present] = scores[found[present]]
+
+        return result
@@ -0,0 +1,477 @@
+import os
+import math
+import json
+import shutil
+from threading import Lock
+import numpy as np
+import pandas as pd
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from Settings.Settings import musicProjectionDataBaseURL, musicProjectionURL
+from thePlayer.databaseSnapshot import databaseSnapshot, snapshotTables
+
+# version of the layout of the grid, bump it whenever the way it is built or stored changes.
+projectionVersion: int = 1
+
+# the columns of the projection .csv file: the snippet and its x and y coordinate in the projection.
+projectionColumns: List[str] = ["FileNames", "x", "y"]
+
+# the average number of snippets per cell of the grid.
+projectionPointsPerCell: int = 8
+
+# the arrays of the grid as they are written to disk, the origin, cell size and shape go in "grid".
+projectionArrays: List[str] = [
+    "coordinates",
+    "grid",
+    "cellOffsets",
+    "cellPositions",
+    "cellPoints",
+    "cellKeys",
+]
+
+
+class databaseProjection:
+    """
+    databaseProjection is a spatial index over the 2D UMAP projection of the snippets, see README-DATA.
+    Musical attributes such as the tempo or the chord voicing change along a direction in the projection,
+    so moving from one snippet to the next in a chosen direction steers the music that way.
+
+    The coordinates are read from a .csv file with the FileNames of the snippets and their x and y
+    coordinate, snippets that aren't in it are left out. The projection is covered by a uniform grid of
+    square cells, and the snippets are stored sorted by cell so the snippets of a cell are one slice.
+    A search walks the rings of cells around the cell of the reference outwards, skipping the cells that
+    lie outside the cone, until no cell that is left can hold a closer match.
+
+    The grid is built offline and written as .npy files next to a manifest, like the nearest-neighbour
+    index, and memory mapped the first time a directional search needs it.
+
+    ...
+
+    Attributes
+    ----------
+    coordinates : np.ndarray
+        (n_snippets x 2) float32 coordinates of every snippet, NaN for the snippets without one. None
+        until the grid is loaded, or if there is no up to date grid.
+
+    origin : np.ndarray
+        the lower left corner of the grid.
+
+    cellSize : float
+        width and height of a cell.
+
+    shape : Tuple[int, int]
+        number of cells along x and along y.
+
+    cellOffsets : np.ndarray
+        offset table of the cells, the snippets of cell (i, j) are at
+        cellOffsets[i * shape[1] + j]:cellOffsets[i * shape[1] + j + 1].
+
+    cellPositions, cellPoints, cellKeys : np.ndarray
+        row position, coordinates and PrimaryKeys of the snippets, sorted by cell.
+
+    primaryKeys : np.ndarray
+        PrimaryKeys of every snippet, to leave out the piece of the reference.
+
+    loaded : bool
+        True once load() has run, whether or not there was a grid to load.
+
+    Methods
+    -------
+    build() :
+        reads the coordinates, builds the grid and writes it to disk.
+
+    load() :
+        memory maps the grid the first time it is called, if it is up to date.
+
+    unload() :
+        forgets the grid, so the next load() reads it again.
+
+    isStale() :
+        checks whether the grid is missing or was built from other data.
+
+    stamp() :
+        returns everything the content of the grid depends on.
+
+    grid() :
+        builds the grid from the coordinates of the snippets.
+
+    cellOf() :
+        returns the cell points lie in.
+
+    cone() :
+        returns the snippets closest to a reference, within a cone around a direction.
+
+    ringCells() :
+        returns the cells of the rings around a cell that overlap with a cone.
+
+    """
+
+    def __init__(
+        self,
+        projectionURL: str = musicProjectionURL,
+        sourceURL: str = musicProjectionDataBaseURL,
+    ) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.projectionURL: str = projectionURL
+        self.manifestURL: str = os.path.join(projectionURL, "manifest.json")
+        self.sourceURL: str = sourceURL
+        self.lock: Lock = Lock()
+
+        self.unload()
+
+    def build(self, database: object) -> None:
+        """
+        :database: a loaded databaseMain object
+        """
+
+        index: object = database.index
+        size: int = len(index.primaryKeys)
+
+        df_projection: TypeVar("pd.DataFrame") = pd.read_csv(
+            self.sourceURL, usecols=projectionColumns
+        )
+
+        rows: np.ndarray = pd.Index(index.snippetFileNames(0, size)).get_indexer(
+            df_projection[projectionColumns[0]]
+        )
+
+        coordinates: np.ndarray = np.full((size, 2), np.nan, dtype=np.float32)
+        coordinates[rows[rows >= 0]] = df_projection.loc[
+            rows >= 0, projectionColumns[1:]
+        ].to_numpy(dtype=np.float32)
+
+        arrays: Dict[str, np.ndarray] = self.grid(coordinates, index.primaryKeys)
+
+        tmpURL: str = self.projectionURL + ".tmp"
+        if os.path.isdir(tmpURL):
+            shutil.rmtree(tmpURL)
+        os.makedirs(tmpURL)
+
+        for name in projectionArrays:
+            np.save(os.path.join(tmpURL, name + ".npy"), arrays[name])
+
+        with open(os.path.join(tmpURL, "manifest.json"), "w") as f:
+            json.dump(self.stamp(size), f, indent=2)
+
+        if os.path.isdir(self.projectionURL):
+            shutil.rmtree(self.projectionURL)
+        os.replace(tmpURL, self.projectionURL)
+
+        # perform logging operations
+        self.logger.info(
+            f"build called - {len(arrays['cellPositions'])} of {size} snippets in a {arrays['grid'][3]:.0f}x{arrays['grid'][4]:.0f} grid written"
+        )
+
+    def load(self, index: object) -> bool:
+        """
+        Memory maps the grid the first time it is called, unless it is stale. Later calls return right
+        away, also when there was no grid to load.
+
+        :index: the database index of the loaded database
+        :return: True if the grid is loaded
+        """
+
+        if self.loaded:
+            return self.coordinates is not None
+
+        with self.lock:
+            if self.loaded:
+                return self.coordinates is not None
+
+            if self.isStale(len(index.primaryKeys)):
+                self.logger.warning(
+                    f"load called - projection grid missing or stale, rebuild it with 'python -m thePlayer.databaseBuild', directional search unavailable"
+                )
+            else:
+                arrays: Dict[str, np.ndarray] = {
+                    name: np.load(
+                        os.path.join(self.projectionURL, name + ".npy"), mmap_mode="r"
+                    )
+                    for name in projectionArrays
+                }
+
+                self.origin = np.array(arrays["grid"][:2], dtype=np.float32)
+                self.cellSize = float(arrays["grid"][2])
+                self.shape = (int(arrays["grid"][3]), int(arrays["grid"][4]))
+                self.cellOffsets = arrays["cellOffsets"]
+                self.cellPositions = arrays["cellPositions"]
+                self.cellPoints = arrays["cellPoints"]
+                self.cellKeys = arrays["cellKeys"]
+                self.primaryKeys = index.primaryKeys
+                self.coordinates = arrays["coordinates"]
+
+                # perform logging operations
+                self.logger.info(
+                    f"load called - {len(self.cellPositions)} snippets in a {self.shape[0]}x{self.shape[1]} grid"
+                )
+
+            self.loaded = True
+
+        return self.coordinates is not None
+
+    def unload(self) -> None:
+        """
+        Forgets the grid, the next call to load() reads it from disk again.
+        """
+
+        self.coordinates: Optional[np.ndarray] = None
+        self.origin: Optional[np.ndarray] = None
+        self.cellSize: float = 1.0
+        self.shape: Tuple[int, int] = (0, 0)
+        self.cellOffsets: Optional[np.ndarray] = None
+        self.cellPositions: Optional[np.ndarray] = None
+        self.cellPoints: Optional[np.ndarray] = None
+        self.cellKeys: Optional[np.ndarray] = None
+        self.primaryKeys: Optional[np.ndarray] = None
+        self.loaded: bool = False
+
+    def isStale(self, size: int) -> bool:
+        """
+        :size: number of snippets in the loaded snippet database
+        :return: True if there is no grid, or it was built from other data
+        """
+
+        try:
+            with open(self.manifestURL) as f:
+                manifest: Dict[str, Any] = json.load(f)
+        except (OSError, ValueError):
+            return True
+
+        return not os.path.isfile(self.sourceURL) or manifest != self.stamp(size)
+
+    def stamp(self, size: int) -> Dict[str, Any]:
+        """
+        :size: number of snippets in the snippet database
+        :return: everything the content of the grid depends on
+        """
+
+        snapshot: object = databaseSnapshot()
+
+        return {
+            "version": projectionVersion,
+            "rows": size,
+            "sources": [
+                (snapshot.sourceStamp(sourceURL) if os.path.isfile(sourceURL) else None)
+                for sourceURL in (snapshotTables["snippets"][0], self.sourceURL)
+            ],
+        }
+
+    def grid(
+        self, coordinates: np.ndarray, primaryKeys: np.ndarray
+    ) -> Dict[str, np.ndarray]:
+        """
+        :coordinates: (n_snippets x 2) coordinates of every snippet, NaN for the snippets without one
+        :primaryKeys: PrimaryKeys of every snippet
+        :return: the arrays of the grid by their name in projectionArrays
+        """
+
+        positions: np.ndarray = np.flatnonzero(~np.isnan(coordinates).any(axis=1))
+        points: np.ndarray = coordinates[positions]
+
+        if len(positions):
+            origin: np.ndarray = points.min(axis=0)
+            extent: np.ndarray = np.maximum(points.max(axis=0) - origin, 1e-6)
+        else:
+            origin = np.zeros(2, dtype=np.float32)
+            extent = np.ones(2, dtype=np.float32)
+
+        # square cells, sized so there are projectionPointsPerCell snippets in a cell on average.
+        self.origin = origin
+        self.cellSize = float(
+            np.sqrt(extent.prod() * projectionPointsPerCell / max(len(positions), 1))
+        )
+        self.shape = tuple(
+            int(cells) for cells in np.floor(extent / self.cellSize).astype(int) + 1
+        )
+
+        cells: np.ndarray = self.cellOf(points)
+        order: np.ndarray = np.argsort(cells, kind="stable")
+
+        cellOffsets: np.ndarray = np.zeros(
+            self.shape[0] * self.shape[1] + 1, dtype=np.int64
+        )
+        np.cumsum(
+            np.bincount(cells, minlength=self.shape[0] * self.shape[1]),
+            out=cellOffsets[1:],
+        )
+        cellPositions: np.ndarray = positions[order].astype(np.int32)
+
+        return {
+            "coordinates": coordinates,
+            "grid": np.array([*origin, self.cellSize, *self.shape], dtype=np.float64),
+            "cellOffsets": cellOffsets,
+            "cellPositions": cellPositions,
+            "cellPoints": np.ascontiguousarray(points[order]),
+            "cellKeys": np.asarray(primaryKeys)[cellPositions],
+        }
+
+    def cellOf(self, points: np.ndarray) -> np.ndarray:
+        """
+        :points: (n x 2) coordinates
+        :return: the number of the cell every point lies in
+        """
+
+        cells: np.ndarray = np.floor((points - self.origin) / self.cellSize).astype(
+            np.int64
+        )
+        np.clip(cells, 0, np.array(self.shape) - 1, out=cells)
+
+        return cells[:, 0] * self.shape[1] + cells[:, 1]
+
+    def cone(
+        self,
+        reference: int,
+        direction: Tuple[float, float],
+        angle: float,
+        count: int,
+        penalties: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :reference: row position of the reference snippet
+        :direction: the x and y of the direction to move in
+        :angle: the largest angle in degrees between the direction and a match, seen from the reference
+        :count: the number of matches to return
+        :penalties: optional float32 array with an amount to add to the distance of every snippet of the
+            database
+        :return: the row positions and distances of the closest snippets in the cone, closest first.
+            Snippets of the same piece as the reference are left out.
+        """
+
+        empty: Tuple[np.ndarray, np.ndarray] = (
+            np.array([], dtype=np.int64),
+            np.array([], dtype=np.float32),
+        )
+
+        if (
+            reference >= len(self.coordinates)
+            or np.isnan(self.coordinates[reference]).any()
+        ):
+            return empty
+
+        unit: np.ndarray = np.asarray(direction, dtype=np.float64)
+        if not np.hypot(*unit) > 0:
+            raise ValueError(f"cone called - direction {direction} has no length")
+        unit /= np.hypot(*unit)
+
+        point: np.ndarray = self.coordinates[reference].astype(np.float64)
+        center: Tuple[int, int] = divmod(
+            int(self.cellOf(point[np.newaxis])[0]), self.shape[1]
+        )
+        cosine: float = math.cos(math.radians(min(angle, 180)))
+
+        positions: np.ndarray = empty[0]
+        distances: np.ndarray = empty[1]
+
+        # the rings are searched in batches that double in width, so a search far out takes a few
+        # steps rather than one per ring. The first batch reaches as far as count snippets would be at
+        # the average density of the grid.
+        inner: int = 0
+        outer: int = 2 + int(
+            math.sqrt(
+                count / projectionPointsPerCell / math.radians(min(max(angle, 1), 180))
+            )
+        )
+
+        while inner < max(self.shape):
+            # every snippet in these rings or further out is at least this far from the reference.
+            if len(distances) >= count and distances[-1] <= (inner - 1) * self.cellSize:
+                break
+
+            cells: np.ndarray = self.ringCells(center, inner, outer, point, unit, angle)
+            inner, outer = outer, outer * 2
+
+            # the cone and the grid are both convex, once the rings have no cell in both neither has
+            # any ring further out.
+            if not len(cells):
+                break
+
+            # the snippets of all the cells in one go, as the concatenation of their slices.
+            starts: np.ndarray = self.cellOffsets[cells]
+            lengths: np.ndarray = self.cellOffsets[cells + 1] - starts
+            if not lengths.sum():
+                continue
+            rows: np.ndarray = np.repeat(
+                starts - np.cumsum(lengths) + lengths, lengths
+            ) + np.arange(lengths.sum())
+
+            vectors: np.ndarray = self.cellPoints[rows] - point
+            ringDistances: np.ndarray = np.hypot(vectors[:, 0], vectors[:, 1])
+            inside: np.ndarray = (
+                (vectors @ unit >= ringDistances * cosine)
+                & (ringDistances > 0)
+                & (self.cellKeys[rows] != self.primaryKeys[reference])
+            )
+
+            ringPositions: np.ndarray = self.cellPositions[rows[inside]]
+            ringDistances = ringDistances[inside].astype(np.float32)
+            if penalties is not None:
+                ringDistances += penalties[ringPositions]
+
+            positions = np.concatenate([positions, ringPositions])
+            distances = np.concatenate([distances, ringDistances])
+
+            best: np.ndarray = np.argsort(distances, kind="stable")[:count]
+            positions, distances = positions[best], distances[best]
+
+        return positions, distances
+
+    def ringCells(
+        self,
+        center: Tuple[int, int],
+        inner: int,
+        outer: int,
+        point: np.ndarray,
+        unit: np.ndarray,
+        angle: float,
+    ) -> np.ndarray:
+        """
+        :center: the column and row of the cell of the reference
+        :inner: the distance in cells to the center of the first ring, 0 for the center cell itself
+        :outer: the distance in cells to the center of the ring after the last one
+        :point: coordinates of the reference
+        :unit: the direction of the cone, of length 1
+        :angle: half the opening angle of the cone in degrees
+        :return: the numbers of the cells of the rings that lie within the grid and overlap with the cone
+        """
+
+        # the square around the center cut down to the grid, without the rings inside the first one.
+        i, j = center
+        columns, rows = np.meshgrid(
+            np.arange(max(i - outer + 1, 0), min(i + outer, self.shape[0])),
+            np.arange(max(j - outer + 1, 0), min(j + outer, self.shape[1])),
+            indexing="ij",
+        )
+        columns, rows = columns.ravel(), rows.ravel()
+        inRings: np.ndarray = np.maximum(np.abs(columns - i), np.abs(rows - j)) >= inner
+        columns, rows = columns[inRings], rows[inRings]
+
+        # a cell overlaps with the cone when the angle to its center is within the angle of the cone
+        # plus the angle the cell itself spans, as seen from the reference. A cell the reference may
+        # lie in spans every angle.
+        centers: np.ndarray = (
+            self.origin + (np.column_stack([columns, rows]) + 0.5) * self.cellSize
+        ) - point
+        lengths: np.ndarray = np.maximum(np.hypot(centers[:, 0], centers[:, 1]), 1e-12)
+        halfDiagonal: float = self.cellSize / np.sqrt(2)
+        spans: np.ndarray = np.where(
+            lengths > halfDiagonal,
+            np.arcsin(np.minimum(halfDiagonal / lengths, 1)),
+            np.pi,
+        )
+        angles: np.ndarray = np.arccos(np.clip(centers @ unit / lengths, -1, 1))
+        overlaps: np.ndarray = angles <= math.radians(min(angle, 180)) + spans
+
+        return columns[overlaps] * self.shape[1] + rows[overlaps]
+
+
+if __name__ == "__main__":
+
+    # build the grid from the current database, run from the root of the repo with:
+    # python -m thePlayer.databaseProjection
+    from thePlayer.databaseMain import databaseMain
+
+    logging.basicConfig(level=logging.INFO)
+    databaseProjection().build(databaseMain(backend="pandas", rebuild=False))
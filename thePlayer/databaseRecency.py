@@ -0,0 +1,184 @@
+from threading import Lock
+import numpy as np
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from Settings.Settings import musicRecentPieces, musicRecencyPenalty
+
+
+class databaseRecency:
+    """
+    databaseRecency keeps track of the pieces that have been played recently, so the similarity search
+    can avoid repeating them. Every piece gets the generation in which it was last played, and every
+    snippet of a piece that is still within the window carries a penalty that the scoring pass adds to
+    its score.
+
+    The snippet database is sorted by piece, so marking or expiring a piece sets one contiguous range
+    of the penalty array.
+
+    The arrays are never changed in place: marking a piece writes new ones and swaps them in under a
+    lock, so a query that runs at the same time keeps scoring against the penalties it started with.
+
+    ...
+
+    Attributes
+    ----------
+    window : int
+        number of pieces played after a piece before it is no longer penalized.
+
+    penalty : float
+        amount added to the score of the snippets of a recent piece, the lower the score the closer
+        the match so these end up behind all the others.
+
+    generation : int
+        number of pieces played so far.
+
+    played : np.ndarray
+        the generation in which every piece was last played, 0 if it hasn't been, indexed by the piece
+        number of the database index.
+
+    snippetPenalties : np.ndarray
+        float32 penalty of every snippet, in the row order of the snippet database.
+
+    Methods
+    -------
+    markPlayed() :
+        registers that a piece has been played.
+
+    setPenalty() :
+        sets the penalty of all the snippets of a piece.
+
+    penalties() :
+        returns the penalty array, or None if no piece is penalized.
+
+    state() :
+        returns the generation and the penalty array that go with it.
+
+    clear() :
+        forgets all played pieces.
+
+    resize() :
+        grows the arrays after pieces have been added to the database index.
+
+    """
+
+    def __init__(
+        self,
+        index: object,
+        window: int = musicRecentPieces,
+        penalty: float = musicRecencyPenalty,
+    ) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.index: object = index
+        self.window: int = window
+        self.penalty: float = penalty
+        self.lock: Lock = Lock()
+
+        self.generation: int = 0
+        self.played: np.ndarray = np.zeros(len(index.pieceOffsets) - 1, dtype=np.int64)
+        self.snippetPenalties: np.ndarray = np.zeros(
+            len(index.primaryKeys), dtype=np.float32
+        )
+
+    def markPlayed(self, primaryKey: int) -> None:
+        """
+        Penalizes the snippets of the piece, and lifts the penalty of the pieces that have dropped out of
+        the window.
+
+        :primaryKey: number representing the piece, as found in the PrimaryKeys column of the snippet database
+        """
+
+        number: Optional[int] = self.index.pieceNumbers.get(primaryKey)
+
+        with self.lock:
+            generation: int = self.generation + 1
+            played: np.ndarray = self.played.copy()
+            snippetPenalties: np.ndarray = self.snippetPenalties.copy()
+
+            if number is not None and self.window > 0:
+                played[number] = generation
+                self.setPenalty(snippetPenalties, number, self.penalty)
+
+            expired: np.ndarray = np.flatnonzero(
+                (played > 0) & (played <= generation - self.window)
+            )
+            for number in expired.tolist():
+                played[number] = 0
+                self.setPenalty(snippetPenalties, number, 0)
+
+            self.played, self.snippetPenalties = played, snippetPenalties
+            self.generation = generation
+
+        # perform logging operations
+        self.logger.info(
+            f"markPlayed called - primaryKey: {primaryKey}, generation: {generation}"
+        )
+
+    def setPenalty(
+        self, snippetPenalties: np.ndarray, number: int, penalty: float
+    ) -> None:
+        """
+        :snippetPenalties: the penalty array to write to
+        :number: number of the piece in the offset table of the database index
+        :penalty: the penalty for all the snippets of the piece
+        """
+        snippetPenalties[
+            self.index.pieceOffsets[number] : self.index.pieceOffsets[number + 1]
+        ] = penalty
+
+    def penalties(self) -> Optional[np.ndarray]:
+        """
+        :return: the float32 penalty of every snippet, or None when no piece is penalized and the
+            scoring pass can skip it
+        """
+
+        return self.state()[1]
+
+    def state(self) -> Tuple[int, Optional[np.ndarray]]:
+        """
+        :return: the generation and the penalty array of that generation as returned by penalties(),
+            read together so a piece marked in between can't pair one with the other
+        """
+
+        with self.lock:
+            return (
+                self.generation,
+                self.snippetPenalties if self.played.any() else None,
+            )
+
+    def clear(self) -> None:
+        """
+        Forgets all played pieces.
+        """
+
+        with self.lock:
+            self.generation = 0
+            self.played = np.zeros_like(self.played)
+            self.snippetPenalties = np.zeros_like(self.snippetPenalties)
+
+    def resize(self) -> None:
+        """
+        Grows the arrays to the size of the database index, the new pieces and snippets are appended
+        after the current ones and haven't been played yet.
+        """
+
+        with self.lock:
+            self.played = np.concatenate(
+                [
+                    self.played,
+                    np.zeros(
+                        len(self.index.pieceOffsets) - 1 - len(self.played), np.int64
+                    ),
+                ]
+            )
+            self.snippetPenalties = np.concatenate(
+                [
+                    self.snippetPenalties,
+                    np.zeros(
+                        len(self.index.primaryKeys) - len(self.snippetPenalties),
+                        np.float32,
+                    ),
+                ]
+            )
@@ -0,0 +1,582 @@
+import os
+import json
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from Settings.Settings import musicSQLiteURL
+from thePlayer.databaseSnapshot import databaseSnapshot, snapshotTables
+
+# version of the layout of the SQLite file, bump it whenever the tables or indexes below change.
+sqliteVersion: int = 1
+
+# the indexes on the snippet table. The last one covers the candidate lookup of the similarity search, the
+# instrument of the piece is stored with every snippet for it.
+sqliteIndexes: Dict[str, str] = {
+    "snippetsSecondaryKeys": "snippets (SecondaryKeys)",
+    "snippetsFileNames": "snippets (FileNames)",
+    "snippetsPrimaryKeys": "snippets (PrimaryKeys)",
+    "snippetsCandidates": "snippets (Instrument, DominantNoteMean) WHERE Valence IS NOT NULL",
+    "piecesPrimaryKey": "pieces (PrimaryKey)",
+}
+
+# the lookups are always run with the same sql and their values as parameters, so sqlite compiles every
+# statement once and reuses it from the statement cache of the connection.
+selectPositionBySecondaryKey: str = (
+    "SELECT position FROM snippets WHERE SecondaryKeys = ? ORDER BY position LIMIT 1"
+)
+selectPositionByFileName: str = (
+    "SELECT position FROM snippets WHERE FileNames = ? ORDER BY position LIMIT 1"
+)
+selectPositionByPrimaryKey: str = (
+    "SELECT position FROM pieces WHERE PrimaryKey = ? ORDER BY position LIMIT 1"
+)
+selectCandidates: str = (
+    "SELECT position FROM snippets WHERE Instrument = ? AND DominantNoteMean = ? "
+    "AND Valence IS NOT NULL ORDER BY position"
+)
+selectFileNames: str = (
+    "SELECT FileNames FROM snippets WHERE position >= ? AND position < ? ORDER BY position"
+)
+selectMoodScores: str = (
+    "SELECT position, score FROM moods WHERE mood = ? ORDER BY position"
+)
+
+
+class databaseSQLite:
+    """
+    databaseSQLite stores the music database in a local SQLite file, as an alternative to holding the
+    tables in pandas. Only the numeric features the similarity search scores on are read into memory,
+    the text columns and the lookups by key are served from the file through its indexes.
+
+    A connection can only be used by one thread at a time, so every thread that reads from the file
+    opens a read-only connection of its own the first time it does.
+
+    Rows of the snippet table are stored with their position in the sorted snippet database, so the
+    positions used everywhere else in thePlayer are the same for both backends. The mood scores are
+    stored sparsely, one row per snippet that has a score for a mood.
+
+    ...
+
+    Attributes
+    ----------
+    sqliteURL : str
+        path to the SQLite file
+
+    meta : Dict
+        the version, sources, columns and dtypes the file was written with.
+
+    connection : sqlite3.Connection
+        the read-only connection of the calling thread.
+
+    Methods
+    -------
+    build() :
+        writes the tables of a loaded databaseMain to the SQLite file.
+
+    connect() :
+        opens the SQLite file for reading.
+
+    isStale() :
+        checks whether the file is missing or was built from other data.
+
+    stamp() :
+        returns everything the content of the file depends on.
+
+    features() :
+        reads the numeric columns the similarity search needs.
+
+    pieces() :
+        reads the primary keys and instruments of the full database.
+
+    snippetRows() :
+        reads rows of the snippet table as a dataframe.
+
+    positionBySecondaryKey(), positionByFileName(), positionByPrimaryKey() :
+        indexed lookups of a row position by key.
+
+    candidatePositions() :
+        indexed lookup of the candidates for an instrument and dominant note.
+
+    blockPositions() :
+        indexed lookup of the candidates for several instruments and dominant notes.
+
+    fileNames() :
+        reads the filenames of a range of rows.
+
+    moodScores() :
+        reads the sparse scores of a mood.
+
+    """
+
+    def __init__(self, sqliteURL: str = musicSQLiteURL) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.sqliteURL: str = sqliteURL
+        self.connections: threading.local = threading.local()
+        self.meta: Optional[Dict[str, Any]] = None
+
+    def build(self, database: object) -> None:
+        """
+        Writes the snippet and full tables and the mood scores of a loaded databaseMain to the SQLite file.
+        The file is first written next to the target and only moved in place once complete.
+
+        :database: a databaseMain object with the pandas backend
+        """
+
+        # the rows as the queries return them, with the keys and filenames as text.
+        df_snippets: TypeVar("pd.DataFrame") = database.snippetRows(
+            np.arange(len(database.index.primaryKeys))
+        )
+        df_full: TypeVar("pd.DataFrame") = database.df_full
+        index: object = database.index
+
+        tmpURL: str = self.sqliteURL + ".tmp"
+        if os.path.isfile(tmpURL):
+            os.remove(tmpURL)
+
+        connection: sqlite3.Connection = sqlite3.connect(tmpURL)
+
+        # the instrument of the piece is stored with every snippet, so the candidates can be selected
+        # from the snippet table alone.
+        instruments: np.ndarray = np.where(
+            index.pieceRows >= 0, index.instruments[index.pieceRows], None
+        )
+
+        snippets: TypeVar("pd.DataFrame") = pd.DataFrame(
+            {
+                "position": np.arange(len(df_snippets)),
+                "label": df_snippets.index.to_numpy(),
+                **{column: df_snippets[column].to_numpy() for column in df_snippets},
+                "Instrument": instruments,
+                "histogram": [row.tobytes() for row in index.noteHistograms],
+            }
+        )
+        pieces: TypeVar("pd.DataFrame") = pd.DataFrame(
+            {
+                "position": np.arange(len(df_full)),
+                **{column: df_full[column].to_numpy() for column in df_full},
+            }
+        )
+        moods: TypeVar("pd.DataFrame") = pd.DataFrame(
+            [
+                (mood, int(row), float(score))
+                for mood, (rows, scores) in database.moods.entries.items()
+                for row, score in zip(rows, scores)
+            ],
+            columns=["mood", "position", "score"],
+        )
+
+        self.writeTable(
+            connection, "snippets", snippets, "position INTEGER PRIMARY KEY"
+        )
+        self.writeTable(connection, "pieces", pieces, "position INTEGER PRIMARY KEY")
+        connection.execute(
+            "CREATE TABLE moods (mood TEXT, position INTEGER, score REAL, "
+            "PRIMARY KEY (mood, position)) WITHOUT ROWID"
+        )
+        connection.executemany(
+            "INSERT INTO moods VALUES (?, ?, ?)", moods.itertuples(index=False)
+        )
+
+        for name, target in sqliteIndexes.items():
+            connection.execute(f"CREATE INDEX {name} ON {target}")
+
+        meta: Dict[str, Any] = {
+            **self.stamp(),
+            "snippets": self.describeColumns(df_snippets),
+            "pieces": self.describeColumns(df_full),
+            "indexName": df_snippets.index.name,
+            "indexDtype": str(df_snippets.index.dtype),
+            "moods": list(database.moods.entries),
+        }
+        connection.execute("CREATE TABLE meta (value TEXT)")
+        connection.execute("INSERT INTO meta VALUES (?)", (json.dumps(meta),))
+
+        connection.commit()
+        connection.close()
+
+        os.replace(tmpURL, self.sqliteURL)
+
+        # perform logging operations
+        self.logger.info(f"build called - database written to {self.sqliteURL}")
+
+    def writeTable(
+        self,
+        connection: sqlite3.Connection,
+        name: str,
+        frame: TypeVar("pd.DataFrame"),
+        key: str,
+    ) -> None:
+        """
+        :connection: connection to the file being built
+        :name: name of the table
+        :frame: the rows of the table, the first column is the key
+        :key: definition of the key column
+        """
+
+        columns: List[str] = [key] + [f'"{column}"' for column in frame.columns[1:]]
+        connection.execute(f"CREATE TABLE {name} ({', '.join(columns)})")
+
+        # missing values are stored as NULL, numpy scalars as the python values sqlite understands.
+        rows: List[List[Any]] = [
+            [self.sqlValue(value) for value in row]
+            for row in frame.itertuples(index=False)
+        ]
+        connection.executemany(
+            f"INSERT INTO {name} VALUES ({', '.join('?' * len(frame.columns))})", rows
+        )
+
+    def describeColumns(self, frame: TypeVar("pd.DataFrame")) -> List[Dict[str, Any]]:
+        """
+        :frame: a table of the database
+        :return: the name and dtype of every column, with the categories of categorical columns, so
+            the rows read back get the same dtypes as the pandas backend
+        """
+
+        columns: List[Dict[str, Any]] = []
+
+        for column in frame.columns:
+            dtype: Any = frame[column].dtype
+            spec: Dict[str, Any] = {"name": column, "dtype": str(dtype)}
+
+            if isinstance(dtype, pd.CategoricalDtype):
+                spec["categories"] = [
+                    self.sqlValue(category) for category in dtype.categories
+                ]
+
+            columns.append(spec)
+
+        return columns
+
+    def sqlValue(self, value: Any) -> Any:
+        """
+        :value: a value from a dataframe
+        :return: the value as a python object sqlite can store, None for missing values
+        """
+
+        if isinstance(value, np.generic):
+            value = value.item()
+
+        if isinstance(value, float) and np.isnan(value):
+            return None
+
+        return value
+
+    def connect(self) -> None:
+        """
+        Opens the SQLite file read-only and reads its meta data. Connections opened before, by any
+        thread, are replaced as they are next used.
+        """
+
+        self.connections = threading.local()
+        self.meta = json.loads(
+            self.connection.execute("SELECT value FROM meta").fetchone()[0]
+        )
+
+        # perform logging operations
+        self.logger.info(f"connect called - database: {self.sqliteURL}")
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        :return: the read-only connection of the calling thread, opened the first time it is asked for
+        """
+
+        connection: Optional[sqlite3.Connection] = getattr(
+            self.connections, "connection", None
+        )
+
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.sqliteURL}?mode=ro", uri=True)
+            self.connections.connection = connection
+
+        return connection
+
+    def isStale(self) -> bool:
+        """
+        :return: True if there is no SQLite file, or it was built from other data or by another version
+        """
+
+        if not os.path.isfile(self.sqliteURL):
+            return True
+
+        try:
+            connection: sqlite3.Connection = sqlite3.connect(
+                f"file:{self.sqliteURL}?mode=ro", uri=True
+            )
+            meta: Dict[str, Any] = json.loads(
+                connection.execute("SELECT value FROM meta").fetchone()[0]
+            )
+            connection.close()
+        except (sqlite3.Error, TypeError, ValueError):
+            return True
+
+        return {key: meta.get(key) for key in self.stamp()} != self.stamp()
+
+    def stamp(self) -> Dict[str, Any]:
+        """
+        :return: everything the content of the file depends on
+        """
+
+        snapshot: object = databaseSnapshot()
+
+        return {
+            "version": sqliteVersion,
+            "sources": [
+                (snapshot.sourceStamp(sourceURL) if os.path.isfile(sourceURL) else None)
+                for sourceURL, _ in snapshotTables.values()
+            ],
+        }
+
+    def features(self) -> Tuple[TypeVar("pd.DataFrame"), np.ndarray]:
+        """
+        Reads the columns the similarity search scores on, in a single pass over the snippet table.
+
+        :return: a dataframe with the numeric columns in the order of the rows, and the
+            (n_snippets x 12) matrix of pitch class counts
+        """
+
+        columns: List[str] = [
+            "PrimaryKeys",
+            "ThirdKey",
+            "DominantNoteMean",
+            "TempoMean",
+            "NoisinessMedian",
+            "Valence",
+            "Arousal",
+            "DensityNotes",
+        ]
+
+        frame: TypeVar("pd.DataFrame") = pd.read_sql_query(
+            f"SELECT {', '.join(columns)}, histogram FROM snippets ORDER BY position",
+            self.connection,
+        )
+        histograms: np.ndarray = np.frombuffer(
+            b"".join(frame.pop("histogram")), dtype=np.int32
+        ).reshape(len(frame), 12)
+
+        return self.castColumns(frame, self.meta["snippets"]), histograms
+
+    def pieces(self) -> TypeVar("pd.DataFrame"):
+        """
+        :return: the PrimaryKey and Instrument columns of the full database, in the order of its rows
+        """
+
+        frame: TypeVar("pd.DataFrame") = pd.read_sql_query(
+            "SELECT PrimaryKey, Instrument FROM pieces ORDER BY position",
+            self.connection,
+        )
+
+        return self.castColumns(frame, self.meta["pieces"])
+
+    def snippetRows(self, positions: np.ndarray) -> TypeVar("pd.DataFrame"):
+        """
+        Reads rows of the snippet table by their position, with the same columns, dtypes and index as the
+        rows of the pandas backend.
+
+        :positions: row positions of the snippets
+        :return: the rows as a dataframe, in the order of the positions
+        """
+
+        specs: List[Dict[str, Any]] = self.meta["snippets"]
+        columns: str = ", ".join(f'"{spec["name"]}"' for spec in specs)
+        positions: List[int] = [int(position) for position in positions]
+
+        rows: Dict[int, Tuple[Any, ...]] = {}
+
+        # sqlite limits the number of parameters of a statement, so long lists are read in chunks.
+        for chunk in range(0, len(positions), 500):
+            numbers: List[int] = positions[chunk : chunk + 500]
+            for row in self.connection.execute(
+                f"SELECT position, label, {columns} FROM snippets "
+                f"WHERE position IN ({', '.join('?' * len(numbers))})",
+                numbers,
+            ):
+                rows[row[0]] = row[1:]
+
+        values: List[Tuple[Any, ...]] = list(
+            zip(*[rows[position] for position in positions])
+        ) or [()] * (len(specs) + 1)
+
+        return pd.DataFrame(
+            {
+                spec["name"]: self.castValues(column, spec)
+                for spec, column in zip(specs, values[1:])
+            },
+            index=pd.Index(
+                np.array(values[0], dtype=self.meta["indexDtype"]),
+                name=self.meta["indexName"],
+            ),
+        )
+
+    def castColumns(
+        self, frame: TypeVar("pd.DataFrame"), specs: List[Dict[str, Any]]
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        :frame: columns as they were read from sqlite
+        :specs: the column descriptions written by describeColumns
+        :return: the columns cast to the dtypes they had in the pandas backend
+        """
+
+        return pd.DataFrame(
+            {
+                spec["name"]: self.castValues(frame[spec["name"]].tolist(), spec)
+                for spec in specs
+                if spec["name"] in frame.columns
+            }
+        )
+
+    def castValues(self, values: Tuple[Any, ...], spec: Dict[str, Any]) -> Any:
+        """
+        Casting the python values sqlite returns straight into an array of the right dtype is a lot
+        faster than letting pandas infer a dtype first and casting that.
+
+        :values: the values of a column as they were read from sqlite
+        :spec: the column description written by describeColumns
+        :return: the column as an array with the dtype it had in the pandas backend
+        """
+
+        if "categories" in spec:
+            return pd.Categorical(values, categories=spec["categories"])
+
+        if spec["dtype"] in ("object", "str", "string"):
+            # sqlite returns None for missing text, pandas uses NaN.
+            array: np.ndarray = np.empty(len(values), dtype=object)
+            array[:] = [np.nan if value is None else value for value in values]
+
+            return (
+                array if spec["dtype"] == "object" else pd.array(array, spec["dtype"])
+            )
+
+        # missing numbers come back as None as well, which numpy turns into NaN.
+        return np.array(values, dtype=spec["dtype"])
+
+    def positionBySecondaryKey(self, secondaryKey: str) -> int:
+        """
+        :secondaryKey: string representing the SecondaryKeys entry in the snippet database
+        :return: row position of the snippet in the snippet database, raises a KeyError if unknown
+        """
+        return self.fetchPosition(selectPositionBySecondaryKey, secondaryKey)
+
+    def positionByFileName(self, fileName: str) -> int:
+        """
+        :fileName: string representing the FileNames entry in the snippet database
+        :return: row position of the snippet in the snippet database, raises a KeyError if unknown
+        """
+        return self.fetchPosition(selectPositionByFileName, fileName)
+
+    def positionByPrimaryKey(self, primaryKey: int) -> int:
+        """
+        :primaryKey: number representing the piece, as found in the PrimaryKey column of the full database
+        :return: row position of the piece in the full database, raises a KeyError if unknown
+        """
+        return self.fetchPosition(selectPositionByPrimaryKey, primaryKey)
+
+    def fetchPosition(self, statement: str, key: Any) -> int:
+        """
+        :statement: one of the select statements at the top of this module
+        :key: the value to look up
+        :return: the position that was found, raises a KeyError if there is none
+        """
+
+        row: Optional[Tuple[int]] = self.connection.execute(
+            statement, (self.sqlValue(key),)
+        ).fetchone()
+
+        if row is None:
+            raise KeyError(key)
+
+        return row[0]
+
+    def candidatePositions(self, instrument: str, dominantNote: Any) -> np.ndarray:
+        """
+        :instrument: string representing the instrumentation, as found in the full database
+        :dominantNote: the DominantNoteMean value, as found in the snippet database
+        :return: sorted array with the row positions of the candidates, empty if there are none
+        """
+
+        rows: List[Tuple[int]] = self.connection.execute(
+            selectCandidates, (self.sqlValue(instrument), self.sqlValue(dominantNote))
+        ).fetchall()
+
+        return np.array([row[0] for row in rows], dtype=np.int64)
+
+    def blockPositions(
+        self,
+        instruments: Optional[Set[str]] = None,
+        dominantNotes: Optional[Set[float]] = None,
+    ) -> np.ndarray:
+        """
+        :instruments: the instruments to gather, None for all of them
+        :dominantNotes: the dominant notes to gather as numbers, None for all of them
+        :return: sorted array with the row positions of the candidates, empty if there are none
+        """
+
+        conditions: List[str] = ["Instrument IS NOT NULL", "Valence IS NOT NULL"]
+        values: List[Any] = []
+
+        for column, selected in (
+            ("Instrument", instruments),
+            ("DominantNoteMean", dominantNotes),
+        ):
+            if selected is not None:
+                conditions.append(f"{column} IN ({', '.join('?' * len(selected))})")
+                values.extend(self.sqlValue(value) for value in selected)
+
+        rows: List[Tuple[int]] = self.connection.execute(
+            f"SELECT position FROM snippets WHERE {' AND '.join(conditions)} "
+            "ORDER BY position",
+            values,
+        ).fetchall()
+
+        return np.array([row[0] for row in rows], dtype=np.int64)
+
+    def fileNames(self, start: int, end: int) -> np.ndarray:
+        """
+        :start: first row position
+        :end: row position after the last one
+        :return: object array with the FileNames of the rows in between
+        """
+
+        rows: List[Tuple[str]] = self.connection.execute(
+            selectFileNames, (int(start), int(end))
+        ).fetchall()
+
+        fileNames: np.ndarray = np.empty(len(rows), dtype=object)
+        fileNames[:] = [row[0] for row in rows]
+
+        return fileNames
+
+    def moodScores(self, mood: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :mood: string representing the mood
+        :return: the row positions of the snippets with a score for the mood, ascending, and their
+            scores. Raises a KeyError if the mood isn't stored.
+        """
+
+        if mood not in self.meta["moods"]:
+            raise KeyError(mood)
+
+        rows: List[Tuple[int, float]] = self.connection.execute(
+            selectMoodScores, (mood,)
+        ).fetchall()
+
+        return (
+            np.array([row[0] for row in rows], dtype=np.int32),
+            np.array([row[1] for row in rows], dtype=np.float32),
+        )
+
+
+if __name__ == "__main__":
+
+    # build the SQLite file from the current database, run from the root of the repo with:
+    # python -m thePlayer.databaseSQLite
+    from thePlayer.databaseMain import databaseMain
+
+    logging.basicConfig(level=logging.INFO)
+    databaseSQLite().build(databaseMain(backend="pandas", rebuild=False))
@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from Settings.Settings import musicMoods
+from thePlayer.databaseIndex import databaseIndex
+
+
+class databaseSQLiteIndex(databaseIndex):
+    """
+    databaseSQLiteIndex is the database index of the SQLite backend. The arrays the similarity search
+    works on are held in memory like they are by databaseIndex, the lookups by key, the candidate
+    blocks and the filenames are answered by the indexes of the SQLite file instead of dicts and
+    object arrays.
+
+    ...
+
+    Attributes
+    ----------
+    store : databaseSQLite
+        the opened SQLite file.
+
+    See databaseIndex for the other attributes, except the lookups of the secondary keys and the
+    filenames and candidateBlocks which are not kept in memory.
+
+    Methods
+    -------
+    See databaseIndex.
+
+    """
+
+    def __init__(
+        self,
+        store: object,
+        features: TypeVar("pd.DataFrame"),
+        noteHistograms: np.ndarray,
+        moods: object,
+    ) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.store: object = store
+        self.noteHistograms: np.ndarray = noteHistograms
+
+        pieces: TypeVar("pd.DataFrame") = store.pieces()
+        self.primaryKeyPositions: Dict[int, int] = self.buildPositions(
+            pieces["PrimaryKey"]
+        )
+
+        self.pieceOffsets, self.pieceNumbers = self.buildPieceOffsets(
+            features["PrimaryKeys"]
+        )
+
+        self.primaryKeys: np.ndarray = features["PrimaryKeys"].to_numpy()
+        self.thirdKeys: np.ndarray = features["ThirdKey"].to_numpy()
+        self.pieceRows: np.ndarray = self.buildPieceRows(features["PrimaryKeys"])
+        self.instruments: np.ndarray = pieces["Instrument"].to_numpy(dtype=object)
+        self.dominantNotes: np.ndarray = features["DominantNoteMean"].to_numpy()
+
+        self.moodRankings: Dict[str, np.ndarray] = {
+            mood: self.buildMoodRanking(self.thirdKeys, *moods.moodScores(mood))
+            for mood in musicMoods
+            if mood in moods.entries
+        }
+
+        # perform logging operations
+        self.logger.info(f"database index built - snippets: {len(features)}")
+
+    def positionBySecondaryKey(self, secondaryKey: str) -> int:
+        """
+        :secondaryKey: string representing the SecondaryKeys entry in the snippet database
+        :return: row position of the snippet in the snippet database, raises a KeyError if unknown
+        """
+        return self.store.positionBySecondaryKey(secondaryKey)
+
+    def positionByFileName(self, fileName: str) -> int:
+        """
+        :fileName: string representing the FileNames entry in the snippet database
+        :return: row position of the snippet in the snippet database, raises a KeyError if unknown
+        """
+        return self.store.positionByFileName(fileName)
+
+    def positionByPrimaryKey(self, primaryKey: int) -> int:
+        """
+        :primaryKey: number representing the piece, as found in the PrimaryKey column of the full database
+        :return: row position of the piece in the full database, raises a KeyError if unknown
+        """
+        return self.store.positionByPrimaryKey(primaryKey)
+
+    def candidatePositions(self, instrument: str, dominantNote: Any) -> np.ndarray:
+        """
+        :instrument: string representing the instrumentation, as found in the full database
+        :dominantNote: the DominantNoteMean value, as found in the snippet database
+        :return: sorted array with the row positions of the candidates, empty if there are none
+        """
+        return self.store.candidatePositions(instrument, dominantNote)
+
+    def blockPositions(
+        self,
+        instruments: Optional[Set[str]] = None,
+        dominantNotes: Optional[Set[float]] = None,
+    ) -> np.ndarray:
+        """
+        :instruments: the instruments to gather, None for all of them
+        :dominantNotes: the dominant notes to gather as numbers, None for all of them
+        :return: sorted array with the row positions of the candidates, empty if there are none
+        """
+        return self.store.blockPositions(instruments, dominantNotes)
+
+    def snippetFileNames(self, start: int, end: int) -> np.ndarray:
+        """
+        :start: first row position
+        :end: row position after the last one
+        :return: array with the FileNames of the rows in between
+        """
+        return self.store.fileNames(start, end)
@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from Settings.Settings import musicMoods
+
+# explicit dtypes for the columns of every table. Keys are stored as integers, features as float32
+# and columns with only a handful of distinct values as categoricals.
+databaseSchemas: Dict[str, Dict[str, str]] = {
+    "snippets": {
+        "PrimaryKeys": "int32",
+        "ThirdKey": "int32",
+        "TotalSnippets": "int32",
+        "DensityNotes": "int32",
+        "UniqueNotes": "int32",
+        "Duration": "float32",
+        "NoisinessMedian": "float32",
+        "TempoMean": "float32",
+        "Valence": "float32",
+        "Arousal": "float32",
+        "DominantNoteMean": "category",
+        "SecondaryKeys": "secondaryKey",
+        **{mood: "float32" for mood in musicMoods},
+    },
+    "full": {
+        "PrimaryKey": "int32",
+        "Instrument": "category",
+    },
+    "moods": {
+        "PrimaryKey": "int32",
+    },
+}
+
+
+# the SecondaryKeys of a snippet is the PrimaryKeys of its piece and its bar as 4 digits, "<piece>_<bar>",
+# which is stored as the number piece * secondaryKeyBase + bar.
+secondaryKeyBase: int = 10000
+
+
+class databaseSchema:
+    """
+    databaseSchema casts the tables of the music database to a compact set of dtypes. Read with the
+    defaults, pandas keeps every text column as python objects and every number as float64 or int64,
+    which for 110k snippets holds several hundred MB.
+
+    Columns named in databaseSchemas get the dtype given there. Of the remaining columns, floats are
+    stored as float32 and text columns with few distinct values (the mood labels and other tags) as
+    categoricals. The SecondaryKeys are encoded as int32 numbers, as long as all of them follow the
+    "<piece>_<bar>" layout. Text columns with a value per row, like the filenames, are left as they
+    are, the database index keeps the filenames in a heap of its own.
+
+    ...
+
+    Methods
+    -------
+    apply() :
+        casts the columns of a table to the schema.
+
+    columnType() :
+        decides the dtype of a single column.
+
+    encodeSecondaryKeys() :
+        encodes a column of SecondaryKeys as numbers.
+
+    encodeSecondaryKey() :
+        encodes a single SecondaryKeys string.
+
+    decodeSecondaryKeys() :
+        turns encoded SecondaryKeys back into strings.
+
+    """
+
+    def __init__(self) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+    def apply(
+        self, table: str, frame: TypeVar("pd.DataFrame")
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        :table: name of the table, one of the keys of databaseSchemas
+        :frame: the table as it was read from the .csv file
+        :return: the table with its columns cast to the schema
+        """
+
+        columns: Dict[str, Any] = {}
+
+        for column in frame.columns:
+            dtype: Optional[str] = self.columnType(table, frame[column])
+
+            if dtype == "secondaryKey":
+                codes: Optional[np.ndarray] = self.encodeSecondaryKeys(frame[column])
+                if codes is not None:
+                    columns[column] = codes
+            elif dtype is not None:
+                columns[column] = frame[column].astype(dtype)
+
+        # perform logging operations
+        self.logger.debug(
+            f"apply called - table: {table}, columns cast: {list(columns)}"
+        )
+
+        return frame.assign(**columns) if columns else frame
+
+    def columnType(self, table: str, values: TypeVar("pd.Series")) -> Optional[str]:
+        """
+        :table: name of the table the column belongs to
+        :values: the column
+        :return: the dtype to cast the column to, or None to leave it as it is
+        """
+
+        dtype: Optional[str] = databaseSchemas.get(table, {}).get(values.name)
+
+        if dtype is None:
+            if pd.api.types.is_float_dtype(values.dtype):
+                dtype = "float32"
+            elif (
+                pd.api.types.is_object_dtype(values.dtype)
+                or pd.api.types.is_string_dtype(values.dtype)
+            ) and values.nunique() <= len(values) // 2:
+                dtype = "category"
+
+        # integers can't hold missing values, those columns stay floating point.
+        if dtype in ("int32", "int16") and values.isna().any():
+            dtype = "float32"
+
+        # keys that are encoded already are left as they are.
+        if dtype == "secondaryKey" and pd.api.types.is_integer_dtype(values.dtype):
+            return None
+
+        if dtype is not None and str(values.dtype) == dtype:
+            return None
+
+        return dtype
+
+    def encodeSecondaryKeys(self, values: TypeVar("pd.Series")) -> Optional[np.ndarray]:
+        """
+        :values: the SecondaryKeys column
+        :return: int32 array with piece * secondaryKeyBase + bar for every key, or None if any of the
+            keys doesn't come back the same when decoded, those are kept as text
+        """
+
+        text: TypeVar("pd.Series") = values.astype(object)
+        if text.isna().any() or not text.map(type).eq(str).all():
+            return None
+
+        # the piece has no leading zeros, those wouldn't survive the round trip.
+        parts: TypeVar("pd.DataFrame") = text.str.extract(r"^(0|[1-9]\d{0,5})_(\d{4})$")
+        if parts.isna().any().any():
+            return None
+
+        codes: np.ndarray = (
+            parts[0].astype(np.int64).to_numpy() * secondaryKeyBase
+            + parts[1].astype(np.int64).to_numpy()
+        )
+        if codes.max(initial=0) > np.iinfo(np.int32).max:
+            return None
+
+        codes = codes.astype(np.int32)
+
+        # only keys that come back exactly as they were are encoded.
+        if not np.array_equal(self.decodeSecondaryKeys(codes), text.to_numpy()):
+            return None
+
+        return codes
+
+    def encodeSecondaryKey(self, secondaryKey: str) -> Optional[int]:
+        """
+        :secondaryKey: string representing the SecondaryKeys entry of a snippet
+        :return: the encoded key, or None if it doesn't follow the "<piece>_<bar>" layout or wouldn't
+            come back the same when decoded, like a piece with leading zeros
+        """
+
+        piece, _, bar = str(secondaryKey).rpartition("_")
+
+        if not (piece.isdigit() and bar.isdigit() and len(bar) == 4):
+            return None
+
+        code: int = int(piece) * secondaryKeyBase + int(bar)
+        if self.decodeSecondaryKeys(np.array([code]))[0] != secondaryKey:
+            return None
+
+        return code
+
+    def decodeSecondaryKeys(self, codes: np.ndarray) -> np.ndarray:
+        """
+        :codes: encoded SecondaryKeys
+        :return: object array with the keys as strings
+        """
+
+        keys: np.ndarray = np.empty(len(codes), dtype=object)
+        keys[:] = [
+            f"{code // secondaryKeyBase}_{code % secondaryKeyBase:04d}"
+            for code in np.asarray(codes).tolist()
+        ]
+
+        return keys
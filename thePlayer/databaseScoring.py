@@ -0,0 +1,275 @@
+import threading
+import numpy as np
+import pandas as pd
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+# these weights allocate importance to the different commonalities between 2 snippets, in the order
+# notes, tempo, noisiness, valence and arousal.
+defaultWeights: List[float] = [1.2, 1, 0.2, 1, 1]
+
+
+class databaseScoring:
+    """
+    databaseScoring holds the features used by the similarity search as a structure of arrays, one
+    contiguous float32 array per feature in the row order of the snippet database, and scores a set
+    of candidate rows against a reference snippet in a single pass over preallocated buffers.
+
+    The feature arrays are only read while scoring and every thread gets buffers of its own, so
+    several threads can score at the same time.
+
+    The score of a candidate is the weighted sum of how far it is from the reference on notes, tempo,
+    noisiness, valence and arousal, so the lower the score the closer the match.
+
+    ...
+
+    Attributes
+    ----------
+    tempo, noisiness, valence, arousal, density : np.ndarray
+        float32 feature arrays, one value per snippet.
+
+    noteHistograms : np.ndarray
+        (n_snippets x 12) matrix of pitch class counts, shared with the database index.
+
+    buffers : threading.local
+        the buffers of the scoring pass, one set per thread.
+
+    Methods
+    -------
+    scoreCandidates() :
+        calculates the similarity score of the candidate rows to a reference row.
+
+    scoreBatch() :
+        calculates the similarity score of the candidate rows to several references at once.
+
+    selectTop() :
+        selects the k lowest scores, in order.
+
+    reserve() :
+        makes sure the buffers of the calling thread can hold a number of candidates.
+
+    appendRows() :
+        adds the features of snippets appended to the snippet database.
+
+    """
+
+    def __init__(
+        self, df_snippets: TypeVar("pd.DataFrame"), noteHistograms: np.ndarray
+    ) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.tempo: np.ndarray = self.featureArray(df_snippets["TempoMean"])
+        self.noisiness: np.ndarray = self.featureArray(df_snippets["NoisinessMedian"])
+        self.valence: np.ndarray = self.featureArray(df_snippets["Valence"])
+        self.arousal: np.ndarray = self.featureArray(df_snippets["Arousal"])
+        self.density: np.ndarray = self.featureArray(df_snippets["DensityNotes"])
+        self.noteHistograms: np.ndarray = noteHistograms
+
+        # buffers are reused between the queries of a thread, they are grown when a larger candidate
+        # set comes in.
+        self.buffers: threading.local = threading.local()
+        self.reserve(1024)
+
+    def featureArray(self, column: TypeVar("pd.Series")) -> np.ndarray:
+        """
+        :column: a numeric column of the snippet database, or an array with its values
+        :return: the column as a contiguous float32 array, arrays that already are one are used as they
+            are, so the memory mapped arrays of the shared backend aren't copied
+        """
+        return np.ascontiguousarray(np.asarray(column, dtype=np.float32))
+
+    def appendRows(
+        self, df_snippets: TypeVar("pd.DataFrame"), noteHistograms: np.ndarray
+    ) -> None:
+        """
+        :df_snippets: the new snippets, appended after all the current rows
+        :noteHistograms: the note histograms of all the snippets, including the new ones
+        """
+
+        self.tempo = np.concatenate(
+            [self.tempo, self.featureArray(df_snippets["TempoMean"])]
+        )
+        self.noisiness = np.concatenate(
+            [self.noisiness, self.featureArray(df_snippets["NoisinessMedian"])]
+        )
+        self.valence = np.concatenate(
+            [self.valence, self.featureArray(df_snippets["Valence"])]
+        )
+        self.arousal = np.concatenate(
+            [self.arousal, self.featureArray(df_snippets["Arousal"])]
+        )
+        self.density = np.concatenate(
+            [self.density, self.featureArray(df_snippets["DensityNotes"])]
+        )
+        self.noteHistograms = noteHistograms
+
+    def reserve(self, size: int) -> threading.local:
+        """
+        Allocates the buffers the scoring pass of the calling thread writes to, if it has none yet or
+        the current ones are too small.
+
+        :size: number of candidates the buffers must be able to hold
+        :return: the buffers of the calling thread
+        """
+
+        buffers: threading.local = self.buffers
+        capacity: int = getattr(buffers, "capacity", 0)
+
+        if size <= capacity:
+            return buffers
+
+        buffers.capacity = max(size, 2 * capacity, 1024)
+        buffers.score = np.empty(buffers.capacity, dtype=np.float32)
+        buffers.term = np.empty(buffers.capacity, dtype=np.float32)
+        buffers.notes = np.empty((buffers.capacity, 12), dtype=np.int32)
+        buffers.count = np.empty(buffers.capacity, dtype=np.int32)
+
+        return buffers
+
+    def scoreCandidates(
+        self,
+        positions: np.ndarray,
+        reference: int,
+        tempoChange: float = 0,
+        valenceChange: float = 0,
+        arousalChange: float = 0,
+        weights: List[float] = defaultWeights,
+        penalties: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        Scores the candidates against the reference. Every term is written into the same buffer and
+        accumulated into the score, so there are no temporary columns or dataframe copies.
+
+        :positions: row positions of the candidates in the snippet database
+        :reference: row position of the reference snippet
+        :tempoChange: the amount the tempo of the match should change up or down
+        :valenceChange: the amount the valence of the match should change
+        :arousalChange: the amount the arousal of the match should change
+        :weights: importance of notes, tempo, noisiness, valence and arousal
+        :penalties: optional float32 array with an amount to add to the score of every snippet of the database
+        :return: view on the score buffer holding one score per candidate, NaN where a feature is missing.
+            It is overwritten by the next call from the same thread.
+        """
+
+        size: int = len(positions)
+        buffers: threading.local = self.reserve(size)
+
+        score: np.ndarray = buffers.score[:size]
+        term: np.ndarray = buffers.term[:size]
+        notes: np.ndarray = buffers.notes[:size]
+        count: np.ndarray = buffers.count[:size]
+
+        # the amount of notes in common, normalized by the amount of notes in the candidate.
+        np.take(self.noteHistograms, positions, axis=0, out=notes)
+        np.minimum(notes, self.noteHistograms[reference], out=notes)
+        np.sum(notes, axis=1, out=count)
+        np.take(self.density, positions, out=term)
+        np.divide(count, term, out=term, dtype=np.float32)
+        np.subtract(1, term, out=term)
+        np.multiply(term, weights[0], out=score)
+
+        # the other features are all compared as the ratio to the (changed) reference value.
+        for feature, target, weight in (
+            (self.tempo, self.tempo[reference] + tempoChange, weights[1]),
+            (self.noisiness, self.noisiness[reference], weights[2]),
+            (self.valence, self.valence[reference] + valenceChange, weights[3]),
+            (self.arousal, self.arousal[reference] + arousalChange, weights[4]),
+        ):
+            # the target is rounded to float32 as well, so the score comes out bit for bit the same as
+            # the one scoreBatch calculates.
+            target = np.float32(target)
+            np.take(feature, positions, out=term)
+            np.divide(term, target, out=term)
+            np.subtract(1, term, out=term)
+            np.abs(term, out=term)
+            np.multiply(term, weight, out=term)
+            np.add(score, term, out=score)
+
+        np.abs(score, out=score)
+
+        if penalties is not None:
+            np.take(penalties, positions, out=term)
+            np.add(score, term, out=score)
+
+        return score
+
+    def scoreBatch(
+        self,
+        positions: np.ndarray,
+        references: np.ndarray,
+        changes: np.ndarray,
+        weights: List[float] = defaultWeights,
+        penalties: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        Scores the candidates against several references at once. Every feature of the candidates is
+        gathered once and broadcast against a column of reference values, which gives the same scores as
+        calling scoreCandidates once per reference.
+
+        :positions: row positions of the candidates in the snippet database
+        :references: row positions of the reference snippets
+        :changes: (n_references x 3) array with the tempo, valence and arousal change for every reference
+        :weights: importance of notes, tempo, noisiness, valence and arousal
+        :penalties: optional float32 array with an amount to add to the score of every snippet of the database
+        :return: (n_references x n_candidates) float32 matrix of scores, NaN where a feature is missing
+        """
+
+        notes: np.ndarray = np.minimum(
+            self.noteHistograms[positions][np.newaxis, :, :],
+            self.noteHistograms[references][:, np.newaxis, :],
+        ).sum(axis=2, dtype=np.int32)
+
+        score: np.ndarray = np.divide(notes, self.density[positions], dtype=np.float32)
+        np.subtract(1, score, out=score)
+        np.multiply(score, weights[0], out=score)
+
+        # the other features are all compared as the ratio to the (changed) reference values.
+        for feature, targets, weight in (
+            (self.tempo, self.tempo[references] + changes[:, 0], weights[1]),
+            (self.noisiness, self.noisiness[references], weights[2]),
+            (self.valence, self.valence[references] + changes[:, 1], weights[3]),
+            (self.arousal, self.arousal[references] + changes[:, 2], weights[4]),
+        ):
+            term: np.ndarray = np.divide(
+                feature[positions][np.newaxis, :],
+                targets[:, np.newaxis],
+                dtype=np.float32,
+            )
+            np.subtract(1, term, out=term)
+            np.abs(term, out=term)
+            np.multiply(term, weight, out=term)
+            np.add(score, term, out=score)
+
+        np.abs(score, out=score)
+
+        if penalties is not None:
+            np.add(score, penalties[positions][np.newaxis, :], out=score)
+
+        return score
+
+    def selectTop(self, scores: np.ndarray, k: int) -> np.ndarray:
+        """
+        Selects the k lowest scores with an argpartition rather than a full sort. The result is in the
+        same order nsmallest would give: ascending score, ties by position and missing scores last.
+
+        :scores: one score per candidate, as returned by scoreCandidates
+        :k: the number of candidates to select
+        :return: indices into scores of the k best candidates, best first
+        """
+
+        k = min(k, len(scores))
+        if k == 0:
+            return np.empty(0, dtype=np.int64)
+
+        # missing scores sort after all the others.
+        keys: np.ndarray = np.where(np.isnan(scores), np.inf, scores)
+
+        kth: float = keys[np.argpartition(keys, k - 1)[k - 1]]
+
+        # everything below the k-th score is in, ties on it are settled by position.
+        below: np.ndarray = np.flatnonzero(keys < kth)
+        ties: np.ndarray = np.flatnonzero(keys == kth)[: k - len(below)]
+        selected: np.ndarray = np.concatenate([below, ties])
+
+        return selected[np.lexsort((selected, keys[selected]))]
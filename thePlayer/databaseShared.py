@@ -0,0 +1,502 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from Settings.Settings import musicSharedURL, musicMoods
+from thePlayer.databaseSnapshot import databaseSnapshot, snapshotTables
+
+# version of the layout of the segment, bump it whenever the way arrays are written changes.
+sharedVersion: int = 1
+
+
+class databaseShared:
+    """
+    databaseShared publishes everything the queries of databaseMain read into a segment of memory mapped
+    files, for deployments where playback, the conductor and the tooling run as separate processes.
+    One process writes the segment, every other process attaches to it. The files are mapped read-only,
+    so all processes share the same pages of the OS page cache and nothing is copied per process.
+
+    The segment holds the columns of the snippet database, with text as a utf-8 heap with byte offsets
+    so single rows can be decoded without decoding the whole column, the arrays of the database index
+    and the scoring features, and the sparse mood scores. Dicts are stored packed, as one array of
+    values with the offsets of every key, and the lookups by SecondaryKeys and FileNames as sorted
+    arrays of keys that are searched with a binary search.
+
+    ...
+
+    Attributes
+    ----------
+    sharedURL : str
+        directory of the segment
+
+    meta : Dict
+        the manifest of the segment, with the small python values that aren't stored as arrays.
+
+    arrays : Dict
+        the memory mapped arrays of the segment, by name.
+
+    Methods
+    -------
+    publish() :
+        writes the structures of a loaded databaseMain to the segment.
+
+    attach() :
+        memory maps the segment read-only.
+
+    isStale() :
+        checks whether the segment is missing or was built from other data.
+
+    stamp() :
+        returns everything the content of the segment depends on.
+
+    features() :
+        returns the scoring features.
+
+    packed() :
+        returns a dict that was stored packed, with views on the shared arrays as values.
+
+    snippetRows() :
+        decodes rows of the snippet database as a dataframe.
+
+    positionBySecondaryKey(), positionByFileName() :
+        binary search of a row position by key.
+
+    fileNames() :
+        decodes the filenames of a range of rows.
+
+    moodScores() :
+        returns the sparse scores of a mood.
+
+    """
+
+    def __init__(self, sharedURL: str = musicSharedURL) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.sharedURL: str = sharedURL
+        self.manifestURL: str = os.path.join(sharedURL, "manifest.json")
+
+        self.meta: Optional[Dict[str, Any]] = None
+        self.arrays: Dict[str, np.ndarray] = {}
+
+    def publish(self, database: object) -> None:
+        """
+        Writes the segment. It is first written to a temporary directory and only swapped in once
+        complete, processes that attach halfway see either the old or the new segment.
+
+        :database: a loaded databaseMain object with the pandas backend
+        """
+
+        # the rows as the queries return them, with the keys and filenames as text.
+        df_snippets: TypeVar("pd.DataFrame") = database.snippetRows(
+            np.arange(len(database.index.primaryKeys))
+        )
+        index: object = database.index
+        scoring: object = database.scoring
+
+        # the temporary directory is per process, processes that find a stale segment at the same time
+        # don't write into each other's files.
+        tmpURL: str = self.sharedURL + f".{os.getpid()}.tmp"
+        if os.path.isdir(tmpURL):
+            shutil.rmtree(tmpURL)
+        os.makedirs(tmpURL)
+
+        arrays: Dict[str, np.ndarray] = {
+            "noteHistograms": index.noteHistograms,
+            "primaryKeys": index.primaryKeys,
+            "thirdKeys": index.thirdKeys,
+            "pieceOffsets": index.pieceOffsets,
+            "pieceRows": index.pieceRows,
+            "dominantNotes": self.plainArray(index.dominantNotes),
+            "TempoMean": scoring.tempo,
+            "NoisinessMedian": scoring.noisiness,
+            "Valence": scoring.valence,
+            "Arousal": scoring.arousal,
+            "DensityNotes": scoring.density,
+            "snippetIndex": self.plainArray(df_snippets.index.to_numpy()),
+        }
+
+        # the key lookups are a sorted array of keys and the row position of every key. The sort is
+        # stable, so of equal keys the first row comes first, like it does in the dicts of the index.
+        for name, column in (
+            ("secondaryKeys", "SecondaryKeys"),
+            ("fileNames", "FileNames"),
+        ):
+            keys: np.ndarray = np.char.encode(
+                df_snippets[column].astype(str).to_numpy(dtype=str), "utf-8"
+            )
+            order: np.ndarray = np.argsort(keys, kind="stable")
+            arrays[name + ".keys"] = keys[order]
+            arrays[name + ".positions"] = order.astype(np.int64)
+
+        blocks: Dict[str, Any] = self.packDict(
+            arrays, "candidateBlocks", index.candidateBlocks
+        )
+        self.packDict(arrays, "moodRankings", index.moodRankings)
+        self.packDict(
+            arrays,
+            "moodRows",
+            {mood: rows for mood, (rows, _) in database.moods.entries.items()},
+        )
+        self.packDict(
+            arrays,
+            "moodScores",
+            {mood: scores for mood, (_, scores) in database.moods.entries.items()},
+        )
+
+        columns: List[Dict[str, Any]] = [
+            self.writeColumn(arrays, f"column{number:04d}", df_snippets[column])
+            for number, column in enumerate(df_snippets.columns)
+        ]
+
+        for name, array in arrays.items():
+            np.save(os.path.join(tmpURL, name + ".npy"), np.ascontiguousarray(array))
+
+        meta: Dict[str, Any] = {
+            **self.stamp(),
+            "rows": len(df_snippets),
+            "columns": columns,
+            "indexName": df_snippets.index.name,
+            "indexDtype": str(df_snippets.index.dtype),
+            "instruments": [self.plainValue(value) for value in index.instruments],
+            "pieceKeys": [
+                self.plainValue(value) for value in index.primaryKeyPositions.keys()
+            ],
+            "piecePositions": list(index.primaryKeyPositions.values()),
+            "candidateBlocks": [
+                [self.plainValue(value) for value in key] for key in blocks
+            ],
+            "moodRankings": list(index.moodRankings),
+            "moods": list(database.moods.entries),
+        }
+        with open(os.path.join(tmpURL, "manifest.json"), "w") as f:
+            json.dump(meta, f)
+
+        # processes that have the old segment mapped keep their mappings, the files are only removed
+        # once they are unmapped.
+        oldURL: str = self.sharedURL + f".{os.getpid()}.old"
+        if os.path.isdir(self.sharedURL):
+            os.replace(self.sharedURL, oldURL)
+        os.replace(tmpURL, self.sharedURL)
+        shutil.rmtree(oldURL, ignore_errors=True)
+
+        # perform logging operations
+        self.logger.info(f"publish called - segment written to {self.sharedURL}")
+
+    def writeColumn(
+        self, arrays: Dict[str, np.ndarray], name: str, values: TypeVar("pd.Series")
+    ) -> Dict[str, Any]:
+        """
+        Adds a column of the snippet database to the arrays of the segment. Numbers are stored as they
+        are, categoricals as their codes and text as a utf-8 heap with the byte offset of every row.
+
+        :arrays: the arrays of the segment, the column is added to it
+        :name: name of the array(s) the column is stored in
+        :values: the column
+        :return: the manifest entry describing the column
+        """
+
+        spec: Dict[str, Any] = {
+            "file": name,
+            "name": values.name,
+            "dtype": str(values.dtype),
+        }
+
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            arrays[name] = values.array.codes
+            spec["categories"] = [
+                self.plainValue(value) for value in values.dtype.categories
+            ]
+
+        elif pd.api.types.is_numeric_dtype(values.dtype) or pd.api.types.is_bool_dtype(
+            values.dtype
+        ):
+            arrays[name] = values.to_numpy()
+
+        else:
+            strings: np.ndarray = values.to_numpy(dtype=object)
+            nulls: np.ndarray = pd.isna(strings)
+            encoded: List[bytes] = [
+                b"" if null else str(value).encode("utf-8")
+                for value, null in zip(strings, nulls)
+            ]
+
+            offsets: np.ndarray = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in encoded], out=offsets[1:])
+
+            arrays[name + ".heap"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+            arrays[name + ".offsets"] = offsets
+            arrays[name + ".nulls"] = nulls
+            spec["text"] = True
+
+        return spec
+
+    def packDict(
+        self, arrays: Dict[str, np.ndarray], name: str, values: Dict[Any, np.ndarray]
+    ) -> List[Any]:
+        """
+        Adds a dict of arrays to the arrays of the segment as one array with all the values, and the
+        offsets where the values of every key start.
+
+        :arrays: the arrays of the segment, the dict is added to it
+        :name: name of the arrays the dict is stored in
+        :values: the dict to store
+        :return: the keys of the dict, in the order of the offsets
+        """
+
+        keys: List[Any] = list(values)
+        offsets: np.ndarray = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(values[key]) for key in keys], out=offsets[1:])
+
+        arrays[name + ".values"] = (
+            np.concatenate([values[key] for key in keys])
+            if keys
+            else np.empty(0, dtype=np.int64)
+        )
+        arrays[name + ".offsets"] = offsets
+
+        return keys
+
+    def plainArray(self, values: np.ndarray) -> np.ndarray:
+        """
+        :values: an array of the database index
+        :return: the array as it can be memory mapped. Object arrays hold the numbers of a column with
+            missing values, they are stored as floats with NaN.
+        """
+
+        if values.dtype == object:
+            return pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(
+                dtype=np.float64
+            )
+
+        return values
+
+    def plainValue(self, value: Any) -> Any:
+        """
+        :value: a key or category of the database
+        :return: the value as a python object that can be written to json
+        """
+
+        if isinstance(value, np.generic):
+            return value.item()
+
+        return value
+
+    def attach(self) -> None:
+        """
+        Memory maps all the arrays of the segment read-only.
+        """
+
+        with open(self.manifestURL) as f:
+            self.meta = json.load(f)
+
+        self.arrays = {
+            fileName[: -len(".npy")]: np.load(
+                os.path.join(self.sharedURL, fileName), mmap_mode="r"
+            )
+            for fileName in os.listdir(self.sharedURL)
+            if fileName.endswith(".npy")
+        }
+
+        # perform logging operations
+        self.logger.info(f"attach called - segment: {self.sharedURL}")
+
+    def isStale(self) -> bool:
+        """
+        :return: True if there is no segment, or it was built from other data, settings or version
+        """
+
+        try:
+            with open(self.manifestURL) as f:
+                meta: Dict[str, Any] = json.load(f)
+        except (OSError, ValueError):
+            return True
+
+        return {key: meta.get(key) for key in self.stamp()} != self.stamp()
+
+    def stamp(self) -> Dict[str, Any]:
+        """
+        :return: everything the content of the segment depends on
+        """
+
+        snapshot: object = databaseSnapshot()
+
+        return {
+            "version": sharedVersion,
+            "moodSettings": list(musicMoods),
+            "sources": [
+                (snapshot.sourceStamp(sourceURL) if os.path.isfile(sourceURL) else None)
+                for sourceURL, _ in snapshotTables.values()
+            ],
+        }
+
+    def features(self) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        """
+        :return: the scoring features by the name of their column in the snippet database, and the
+            matrix of note histograms
+        """
+
+        features: Dict[str, np.ndarray] = {
+            column: self.arrays[column]
+            for column in (
+                "TempoMean",
+                "NoisinessMedian",
+                "Valence",
+                "Arousal",
+                "DensityNotes",
+            )
+        }
+
+        return features, self.arrays["noteHistograms"]
+
+    def packed(self, name: str, keys: List[Any]) -> Dict[Any, np.ndarray]:
+        """
+        :name: name of the arrays the dict is stored in
+        :keys: the keys of the dict, in the order they were packed in
+        :return: the dict, with read-only views on the shared values
+        """
+
+        values: np.ndarray = self.arrays[name + ".values"]
+        offsets: np.ndarray = self.arrays[name + ".offsets"]
+
+        return {
+            key: values[offsets[number] : offsets[number + 1]]
+            for number, key in enumerate(keys)
+        }
+
+    def snippetRows(self, positions: np.ndarray) -> TypeVar("pd.DataFrame"):
+        """
+        Decodes rows of the snippet database, with the same columns, dtypes and index as the rows of the
+        pandas backend.
+
+        :positions: row positions of the snippets
+        :return: the rows as a dataframe, in the order of the positions
+        """
+
+        positions: np.ndarray = np.asarray(positions, dtype=np.int64)
+        columns: Dict[str, Any] = {}
+
+        for spec in self.meta["columns"]:
+            if "categories" in spec:
+                columns[spec["name"]] = pd.Categorical.from_codes(
+                    self.arrays[spec["file"]][positions], spec["categories"]
+                )
+            elif spec.get("text"):
+                values: np.ndarray = self.decodeText(spec["file"], positions)
+                columns[spec["name"]] = (
+                    values
+                    if spec["dtype"] == "object"
+                    else pd.array(values, spec["dtype"])
+                )
+            else:
+                columns[spec["name"]] = self.arrays[spec["file"]][positions]
+
+        return pd.DataFrame(
+            columns,
+            index=pd.Index(
+                self.arrays["snippetIndex"][positions].astype(self.meta["indexDtype"]),
+                name=self.meta["indexName"],
+            ),
+        )
+
+    def decodeText(self, name: str, positions: np.ndarray) -> np.ndarray:
+        """
+        :name: name of the arrays the text column is stored in
+        :positions: row positions to decode
+        :return: object array with the strings, NaN where the value is missing
+        """
+
+        heap: np.ndarray = self.arrays[name + ".heap"]
+        offsets: np.ndarray = self.arrays[name + ".offsets"]
+        nulls: np.ndarray = self.arrays[name + ".nulls"]
+
+        strings: np.ndarray = np.empty(len(positions), dtype=object)
+        strings[:] = [
+            (
+                np.nan
+                if nulls[position]
+                else heap[offsets[position] : offsets[position + 1]]
+                .tobytes()
+                .decode("utf-8")
+            )
+            for position in positions.tolist()
+        ]
+
+        return strings
+
+    def positionBySecondaryKey(self, secondaryKey: str) -> int:
+        """
+        :secondaryKey: string representing the SecondaryKeys entry in the snippet database
+        :return: row position of the snippet in the snippet database, raises a KeyError if unknown
+        """
+        return self.searchPosition("secondaryKeys", secondaryKey)
+
+    def positionByFileName(self, fileName: str) -> int:
+        """
+        :fileName: string representing the FileNames entry in the snippet database
+        :return: row position of the snippet in the snippet database, raises a KeyError if unknown
+        """
+        return self.searchPosition("fileNames", fileName)
+
+    def searchPosition(self, name: str, key: str) -> int:
+        """
+        :name: name of the key lookup, 'secondaryKeys' or 'fileNames'
+        :key: the key to look up
+        :return: the first row position with the key, raises a KeyError if there is none
+        """
+
+        keys: np.ndarray = self.arrays[name + ".keys"]
+        encoded: bytes = str(key).encode("utf-8")
+
+        found: int = int(np.searchsorted(keys, encoded))
+
+        if found == len(keys) or keys[found] != encoded:
+            raise KeyError(key)
+
+        return int(self.arrays[name + ".positions"][found])
+
+    def fileNames(self, start: int, end: int) -> np.ndarray:
+        """
+        :start: first row position
+        :end: row position after the last one
+        :return: object array with the FileNames of the rows in between
+        """
+
+        spec: Dict[str, Any] = next(
+            spec for spec in self.meta["columns"] if spec["name"] == "FileNames"
+        )
+
+        return self.decodeText(spec["file"], np.arange(start, max(start, end)))
+
+    def moodScores(self, mood: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :mood: string representing the mood
+        :return: the row positions of the snippets with a score for the mood, ascending, and their
+            scores. Raises a KeyError if the mood isn't stored.
+        """
+
+        if mood not in self.meta["moods"]:
+            raise KeyError(mood)
+
+        number: int = self.meta["moods"].index(mood)
+        offsets: np.ndarray = self.arrays["moodRows.offsets"]
+        start, end = int(offsets[number]), int(offsets[number + 1])
+
+        return (
+            self.arrays["moodRows.values"][start:end],
+            self.arrays["moodScores.values"][start:end],
+        )
+
+
+if __name__ == "__main__":
+
+    # publish the segment from the current database, run from the root of the repo with:
+    # python -m thePlayer.databaseShared
+    from thePlayer.databaseMain import databaseMain
+
+    logging.basicConfig(level=logging.INFO)
+    databaseShared().publish(databaseMain(backend="pandas", rebuild=False))
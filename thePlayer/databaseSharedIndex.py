@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from thePlayer.databaseIndex import databaseIndex
+
+
+class databaseSharedIndex(databaseIndex):
+    """
+    databaseSharedIndex is the database index of the shared backend. Its arrays, the candidate blocks
+    and the mood rankings are read-only views on the memory mapped segment published by databaseShared,
+    so every process that attaches uses the same memory. Only the small dicts per piece are built in
+    the process itself. The lookups by key and the filenames are answered by the segment.
+
+    ...
+
+    Attributes
+    ----------
+    store : databaseShared
+        the attached segment.
+
+    See databaseIndex for the other attributes, except the lookups of the secondary keys and the
+    filenames which are not kept in memory.
+
+    Methods
+    -------
+    See databaseIndex.
+
+    """
+
+    def __init__(self, store: object) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.store: object = store
+        arrays: Dict[str, np.ndarray] = store.arrays
+
+        self.noteHistograms: np.ndarray = arrays["noteHistograms"]
+        self.primaryKeys: np.ndarray = arrays["primaryKeys"]
+        self.thirdKeys: np.ndarray = arrays["thirdKeys"]
+        self.pieceOffsets: np.ndarray = arrays["pieceOffsets"]
+        self.pieceRows: np.ndarray = arrays["pieceRows"]
+        self.dominantNotes: np.ndarray = arrays["dominantNotes"]
+
+        self.primaryKeyPositions: Dict[int, int] = dict(
+            zip(store.meta["pieceKeys"], store.meta["piecePositions"])
+        )
+        self.pieceNumbers: Dict[Any, int] = {
+            key: number
+            for number, key in enumerate(
+                self.primaryKeys[self.pieceOffsets[:-1]].tolist()
+            )
+        }
+        self.instruments: np.ndarray = np.array(store.meta["instruments"], dtype=object)
+
+        self.candidateBlocks: Dict[Tuple[Any, Any], np.ndarray] = store.packed(
+            "candidateBlocks", [tuple(key) for key in store.meta["candidateBlocks"]]
+        )
+        self.moodRankings: Dict[str, np.ndarray] = store.packed(
+            "moodRankings", store.meta["moodRankings"]
+        )
+
+        # perform logging operations
+        self.logger.info(f"database index attached - snippets: {len(self.primaryKeys)}")
+
+    def positionBySecondaryKey(self, secondaryKey: str) -> int:
+        """
+        :secondaryKey: string representing the SecondaryKeys entry in the snippet database
+        :return: row position of the snippet in the snippet database, raises a KeyError if unknown
+        """
+        return self.store.positionBySecondaryKey(secondaryKey)
+
+    def positionByFileName(self, fileName: str) -> int:
+        """
+        :fileName: string representing the FileNames entry in the snippet database
+        :return: row position of the snippet in the snippet database, raises a KeyError if unknown
+        """
+        return self.store.positionByFileName(fileName)
+
+    def snippetFileNames(self, start: int, end: int) -> np.ndarray:
+        """
+        :start: first row position
+        :end: row position after the last one
+        :return: array with the FileNames of the rows in between
+        """
+        return self.store.fileNames(start, end)
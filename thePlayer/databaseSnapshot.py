@@ -0,0 +1,497 @@
+import os
+import json
+import hashlib
+import shutil
+import numpy as np
+import pandas as pd
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from Settings.Settings import (
+    musicFullDataBaseURL,
+    musicMoodsDataBaseURL,
+    musicSnippetsDataBaseTagsURL,
+    musicSnapshotURL,
+)
+from thePlayer.databaseSchema import databaseSchema
+
+# version of the on-disk layout, bump it whenever the way columns are written changes so old
+# snapshots are detected as stale instead of being read wrongly.
+snapshotVersion: int = 3
+
+# the tables that make up the music database, with the .csv file they are read from and the
+# arguments pandas needs to read them.
+snapshotTables: Dict[str, Tuple[str, Dict[str, Any]]] = {
+    "snippets": (musicSnippetsDataBaseTagsURL, {"index_col": 0}),
+    "full": (musicFullDataBaseURL, {}),
+    "moods": (musicMoodsDataBaseURL, {}),
+}
+
+
+# content hashes of the source files hashed by this process, by path, size and modification time, so
+# the artifacts that check the same files at startup don't hash them again.
+sourceHashes: Dict[Tuple[str, int, int], str] = {}
+
+
+class databaseSnapshot:
+    """
+    databaseSnapshot writes the .csv files of the music database to a typed, binary and columnar
+    snapshot and reads them back. Parsing 110k rows of .csv and inferring their types takes seconds,
+    reading the snapshot back is little more than mapping a few files into memory.
+
+    Every column is written to its own .npy file, so it can be memory mapped. Text columns are
+    stored as one utf-8 heap with an array of offsets. A manifest.json next to the columns records
+    the dtypes and the size and content hash of the .csv files the snapshot was built from, which is
+    how a stale snapshot is detected.
+
+    ...
+
+    Attributes
+    ----------
+    snapshotURL : str
+        directory the snapshot is written to
+
+    Methods
+    -------
+    build() :
+        reads all the .csv files and writes them to the snapshot directory.
+
+    load() :
+        reads the snapshot back into dataframes.
+
+    writeTable() :
+        writes all the columns of one table.
+
+    appendRows() :
+        adds rows that were appended to a .csv file to the snapshot.
+
+    loadTable() :
+        reads some or all of the columns of one table from the snapshot.
+
+    isStale() :
+        checks whether the snapshot is missing or older than the .csv files.
+
+    readSources() :
+        reads the tables straight from the .csv files.
+
+    readSource() :
+        reads some or all of the columns of one table from its .csv file.
+
+    tableColumns() :
+        returns the names of the columns a table has.
+
+    readManifest() :
+        returns the manifest of the snapshot, or None if there is none.
+
+    columnFiles() :
+        returns the names of the files a column is stored in.
+
+    """
+
+    def __init__(self, snapshotURL: str = musicSnapshotURL) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.snapshotURL: str = snapshotURL
+        self.manifestURL: str = os.path.join(snapshotURL, "manifest.json")
+
+    def build(
+        self, frames: Optional[Dict[str, TypeVar("pd.DataFrame")]] = None
+    ) -> Dict[str, Any]:
+        """
+        Reads every table from its .csv file and writes it to the snapshot directory. The snapshot is
+        first written to a temporary directory and only swapped in once complete, so a crash halfway
+        never leaves a snapshot behind that looks valid.
+
+        :frames: the tables as returned by readSource(), when they have been read already. None reads them here.
+        :return: the manifest that was written
+        """
+
+        if frames is None:
+            frames = self.readSources()
+
+        tmpURL: str = self.snapshotURL + ".tmp"
+        if os.path.isdir(tmpURL):
+            shutil.rmtree(tmpURL)
+        os.makedirs(tmpURL)
+
+        manifest: Dict[str, Any] = {"version": snapshotVersion, "tables": {}}
+
+        for table, frame in frames.items():
+            manifest["tables"][table] = self.writeTable(
+                os.path.join(tmpURL, table), table, frame
+            )
+
+        with open(os.path.join(tmpURL, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        if os.path.isdir(self.snapshotURL):
+            shutil.rmtree(self.snapshotURL)
+        os.replace(tmpURL, self.snapshotURL)
+
+        # perform logging operations
+        self.logger.info(f"build called - snapshot written to {self.snapshotURL}")
+
+        return manifest
+
+    def writeTable(
+        self, tableURL: str, table: str, frame: TypeVar("pd.DataFrame")
+    ) -> Dict[str, Any]:
+        """
+        Writes all the columns of a table to a directory of its own.
+
+        :tableURL: directory to write the table to, it must not exist yet
+        :table: name of the table, one of the keys of snapshotTables
+        :frame: the table as a dataframe
+        :return: the manifest entry describing the table
+        """
+
+        os.makedirs(tableURL)
+
+        return {
+            "source": self.sourceStamp(snapshotTables[table][0]),
+            "rows": len(frame),
+            "index": self.writeColumn(tableURL, "index", frame.index),
+            "columns": {
+                str(column): self.writeColumn(tableURL, f"{number:04d}", frame[column])
+                for number, column in enumerate(frame.columns)
+            },
+            "order": [str(column) for column in frame.columns],
+        }
+
+    def appendRows(self, table: str, frame: TypeVar("pd.DataFrame")) -> None:
+        """
+        Adds rows that have just been appended to the .csv file of a table to the snapshot, so it stays
+        up to date without reading the .csv files again. Only the directory of that table is rewritten,
+        from the columns already in the snapshot and the new rows.
+
+        :table: name of the table, one of the keys of snapshotTables
+        :frame: the new rows, with the columns of the .csv file
+        """
+
+        manifest: Dict[str, Any] = self.readManifest()
+        tableURL: str = os.path.join(self.snapshotURL, table)
+
+        # the new rows are cast first so their keys are encoded like the ones in the snapshot.
+        # Categoricals with different categories are concatenated as objects, the schema casts them back.
+        combined: TypeVar("pd.DataFrame") = databaseSchema().apply(
+            table,
+            pd.concat([self.loadTable(table), databaseSchema().apply(table, frame)]),
+        )
+
+        tmpURL: str = tableURL + ".tmp"
+        if os.path.isdir(tmpURL):
+            shutil.rmtree(tmpURL)
+
+        manifest["tables"][table] = self.writeTable(tmpURL, table, combined)
+
+        shutil.rmtree(tableURL)
+        os.replace(tmpURL, tableURL)
+
+        with open(self.manifestURL, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        # perform logging operations
+        self.logger.info(f"appendRows called - table: {table}, rows: {len(frame)}")
+
+    def load(self) -> Dict[str, TypeVar("pd.DataFrame")]:
+        """
+        Reads all the tables from the snapshot. Numeric columns are memory mapped, text columns are
+        decoded from their heap in one go.
+
+        :return: a dict with a dataframe for every table in the snapshot
+        """
+
+        tables: Dict[str, TypeVar("pd.DataFrame")] = {
+            table: self.loadTable(table) for table in self.readManifest()["tables"]
+        }
+
+        # perform logging operations
+        self.logger.info(f"load called - tables: {list(tables)}")
+
+        return tables
+
+    def loadTable(
+        self, table: str, columns: Optional[List[str]] = None
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        Reads a single table from the snapshot. Every column has files of its own, so columns that
+        aren't asked for are never touched.
+
+        :table: name of the table, one of the keys of snapshotTables
+        :columns: names of the columns to read, in the order of the snapshot. None reads all of them,
+            names the table doesn't have are skipped.
+        :return: the table as a dataframe
+        """
+
+        spec: Dict[str, Any] = self.readManifest()["tables"][table]
+        tableURL: str = os.path.join(self.snapshotURL, table)
+
+        frame: TypeVar("pd.DataFrame") = pd.DataFrame(
+            {
+                column: self.readColumn(tableURL, spec["columns"][column])
+                for column in spec["order"]
+                if columns is None or column in columns
+            },
+            index=pd.Index(
+                self.readColumn(tableURL, spec["index"]), name=spec["index"]["name"]
+            ),
+        )
+
+        # perform logging operations
+        self.logger.debug(
+            f"loadTable called - table: {table}, columns: {list(frame.columns)}"
+        )
+
+        return frame
+
+    def isStale(self) -> bool:
+        """
+        A snapshot is stale when it doesn't exist, was written by a different version of this module,
+        when one of the files its manifest lists is missing, or when one of the .csv files it was built
+        from has changed since.
+
+        :return: True if the snapshot can't be used
+        """
+
+        manifest: Optional[Dict[str, Any]] = self.readManifest()
+
+        if manifest is None or manifest.get("version") != snapshotVersion:
+            return True
+
+        for table, (sourceURL, _) in snapshotTables.items():
+            if table not in manifest["tables"]:
+                return True
+
+            # a manifest can outlive the columns it describes, for example when only part of the
+            # snapshot was copied or checked out.
+            tableURL: str = os.path.join(self.snapshotURL, table)
+            spec: Dict[str, Any] = manifest["tables"][table]
+            for columnSpec in [spec["index"], *spec["columns"].values()]:
+                missing: List[str] = [
+                    fileName
+                    for fileName in self.columnFiles(columnSpec)
+                    if not os.path.isfile(os.path.join(tableURL, fileName))
+                ]
+                if missing:
+                    self.logger.warning(
+                        f"isStale called - {table} column files {missing} not found"
+                    )
+                    return True
+
+            # without the source there is nothing to compare against, the snapshot is all we have.
+            if not os.path.isfile(sourceURL):
+                self.logger.warning(f"isStale called - source {sourceURL} not found")
+                continue
+
+            if manifest["tables"][table]["source"] != self.sourceStamp(sourceURL):
+                return True
+
+        return False
+
+    def readSources(self) -> Dict[str, TypeVar("pd.DataFrame")]:
+        """
+        Reads all the tables straight from their .csv files, this is the slow path. The columns are cast
+        to the compact dtypes of databaseSchema.
+
+        :return: a dict with a dataframe for every table
+        """
+
+        return {table: self.readSource(table) for table in snapshotTables}
+
+    def readSource(
+        self, table: str, columns: Optional[List[str]] = None
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        Reads a single table from its .csv file, cast to the compact dtypes of databaseSchema. Only the
+        columns that are asked for are parsed, pandas skips over the others.
+
+        :table: name of the table, one of the keys of snapshotTables
+        :columns: names of the columns to read, None reads all of them. Names the table doesn't have
+            are skipped.
+        :return: the table as a dataframe
+        """
+
+        sourceURL, kwargs = snapshotTables[table]
+
+        if columns is not None:
+            # the index column is read as well, whatever its name.
+            header: List[str] = pd.read_csv(sourceURL, nrows=0).columns.tolist()
+            kwargs = dict(
+                kwargs,
+                usecols=[
+                    number
+                    for number, column in enumerate(header)
+                    if column in columns or number == kwargs.get("index_col")
+                ],
+            )
+
+        return databaseSchema().apply(table, pd.read_csv(sourceURL, **kwargs))
+
+    def tableColumns(self, table: str, fromSnapshot: bool = True) -> List[str]:
+        """
+        :table: name of the table, one of the keys of snapshotTables
+        :fromSnapshot: True to look the columns up in the snapshot, False to read the header of the .csv
+        :return: names of the columns of the table, without the index column
+        """
+
+        if fromSnapshot:
+            return list(self.readManifest()["tables"][table]["order"])
+
+        sourceURL, kwargs = snapshotTables[table]
+
+        return pd.read_csv(sourceURL, nrows=0, **kwargs).columns.tolist()
+
+    def readManifest(self) -> Optional[Dict[str, Any]]:
+        """
+        Reads the manifest of the snapshot.
+
+        :return: the manifest as a dict, or None if no snapshot has been built
+        """
+
+        try:
+            with open(self.manifestURL) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def sourceStamp(self, sourceURL: str) -> Dict[str, Union[str, int]]:
+        """
+        Describes the content of a source file, so a change to it can be detected later on. The content
+        is hashed rather than trusting the modification time, which copies and checkouts don't keep.
+
+        :sourceURL: path to the .csv file
+        :return: dict with the name, size and sha256 hash of the file
+        """
+
+        stat: os.stat_result = os.stat(sourceURL)
+        key: Tuple[str, int, int] = (
+            os.path.abspath(sourceURL),
+            stat.st_size,
+            stat.st_mtime_ns,
+        )
+
+        if key not in sourceHashes:
+            digest: object = hashlib.sha256()
+            with open(sourceURL, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            sourceHashes[key] = digest.hexdigest()
+
+        return {
+            "file": os.path.basename(sourceURL),
+            "size": stat.st_size,
+            "sha256": sourceHashes[key],
+        }
+
+    def writeColumn(
+        self, tableURL: str, fileName: str, values: TypeVar("pd.Series")
+    ) -> Dict[str, Any]:
+        """
+        Writes a single column to disk. Numbers and booleans are written as a plain .npy file,
+        categoricals as their codes with the categories written as a column of their own, and
+        anything else is treated as text and written as a utf-8 heap with character offsets.
+
+        :tableURL: directory of the table the column belongs to
+        :fileName: name of the file(s) the column is written to, without extension
+        :values: the column itself, a series or an index
+        :return: the manifest entry describing the column
+        """
+
+        spec: Dict[str, Any] = {"file": fileName, "name": values.name}
+
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes: np.ndarray = np.ascontiguousarray(values.array.codes)
+            np.save(os.path.join(tableURL, fileName + ".npy"), codes)
+
+            spec["kind"] = "category"
+            spec["categories"] = self.writeColumn(
+                tableURL, fileName + ".categories", pd.Series(values.dtype.categories)
+            )
+
+        elif pd.api.types.is_numeric_dtype(values.dtype) or pd.api.types.is_bool_dtype(
+            values.dtype
+        ):
+            array: np.ndarray = np.ascontiguousarray(values.to_numpy())
+            np.save(os.path.join(tableURL, fileName + ".npy"), array)
+
+            spec["kind"] = "numeric"
+            spec["dtype"] = array.dtype.str
+
+        else:
+            strings: np.ndarray = values.to_numpy(dtype=object)
+            nulls: np.ndarray = pd.isna(strings)
+            strings = [str(s) if not n else "" for s, n in zip(strings, nulls)]
+
+            # offsets are counted in characters rather than bytes, the heap is decoded as a whole
+            # when loading and slicing a python string by character is what we do there.
+            offsets: np.ndarray = np.zeros(len(strings) + 1, dtype=np.int64)
+            np.cumsum([len(s) for s in strings], out=offsets[1:])
+
+            heap: np.ndarray = np.frombuffer("".join(strings).encode("utf-8"), np.uint8)
+
+            np.save(os.path.join(tableURL, fileName + ".heap.npy"), heap)
+            np.save(os.path.join(tableURL, fileName + ".offsets.npy"), offsets)
+            if nulls.any():
+                np.save(os.path.join(tableURL, fileName + ".nulls.npy"), nulls)
+
+            spec["kind"] = "string"
+            spec["nulls"] = bool(nulls.any())
+
+        return spec
+
+    def columnFiles(self, spec: Dict[str, Any]) -> List[str]:
+        """
+        :spec: the manifest entry describing a column
+        :return: names of the files writeColumn() wrote the column to
+        """
+
+        if spec["kind"] == "numeric":
+            return [spec["file"] + ".npy"]
+
+        if spec["kind"] == "category":
+            return [spec["file"] + ".npy", *self.columnFiles(spec["categories"])]
+
+        return [spec["file"] + ".heap.npy", spec["file"] + ".offsets.npy"] + (
+            [spec["file"] + ".nulls.npy"] if spec["nulls"] else []
+        )
+
+    def readColumn(self, tableURL: str, spec: Dict[str, Any]) -> Any:
+        """
+        Reads a single column back from disk.
+
+        :tableURL: directory of the table the column belongs to
+        :spec: the manifest entry describing the column
+        :return: a (memory mapped) numpy array for numeric columns, a categorical for categories and
+            an object array for text
+        """
+
+        columnURL: str = os.path.join(tableURL, spec["file"])
+
+        if spec["kind"] == "numeric":
+            return np.load(columnURL + ".npy", mmap_mode="r")
+
+        if spec["kind"] == "category":
+            return pd.Categorical.from_codes(
+                np.load(columnURL + ".npy"),
+                self.readColumn(tableURL, spec["categories"]),
+            )
+
+        heap: str = np.load(columnURL + ".heap.npy").tobytes().decode("utf-8")
+        offsets: List[int] = np.load(columnURL + ".offsets.npy").tolist()
+
+        strings: np.ndarray = np.empty(len(offsets) - 1, dtype=object)
+        strings[:] = [heap[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+        if spec["nulls"]:
+            strings[np.load(columnURL + ".nulls.npy")] = np.nan
+
+        return strings
+
+
+if __name__ == "__main__":
+
+    # build the snapshot from the .csv files in theDB/, run from the root of the repo with:
+    # python -m thePlayer.databaseSnapshot
+    logging.basicConfig(level=logging.INFO)
+    databaseSnapshot().build()
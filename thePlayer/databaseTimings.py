@@ -0,0 +1,255 @@
+import time
+from threading import Lock
+import numpy as np
+import pandas as pd
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from Settings.Settings import musicTimingsSize
+
+# the stages of a similarity query, in the order they run. A query only goes through some of them, a
+# cached result for example skips everything between the cache lookup and the mood annotation. A stage
+# that runs more than once, like the scoring of every level of findRelaxedPiece, adds up.
+timingStages: List[str] = [
+    "cache",
+    "reference",
+    "graph",
+    "candidates",
+    "scoring",
+    "select",
+    "moods",
+]
+
+
+class databaseTimings:
+    """
+    databaseTimings records how long every stage of the last similarity queries took and how many rows
+    came out of it, so a slow transition can be traced to the stage that is slow without turning on
+    DEBUG logging. The queries are kept in a ring buffer of fixed size, the oldest one is overwritten by
+    the next.
+
+    A query gets a timer from start(), a dict that the stages are marked on as they finish, and is
+    recorded with add() once it is done. The timer belongs to the query alone, only add() takes the lock.
+    Every query is recorded with the method that ran it, findRelaxedPiece with the level of relaxation it
+    stopped at as in "findRelaxedPiece:relatedKeys", and the report can be limited to one of them.
+
+    ...
+
+    Attributes
+    ----------
+    size : int
+        the number of queries kept, 0 disables the recording.
+
+    seconds : np.ndarray
+        (size x n_stages) wall time of every stage of every query, NaN for the stages it skipped.
+
+    rows : np.ndarray
+        (size x n_stages) number of rows that came out of every stage of every query, -1 for the stages
+        it skipped.
+
+    references : np.ndarray
+        the reference snippet of every query.
+
+    queries : np.ndarray
+        the method that ran every query.
+
+    count : int
+        number of queries recorded so far, also the ones that have been overwritten.
+
+    Methods
+    -------
+    start() :
+        returns a timer for a new query.
+
+    mark() :
+        marks the end of a stage on a timer.
+
+    add() :
+        records a finished query.
+
+    report() :
+        returns the percentiles of the time and the rows of every stage.
+
+    slowest() :
+        returns the slowest recorded queries.
+
+    chosen() :
+        selects the recorded queries of a method.
+
+    clear() :
+        forgets all recorded queries.
+
+    """
+
+    def __init__(self, size: int = musicTimingsSize) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.size: int = size
+        self.lock: Lock = Lock()
+        self.clear()
+
+    def start(self) -> Optional[Dict[Optional[str], Any]]:
+        """
+        :return: a timer for a new query, None if the recording is disabled
+        """
+
+        if self.size <= 0:
+            return None
+
+        # the None key holds the time the last stage ended.
+        return {None: time.perf_counter()}
+
+    def mark(
+        self, timer: Optional[Dict[Optional[str], Any]], stage: str, rows: int
+    ) -> None:
+        """
+        :timer: the timer of the query as returned by start(), nothing is marked if it is None
+        :stage: name of the stage that has just ended, one of timingStages
+        :rows: number of rows that came out of the stage
+        """
+
+        if timer is None:
+            return
+
+        now: float = time.perf_counter()
+        seconds, before = timer.get(stage, (0, 0))
+        timer[stage] = (seconds + now - timer[None], before + rows)
+        timer[None] = now
+
+    def add(
+        self,
+        timer: Optional[Dict[Optional[str], Any]],
+        reference: str,
+        query: str = "querySimilarPiece",
+    ) -> None:
+        """
+        :timer: the timer of the finished query, nothing is recorded if it is None
+        :reference: the reference snippet of the query
+        :query: the method that ran the query
+        """
+
+        if timer is None:
+            return
+
+        seconds: List[float] = [np.nan] * len(timingStages)
+        rows: List[int] = [-1] * len(timingStages)
+
+        for number, stage in enumerate(timingStages):
+            if stage in timer:
+                seconds[number], rows[number] = timer[stage]
+
+        with self.lock:
+            slot: int = self.count % self.size
+            self.seconds[slot] = seconds
+            self.rows[slot] = rows
+            self.references[slot] = reference
+            self.queries[slot] = query
+            self.count += 1
+
+    def report(self, query: Optional[str] = None) -> TypeVar("pd.DataFrame"):
+        """
+        :query: the method to limit the report to, "findRelaxedPiece" covers all its levels while
+            "findRelaxedPiece:strict" covers one. None for all the queries.
+        :return: a dataframe with a row per stage and one for the whole query, with the number of queries
+            that went through it and the 50th, 95th and 99th percentile of its time in milliseconds and
+            of the rows that came out of it
+        """
+
+        with self.lock:
+            recorded: int = min(self.count, self.size)
+            chosen: np.ndarray = self.chosen(self.queries[:recorded], query)
+            seconds: np.ndarray = self.seconds[:recorded][chosen]
+            rows: np.ndarray = self.rows[:recorded][chosen]
+
+        report: List[Dict[str, Any]] = []
+
+        for number, stage in enumerate(timingStages + ["total"]):
+            if stage == "total":
+                stageSeconds: np.ndarray = np.nansum(seconds, axis=1)
+                stageRows: np.ndarray = rows[:, timingStages.index("moods")]
+            else:
+                ran: np.ndarray = rows[:, number] >= 0
+                stageSeconds = seconds[ran, number]
+                stageRows = rows[ran, number]
+
+            entry: Dict[str, Any] = {"stage": stage, "queries": len(stageSeconds)}
+            for percentile in (50, 95, 99):
+                entry[f"p{percentile}Ms"] = (
+                    np.percentile(stageSeconds, percentile) * 1000
+                    if len(stageSeconds)
+                    else np.nan
+                )
+            for percentile in (50, 95, 99):
+                entry[f"p{percentile}Rows"] = (
+                    np.percentile(stageRows, percentile) if len(stageRows) else np.nan
+                )
+            report.append(entry)
+
+        # perform logging operations
+        self.logger.info(f"report called - queries: {len(seconds)}, query: {query}")
+
+        return pd.DataFrame(report).set_index("stage")
+
+    def slowest(
+        self, n: int = 10, query: Optional[str] = None
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        :n: the number of queries to return
+        :query: the method to limit the queries to as in report(), None for all the queries
+        :return: a dataframe with the method, the reference and the time in milliseconds of every stage of
+            the n slowest recorded queries, slowest first
+        """
+
+        with self.lock:
+            recorded: int = min(self.count, self.size)
+            chosen: np.ndarray = self.chosen(self.queries[:recorded], query)
+            seconds: np.ndarray = self.seconds[:recorded][chosen]
+            references: np.ndarray = self.references[:recorded][chosen]
+            queries: np.ndarray = self.queries[:recorded][chosen]
+
+        totals: np.ndarray = np.nansum(seconds, axis=1)
+        order: np.ndarray = np.argsort(-totals, kind="stable")[:n]
+
+        slowest: TypeVar("pd.DataFrame") = pd.DataFrame(
+            seconds[order] * 1000, columns=timingStages
+        )
+        slowest.insert(0, "query", queries[order])
+        slowest.insert(1, "referencePiece", references[order])
+        slowest["total"] = totals[order] * 1000
+
+        return slowest
+
+    def chosen(self, queries: np.ndarray, query: Optional[str]) -> np.ndarray:
+        """
+        :queries: the method of every recorded query
+        :query: the method to select as in report(), None for all the queries
+        :return: boolean array that is True for the queries that were run by the method
+        """
+
+        if query is None:
+            return np.ones(len(queries), dtype=bool)
+
+        return np.array(
+            [
+                recorded == query or recorded.startswith(query + ":")
+                for recorded in queries
+            ],
+            dtype=bool,
+        )
+
+    def clear(self) -> None:
+        """
+        Forgets all recorded queries.
+        """
+
+        with self.lock:
+            self.seconds: np.ndarray = np.full(
+                (max(self.size, 0), len(timingStages)), np.nan
+            )
+            self.rows: np.ndarray = np.full(
+                (max(self.size, 0), len(timingStages)), -1, dtype=np.int64
+            )
+            self.references: np.ndarray = np.empty(max(self.size, 0), dtype=object)
+            self.queries: np.ndarray = np.empty(max(self.size, 0), dtype=object)
+            self.count: int = 0
@@ -98,13 +98,17 @@ class musicMain:
             "False": [],
         }
 
-    def main(self, gameState: str) -> Union[None, TypeVar("pd.Series")]:
+    def main(
+        self, gameState: str, moodOptions: Optional[List[str]] = None
+    ) -> Union[None, TypeVar("pd.Series")]:
         """
         main method that coordinates all music playback and database lookups. It takes the game
         state and selects new music based on mood tags. This method is only called when a music
         switching event is called from the main method.
 
         :gameState: A string variable that represents the player's current action.
+        :moodOptions: the moods that fit the change in game state in order of preference, as
+            contextMain keeps them. The next ones are tried when the first has no matches.
         :return: None if no matches have been found, else the matched row from the database
         """
 
@@ -123,24 +127,16 @@ class musicMain:
                     # The starting point for the music takes a random piece that coheres highly
                     # to the mood we are looking for and plays it from the start.
 
-                    matches: TypeVar("pd.DataFrame") = self.data.findPieceByMood(mood)
-
-                    if matches.empty:
-                        raise KeyError
-
-                    # choose one sample at random
-                    match: TypeVar("pd.DataFrame") = matches.sample()
-                    matchedRow: TypeVar("pd.Series") = matches.loc[
-                        match.index.values[0]
-                    ]
+                    # choose one sample at random, raises a KeyError if there are none.
+                    matchedRow: TypeVar("pd.Series") = self.data.samplePieceByMood(
+                        mood
+                    ).iloc[0]
 
                     secondaryKey: str = str(int(matchedRow.PrimaryKeys)) + "_0000"
-                    matchedRow: TypeVar("pd.Series") = self.data.df_snippets.loc[
-                        self.data.df_snippets.SecondaryKeys == secondaryKey
-                    ]
-
-                    if matchedRow.empty:
-                        raise KeyError
+                    # raises a KeyError when the piece has no first snippet.
+                    matchedRow: TypeVar("pd.DataFrame") = self.data.snippetRows(
+                        [self.data.index.positionBySecondaryKey(secondaryKey)]
+                    )
 
                     filenames: TypeVar("pd.Series") = self.data.gatherSnippets(
                         matchedRow
@@ -149,6 +145,9 @@ class musicMain:
 
                     matchFound: bool = True
 
+                    # the piece is avoided by the next searches.
+                    self.data.markPlayed(matchedRow["PrimaryKeys"].iat[0])
+
                     # perform logging operations
                     self.logger.debug(f"player silent: {self.player.is_silent}")
                     self.logger.debug(f"matches found: {filenames}")
@@ -161,9 +160,13 @@ class musicMain:
                     # in this case 2 snippets from the current one being played.
                     toMatch: str = self.player.getFutureSnippet(2)
 
-                    matches: TypeVar("pd.DataFrame") = self.data.findSimilarPiece(
-                        toMatch, mood
+                    # the filters are relaxed step by step when they leave nothing, within the
+                    # search budget, rather than staying silent until the next tick. When nothing fits
+                    # the preferred mood, the other moods are tried in order of preference.
+                    matches, level = self.data.findRelaxedPiece(
+                        toMatch, mood, fallbackMoods=moodOptions
                     )
+                    self.logger.debug(f"matches found at level: {level}")
 
                     if matches.empty:
                         raise KeyError
@@ -178,13 +181,16 @@ class musicMain:
 
                     matchFound: bool = True
 
+                    # the piece is avoided by the next searches.
+                    self.data.markPlayed(matchedRow["PrimaryKeys"])
+
                     # perform logging operations
                     self.logger.debug(f"player silent: {self.player.is_silent}")
                     self.logger.debug(f"matches found: {filenames}")
 
                     return matchedRow["PrimaryKeys"]
 
-            except IndexError as e:
+            except (IndexError, KeyError) as e:
                 # perform logging operations
                 self.logger.debug(f"matches found: None")
                 return None
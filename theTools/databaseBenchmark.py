@@ -0,0 +1,418 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+import numpy as np
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+import Settings.Settings as settings
+from theTools.databaseGenerator import databaseGenerator
+
+# the numbers of snippets the database is benchmarked at: a small catalog, the size of the real one
+# and ten times that.
+benchmarkSizes: List[int] = [10000, 110000, 1000000]
+
+# the folder the .csv files and artifacts of the database are in, as set in Settings.
+defaultDBURL: str = os.path.join(settings.rootURL, settings.musicDBPath)
+
+# the environment variable that points the processes of a benchmark at the database of one size.
+benchmarkVariable: str = "BENCHMARK_DB_URL"
+
+
+def pointSettingsAt(dataURL: str) -> None:
+    """
+    Points every location in theDB/ that is set in Settings to the same file in another folder, and
+    turns off the query cache so every query is measured in full. This has to happen before the
+    modules of thePlayer are imported, they read the settings when they are.
+
+    :dataURL: the folder of the database to use
+    """
+
+    for name, value in list(vars(settings).items()):
+        if (
+            name.startswith("music")
+            and isinstance(value, str)
+            and value.startswith(defaultDBURL + os.sep)
+        ):
+            setattr(
+                settings,
+                name,
+                os.path.join(dataURL, os.path.relpath(value, defaultDBURL)),
+            )
+
+    settings.musicQueryCacheSize = 0
+
+
+# the processes the database is measured in, and the processes they start to build the artifacts, all
+# import this module first.
+if os.environ.get(benchmarkVariable):
+    pointSettingsAt(os.environ[benchmarkVariable])
+
+
+def summarize(seconds: List[float]) -> Dict[str, float]:
+    """
+    :seconds: the wall time of every call
+    :return: dict with the number of calls and the mean, 50th, 95th and 99th percentile and maximum time
+        in milliseconds
+    """
+
+    milliseconds: np.ndarray = np.array(seconds) * 1000
+
+    return {
+        "calls": len(milliseconds),
+        "mean": float(milliseconds.mean()),
+        "p50": float(np.percentile(milliseconds, 50)),
+        "p95": float(np.percentile(milliseconds, 95)),
+        "p99": float(np.percentile(milliseconds, 99)),
+        "max": float(milliseconds.max()),
+    }
+
+
+def peakMemory() -> Optional[int]:
+    """
+    :return: the peak resident memory of the process in bytes, None where the platform can't tell
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # linux reports kilobytes, macOS bytes.
+    peak: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def runWorker(backend: str, queries: int, seed: int, build: bool) -> Dict[str, Any]:
+    """
+    Times the database in this process, against the database the environment variable points at.
+    Runs in a fresh process per size, so the load is measured cold and the sizes don't share any state.
+
+    :backend: the backend to load the database with
+    :queries: the number of calls of every query method
+    :seed: seed of the random generator that picks the queries
+    :build: True to build all the artifacts first, otherwise only the snapshot is built
+    :return: dict with the time of every step and a summary of the time of every query method
+    """
+
+    from thePlayer.databaseMain import databaseMain
+    from thePlayer.databaseBuild import databaseBuild
+    from thePlayer.databaseSnapshot import databaseSnapshot
+
+    result: Dict[str, Any] = {}
+
+    start: float = time.perf_counter()
+    if build:
+        databaseBuild().build(backend)
+    else:
+        databaseSnapshot().build()
+    result["build"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    database: object = databaseMain(backend=backend, rebuild=False)
+    result["load"] = time.perf_counter() - start
+    result["graph"] = database.graph.targets is not None
+
+    rng: object = np.random.default_rng(seed)
+    moods: List[str] = list(database.moods.entries)
+
+    # references that can be matched: with a valence and a piece in the full database.
+    references: np.ndarray = np.flatnonzero(
+        ~np.isnan(database.scoring.valence) & (database.index.pieceRows >= 0)
+    )
+    references = rng.choice(references, min(queries, len(references)), replace=False)
+
+    timings: Dict[str, List[float]] = {
+        "findPieceByMood": [],
+        "findSimilarPiece": [],
+        "gatherSnippets": [],
+    }
+
+    for reference in references.tolist():
+        mood: str = moods[rng.integers(len(moods))]
+
+        start = time.perf_counter()
+        database.findPieceByMood(mood)
+        timings["findPieceByMood"].append(time.perf_counter() - start)
+
+        fileName: str = database.index.snippetFileNames(reference, reference + 1)[0]
+
+        start = time.perf_counter()
+        matches: TypeVar("pd.DataFrame") = database.findSimilarPiece(fileName, mood)
+        timings["findSimilarPiece"].append(time.perf_counter() - start)
+
+        if len(matches):
+            start = time.perf_counter()
+            database.gatherSnippets(matches.iloc[[0]])
+            timings["gatherSnippets"].append(time.perf_counter() - start)
+
+    result["queries"] = {
+        method: summarize(seconds) for method, seconds in timings.items() if seconds
+    }
+    result["peakMemory"] = peakMemory()
+
+    return result
+
+
+class databaseBenchmark:
+    """
+    databaseBenchmark measures the music database on synthetic data at several sizes: the time it takes
+    to build the artifacts and to load the database, and the time findPieceByMood, findSimilarPiece and
+    gatherSnippets take per call. Every size is generated with databaseGenerator and measured in a
+    process of its own. The results are written as JSON, together with the version of the code and the
+    machine they were measured on, so runs of different versions can be compared with compare().
+
+    ...
+
+    Attributes
+    ----------
+    sizes : List[int]
+        the numbers of snippets to benchmark at.
+
+    dataURL : str
+        the folder the synthetic databases are kept in, one subfolder per size.
+
+    backend : str
+        the backend to load the database with.
+
+    queries : int
+        the number of calls of every query method per size.
+
+    seed : int
+        seed of the generator and of the choice of queries.
+
+    build : bool
+        True to build all the artifacts, including the transition graph, before loading.
+
+    Methods
+    -------
+    run() :
+        benchmarks every size and returns the results.
+
+    runSize() :
+        benchmarks a single size in a separate process.
+
+    environment() :
+        describes the code and the machine the benchmark runs on.
+
+    compare() :
+        compares the results of two runs.
+
+    """
+
+    def __init__(
+        self,
+        sizes: List[int] = benchmarkSizes,
+        dataURL: Optional[str] = None,
+        backend: str = "pandas",
+        queries: int = 200,
+        seed: int = 0,
+        build: bool = False,
+    ) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.sizes: List[int] = sizes
+        self.dataURL: Optional[str] = dataURL
+        self.backend: str = backend
+        self.queries: int = queries
+        self.seed: int = seed
+        self.build: bool = build
+
+    def run(self) -> Dict[str, Any]:
+        """
+        :return: dict with the environment and the results of every size
+        """
+
+        # without a folder to keep them in, the databases are generated in a temporary one.
+        dataURL: str = self.dataURL or tempfile.mkdtemp(prefix="theDB-benchmark-")
+        results: Dict[str, Any] = {"environment": self.environment(), "sizes": []}
+
+        try:
+            for size in self.sizes:
+                results["sizes"].append(
+                    self.runSize(size, os.path.join(dataURL, str(size)))
+                )
+        finally:
+            if self.dataURL is None:
+                shutil.rmtree(dataURL, ignore_errors=True)
+
+        return results
+
+    def runSize(self, size: int, sizeURL: str) -> Dict[str, Any]:
+        """
+        :size: the number of snippets
+        :sizeURL: the folder of the database of this size, it is generated if it isn't there
+        :return: dict with the results of the size
+        """
+
+        result: Dict[str, Any] = {"snippets": size, "generate": None}
+
+        generator: databaseGenerator = databaseGenerator(size, seed=self.seed)
+        result["pieces"] = generator.pieces
+
+        if not os.path.isfile(os.path.join(sizeURL, "DatabaseSplittedTags.csv")):
+            start: float = time.perf_counter()
+            generator.generate(sizeURL)
+            result["generate"] = time.perf_counter() - start
+
+        # the worker prints its results as the last line of its output.
+        output: str = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "theTools.databaseBenchmark",
+                "--worker",
+                "--backend",
+                self.backend,
+                "--queries",
+                str(self.queries),
+                "--seed",
+                str(self.seed),
+            ]
+            + (["--build"] if self.build else []),
+            cwd=settings.rootURL,
+            env={**os.environ, benchmarkVariable: sizeURL},
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+        ).stdout
+        result.update(json.loads(output.strip().splitlines()[-1]))
+
+        # perform logging operations
+        self.logger.info(
+            f"runSize called - snippets: {size}, load: {result['load']:.3f}s, findSimilarPiece p50: {result['queries']['findSimilarPiece']['p50']:.3f}ms"
+        )
+
+        return result
+
+    def environment(self) -> Dict[str, Any]:
+        """
+        :return: dict with the commit of the code, the settings of the run and the machine it runs on
+        """
+
+        try:
+            commit: Optional[str] = subprocess.run(
+                ["git", "rev-parse", "HEAD"],
+                cwd=settings.rootURL,
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+
+        return {
+            "commit": commit,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "backend": self.backend,
+            "queries": self.queries,
+            "seed": self.seed,
+            "build": self.build,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": __import__("pandas").__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        }
+
+    def compare(
+        self, baseline: Dict[str, Any], results: Dict[str, Any]
+    ) -> List[Dict[str, Any]]:
+        """
+        :baseline: the results of an earlier run, as written by run()
+        :results: the results of this run
+        :return: a row per size and measurement with both times and the ratio of this run to the baseline,
+            the median is used for the query methods
+        """
+
+        rows: List[Dict[str, Any]] = []
+        before: Dict[int, Dict[str, Any]] = {
+            size["snippets"]: size for size in baseline["sizes"]
+        }
+
+        for size in results["sizes"]:
+            old: Optional[Dict[str, Any]] = before.get(size["snippets"])
+            if old is None:
+                continue
+
+            measurements: List[Tuple[str, float, float]] = [
+                (step, old[step], size[step]) for step in ("build", "load")
+            ] + [
+                (method, old["queries"][method]["p50"], timing["p50"])
+                for method, timing in size["queries"].items()
+                if method in old["queries"]
+            ]
+
+            for name, oldValue, newValue in measurements:
+                rows.append(
+                    {
+                        "snippets": size["snippets"],
+                        "measurement": name,
+                        "baseline": oldValue,
+                        "current": newValue,
+                        "ratio": newValue / oldValue if oldValue else None,
+                    }
+                )
+
+        return rows
+
+
+if __name__ == "__main__":
+
+    # benchmark the database on synthetic data, run from the root of the repo with:
+    # python -m theTools.databaseBenchmark [--sizes 10000 110000 1000000] [--output benchmark.json]
+    #     [--compare <earlier results .json>] [--data <folder to keep the databases in>] [--build]
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=benchmarkSizes)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare")
+    parser.add_argument("--data")
+    parser.add_argument("--backend", default="pandas")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--build", action="store_true")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    arguments: argparse.Namespace = parser.parse_args()
+
+    if arguments.worker:
+        print(
+            json.dumps(
+                runWorker(
+                    arguments.backend,
+                    arguments.queries,
+                    arguments.seed,
+                    arguments.build,
+                )
+            )
+        )
+        sys.exit()
+
+    logging.basicConfig(level=logging.INFO)
+
+    benchmark: databaseBenchmark = databaseBenchmark(
+        arguments.sizes,
+        arguments.data,
+        arguments.backend,
+        arguments.queries,
+        arguments.seed,
+        arguments.build,
+    )
+    results: Dict[str, Any] = benchmark.run()
+
+    with open(arguments.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if arguments.compare:
+        with open(arguments.compare) as f:
+            for row in benchmark.compare(json.load(f), results):
+                print(
+                    f"{row['snippets']:>8} {row['measurement']:<18} {row['baseline']:>10.4f} {row['current']:>10.4f} {row['ratio'] or float('nan'):>6.2f}x"
+                )
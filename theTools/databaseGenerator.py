@@ -0,0 +1,308 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+from typing import List, Set, Dict, Tuple, Optional, Union, Any, TypeVar
+import logging
+
+from Settings.Settings import musicMoods
+
+# the instrumentations and composers the pieces are drawn from.
+generatorInstruments: List[str] = [
+    "Piano",
+    "Orchestra",
+    "Strings",
+    "Organ",
+    "Choir",
+    "Guitar",
+]
+generatorComposers: List[str] = [
+    "Bach",
+    "Beethoven",
+    "Brahms",
+    "Chopin",
+    "Debussy",
+    "Dvorak",
+    "Mahler",
+    "Mozart",
+    "Ravel",
+    "Schubert",
+    "Tchaikovsky",
+    "Vivaldi",
+]
+
+# the average number of snippets per piece of the real database, 110k snippets of 800 pieces.
+generatorSnippetsPerPiece: int = 137
+
+# the scale degrees of a major key, notes of a piece are mostly drawn from the scale of its key.
+majorScale: List[int] = [0, 2, 4, 5, 7, 9, 11]
+
+
+class databaseGenerator:
+    """
+    databaseGenerator writes a synthetic music database with the layout of the .csv files in theDB/:
+    Database.csv with the pieces, DatabaseSplitted.csv and DatabaseSplittedTags.csv with the snippets
+    and Cyanite.csv with the mood tags. The real files aren't part of the repository, the synthetic
+    ones make it possible to run and benchmark the database at any size.
+
+    The values are random but shaped like the real ones: every piece has an instrumentation, a key, a
+    tempo and a valence and arousal that its snippets vary around, the notes of a snippet are mostly
+    from the scale of the key, a tenth of the snippets lack a valence and a piece only has scores for
+    some of the moods. The same seed always gives the same files.
+
+    ...
+
+    Attributes
+    ----------
+    snippets : int
+        the number of snippets to generate.
+
+    pieces : int
+        the number of pieces the snippets are divided over.
+
+    seed : int
+        seed of the random generator.
+
+    Methods
+    -------
+    generate() :
+        writes the .csv files.
+
+    pieceLengths() :
+        divides the snippets over the pieces.
+
+    fullTable() :
+        generates the pieces.
+
+    snippetTable() :
+        generates the snippets.
+
+    moodTable() :
+        generates the mood tags of the pieces.
+
+    """
+
+    def __init__(
+        self, snippets: int = 110000, pieces: Optional[int] = None, seed: int = 0
+    ) -> None:
+        # initialize logger
+        self.logger: object = logging.getLogger(__name__)
+
+        self.snippets: int = snippets
+        self.pieces: int = pieces or max(1, snippets // generatorSnippetsPerPiece)
+        self.seed: int = seed
+
+        if self.pieces > self.snippets:
+            raise ValueError(
+                f"databaseGenerator initialized - {self.pieces} pieces need at least as many snippets"
+            )
+
+    def generate(self, outURL: str) -> Dict[str, int]:
+        """
+        :outURL: the folder to write the .csv files to, it is created if it doesn't exist
+        :return: dict with the number of pieces and snippets written
+        """
+
+        rng: object = np.random.default_rng(self.seed)
+        os.makedirs(outURL, exist_ok=True)
+
+        lengths: np.ndarray = self.pieceLengths(rng)
+        df_snippets: TypeVar("pd.DataFrame") = self.snippetTable(rng, lengths)
+        df_full: TypeVar("pd.DataFrame") = self.fullTable(rng, lengths, df_snippets)
+        df_moods: TypeVar("pd.DataFrame") = self.moodTable(rng)
+
+        df_full.to_csv(os.path.join(outURL, "Database.csv"), index=False)
+        df_snippets.to_csv(os.path.join(outURL, "DatabaseSplittedTags.csv"))
+        df_snippets[["FileNames", "PrimaryKeys", "SecondaryKeys"]].to_csv(
+            os.path.join(outURL, "DatabaseSplitted.csv")
+        )
+        df_moods.to_csv(os.path.join(outURL, "Cyanite.csv"), index=False)
+
+        # perform logging operations
+        self.logger.info(
+            f"generate called - pieces: {self.pieces}, snippets: {self.snippets}, written to {outURL}"
+        )
+
+        return {"pieces": self.pieces, "snippets": self.snippets}
+
+    def pieceLengths(self, rng: object) -> np.ndarray:
+        """
+        :rng: the random generator
+        :return: the number of snippets of every piece, at least 1 and adding up to the number of snippets
+        """
+
+        # every piece gets one snippet, the rest is divided in proportion to a random weight.
+        weights: np.ndarray = rng.gamma(4, size=self.pieces)
+        lengths: np.ndarray = 1 + np.floor(
+            weights / weights.sum() * (self.snippets - self.pieces)
+        ).astype(np.int64)
+
+        # what is left after rounding down goes to the pieces with the largest remainders.
+        remainders: np.ndarray = weights / weights.sum() * (self.snippets - self.pieces)
+        remainders -= np.floor(remainders)
+        lengths[np.argsort(-remainders)[: self.snippets - lengths.sum()]] += 1
+
+        return lengths
+
+    def fullTable(
+        self,
+        rng: object,
+        lengths: np.ndarray,
+        df_snippets: TypeVar("pd.DataFrame"),
+    ) -> TypeVar("pd.DataFrame"):
+        """
+        :rng: the random generator
+        :lengths: the number of snippets of every piece
+        :df_snippets: the snippets, the duration of a piece is that of its snippets
+        :return: the pieces, with the columns of Database.csv
+        """
+
+        keys: np.ndarray = np.arange(self.pieces)
+
+        return pd.DataFrame(
+            {
+                "PrimaryKey": keys,
+                "FileName": [f"piece_{key}.flac" for key in keys],
+                "Composer": np.array(generatorComposers)[
+                    rng.integers(len(generatorComposers), size=self.pieces)
+                ],
+                "Instrument": np.array(generatorInstruments)[
+                    rng.integers(len(generatorInstruments), size=self.pieces)
+                ],
+                "Duration": np.add.reduceat(
+                    df_snippets["Duration"].to_numpy(),
+                    np.concatenate([[0], np.cumsum(lengths)[:-1]]),
+                ).round(2),
+            }
+        )
+
+    def snippetTable(self, rng: object, lengths: np.ndarray) -> TypeVar("pd.DataFrame"):
+        """
+        :rng: the random generator
+        :lengths: the number of snippets of every piece
+        :return: the snippets sorted by piece and bar, with the columns of DatabaseSplittedTags.csv
+        """
+
+        pieces: np.ndarray = np.repeat(np.arange(self.pieces), lengths)
+        bars: np.ndarray = np.arange(self.snippets) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+        )
+
+        # the values every piece varies around.
+        pieceKeys: np.ndarray = rng.integers(12, size=self.pieces)
+        pieceTempi: np.ndarray = rng.integers(60, 180, size=self.pieces)
+        pieceNoisiness: np.ndarray = rng.uniform(0.1, 1.1, size=self.pieces)
+        pieceValence: np.ndarray = rng.uniform(-1, 1, size=self.pieces)
+        pieceArousal: np.ndarray = rng.uniform(-1, 1, size=self.pieces)
+
+        tempo: np.ndarray = np.clip(
+            pieceTempi[pieces] + rng.integers(-4, 5, size=self.snippets), 40, 220
+        ).astype(float)
+
+        # the notes of a snippet are mostly from the scale of the key of its piece.
+        density: np.ndarray = rng.integers(3, 30, size=self.snippets)
+        offsets: np.ndarray = np.concatenate([[0], np.cumsum(density)])
+        owners: np.ndarray = np.repeat(np.arange(self.snippets), density)
+        inScale: np.ndarray = rng.random(offsets[-1]) < 0.85
+        notes: np.ndarray = (
+            np.where(
+                inScale,
+                pieceKeys[pieces][owners]
+                + np.array(majorScale)[rng.integers(7, size=offsets[-1])],
+                rng.integers(12, size=offsets[-1]),
+            )
+            % 12
+        )
+        noteLists: List[str] = [
+            "[" + ", ".join(map(str, notes[start:end].tolist())) + "]"
+            for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())
+        ]
+        uniqueNotes: np.ndarray = np.array(
+            [
+                len(set(notes[start:end].tolist()))
+                for start, end in zip(offsets[:-1], offsets[1:])
+            ]
+        )
+
+        df_snippets: TypeVar("pd.DataFrame") = pd.DataFrame(
+            {
+                "FileNames": [
+                    f"piece_{piece}.flac_{bar + 1}.wav"
+                    for piece, bar in zip(pieces.tolist(), bars.tolist())
+                ],
+                "PrimaryKeys": pieces.astype(float),
+                "SecondaryKeys": [
+                    f"{piece}_{bar:04d}"
+                    for piece, bar in zip(pieces.tolist(), bars.tolist())
+                ],
+                "ThirdKey": bars,
+                "TotalSnippets": lengths[pieces],
+                "Duration": (4 * 60 / tempo).round(3),
+                "NoisinessMedian": np.clip(
+                    pieceNoisiness[pieces] + rng.normal(0, 0.05, size=self.snippets),
+                    0.1,
+                    1.1,
+                ),
+                "TempoMean": tempo,
+                "DensityNotes": density,
+                "Notes": noteLists,
+                "UniqueNotes": uniqueNotes,
+                "DominantNoteMean": np.where(
+                    rng.random(self.snippets) < 0.8,
+                    pieceKeys[pieces],
+                    rng.integers(12, size=self.snippets),
+                ),
+                "Valence": np.where(
+                    rng.random(self.snippets) < 0.9,
+                    np.clip(
+                        pieceValence[pieces] + rng.normal(0, 0.1, size=self.snippets),
+                        -1,
+                        1,
+                    ),
+                    np.nan,
+                ),
+                "Arousal": np.clip(
+                    pieceArousal[pieces] + rng.normal(0, 0.1, size=self.snippets), -1, 1
+                ),
+            }
+        )
+
+        # a piece has scores for some of the moods only, for all of its snippets.
+        for mood in musicMoods:
+            scored: np.ndarray = rng.random(self.pieces) < 0.3
+            level: np.ndarray = rng.random(self.pieces)
+            df_snippets[mood] = np.where(
+                scored[pieces],
+                np.clip(level[pieces] + rng.normal(0, 0.05, size=self.snippets), 0, 1),
+                np.nan,
+            )
+
+        return df_snippets
+
+    def moodTable(self, rng: object) -> TypeVar("pd.DataFrame"):
+        """
+        :rng: the random generator
+        :return: the mood tag of every piece, with the columns of Cyanite.csv
+        """
+
+        return pd.DataFrame(
+            {
+                "PrimaryKey": np.arange(self.pieces),
+                "mood": np.array(musicMoods)[
+                    rng.integers(len(musicMoods), size=self.pieces)
+                ],
+            }
+        )
+
+
+if __name__ == "__main__":
+
+    # write a synthetic database, run from the root of the repo with:
+    # python -m theTools.databaseGenerator <folder> [snippets] [pieces]
+    # point musicDBPath in Settings/Settings.py at the folder to use it.
+    logging.basicConfig(level=logging.INFO)
+
+    databaseGenerator(
+        int(sys.argv[2]) if len(sys.argv) > 2 else 110000,
+        int(sys.argv[3]) if len(sys.argv) > 3 else None,
+    ).generate(sys.argv[1])